@@ -0,0 +1,231 @@
+﻿import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from pathlib import Path
+
+import click
+from pydantic import BaseModel, Field
+
+from benchmarks.synthetic_api import SyntheticApiConfig, SyntheticPatentsApi
+
+"""
+End to end ingestion benchmark - runs fetch_patents against a local synthetic patents api with each output sink, and
+compares the results against a stored baseline to flag regressions.
+
+Every sink is benchmarked in a fresh process, so its peak RSS is its own and nothing (imports, pools, caches) is
+warmed up by the sink before it. patent_fetcher reads its settings on import, so it is only imported in those
+processes, once API_URL points at the synthetic api.
+
+eg python -m benchmarks --items 50000 --concurrency 8
+"""
+
+OUTPUTS = ("local", "sqlite", "ndjson", "partitioned")
+GRANT_FROM_DATE, GRANT_TO_DATE = date(2024, 1, 1), date(2025, 1, 1)
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+
+
+class BenchmarkConfig(BaseModel):
+    api: SyntheticApiConfig = Field(default_factory=SyntheticApiConfig)
+    page_size: int = Field(default=500, ge=1)
+    concurrency: int = Field(default=4, ge=1)
+    flush_workers: int = Field(default=1, ge=0)
+    buffer_size: int = Field(default=5_000, ge=1)
+    process_workers: int = Field(default=0, ge=0)
+
+
+class SinkResult(BaseModel):
+    items: int
+    seconds: float
+    items_per_second: float
+    page_latency_p50: float | None # seconds, estimated from the request_seconds histogram buckets
+    page_latency_p99: float | None
+    peak_rss_bytes: int | None # None where the platform can't tell
+
+
+class BenchmarkReport(BaseModel):
+    config: BenchmarkConfig
+    results: dict[str, SinkResult] = Field(default_factory=dict)
+
+
+def _peak_rss_bytes() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_sink(output: str, config: BenchmarkConfig, workdir: str) -> SinkResult:
+    """
+    Fetches every synthetic patent into one sink, in the calling process (see run_benchmark for a fresh one each)
+    """
+    from patent_fetcher.clients.patent_client import PatentClient
+    from patent_fetcher.constants import CacheMode, Output, OUTPUT_CLIENT
+    from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+    from patent_fetcher.models.patent_client import PatentsClientRequest
+    from patent_fetcher.settings import cli_settings
+
+    # Everything a sink writes stays in the workdir, and nothing is served from or kept in local state
+    os.chdir(workdir)
+    cli_settings.output_dir = workdir
+    cli_settings.sqlite_db = os.path.join(workdir, "patents.db")
+    cli_settings.cache_db = None
+    cli_settings.state_db = None
+    cli_settings.buffer_size = config.buffer_size
+    cli_settings.process_workers = config.process_workers
+
+    request = PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=GRANT_FROM_DATE,
+            grant_to_date=GRANT_TO_DATE,
+            pagination=PatentsApiRequestPage(page_size=config.page_size)
+        ),
+        output_client=OUTPUT_CLIENT[Output(output)],
+        concurrency=config.concurrency,
+        flush_workers=config.flush_workers,
+        cache_mode=CacheMode.BYPASS,
+    )
+    started = time.perf_counter()
+    with PatentClient() as client:
+        response = client.fetch_patents(request)
+    seconds = time.perf_counter() - started
+
+    latency = response.metrics.histogram("request_seconds") if response.metrics else None
+    return SinkResult(
+        items=response.total_items_outputted,
+        seconds=seconds,
+        items_per_second=response.total_items_outputted / seconds,
+        page_latency_p50=latency.p50 if latency else None,
+        page_latency_p99=latency.p99 if latency else None,
+        peak_rss_bytes=_peak_rss_bytes(),
+    )
+
+
+def run_benchmark(config: BenchmarkConfig, outputs: tuple[str, ...] = OUTPUTS) -> BenchmarkReport:
+    """
+    Serves the synthetic api from this process, and benchmarks each sink against it in a fresh process
+    """
+    api = SyntheticPatentsApi(config.api)
+    api.prerender(config.page_size, GRANT_FROM_DATE, GRANT_TO_DATE)
+    api.start()
+    os.environ["API_URL"] = api.url
+    os.environ["API_TOKEN"] = "benchmark"
+    report = BenchmarkReport(config=config)
+    try:
+        for output in outputs:
+            with tempfile.TemporaryDirectory(prefix=f"patent_benchmark_{output}_") as workdir, \
+                    ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                report.results[output] = executor.submit(run_sink, output, config, workdir).result()
+    finally:
+        api.stop()
+    return report
+
+
+def compare(report: BenchmarkReport, baseline: BenchmarkReport, tolerance: float) -> list[str]:
+    """
+    :param tolerance: relative slack before a change counts as a regression, eg 0.2 for 20%
+    :return: a description of each regression against the baseline - throughput down, or p50 latency/peak RSS up.
+             p99 is only reported, with a few dozen pages it is down to the one slowest page and too noisy to gate on
+    """
+    if report.config != baseline.config:
+        raise ValueError("The baseline was recorded with a different benchmark config, re-record it with --save_baseline")
+    regressions = []
+    for output, result in report.results.items():
+        if (base := baseline.results.get(output)) is None:
+            continue
+        if result.items_per_second < base.items_per_second * (1 - tolerance):
+            regressions.append(f"{output}: {result.items_per_second:.0f} items/s, baseline {base.items_per_second:.0f}")
+        for metric in ("page_latency_p50", "peak_rss_bytes"):
+            value, base_value = getattr(result, metric), getattr(base, metric)
+            if value is not None and base_value and value > base_value * (1 + tolerance):
+                regressions.append(f"{output}: {metric} {value:g}, baseline {base_value:g}")
+    return regressions
+
+
+def _format_result(output: str, result: SinkResult) -> str:
+    p50 = f"{result.page_latency_p50 * 1000:.1f}ms" if result.page_latency_p50 is not None else "-"
+    p99 = f"{result.page_latency_p99 * 1000:.1f}ms" if result.page_latency_p99 is not None else "-"
+    rss = f"{result.peak_rss_bytes / 1024 ** 2:.0f}MiB" if result.peak_rss_bytes else "-"
+    return f"{output:<12} {result.items:>9} {result.items_per_second:>12.0f} {p50:>10} {p99:>10} {rss:>10}"
+
+
+@click.command()
+@click.option("--items", type=click.IntRange(min=1), default=20_000, help="Number of synthetic patents, defaults to 20000")
+@click.option("--page_size", type=click.IntRange(min=1), default=500, help="Page size fetched, defaults to 500")
+@click.option("--concurrency", type=click.IntRange(min=1), default=4, help="Pages fetched in parallel, defaults to 4")
+@click.option("--flush_workers", type=click.IntRange(min=0), default=1, help="Background writer threads, defaults to 1")
+@click.option("--process_workers", type=click.IntRange(min=0), default=0, help="Processes decoding pages and compressing outputs, defaults to 0")
+@click.option("--latency", type=click.FloatRange(min=0), default=0.005, help="Seconds added to every page, defaults to 0.005")
+@click.option("--jitter", type=click.FloatRange(min=0), default=0.0, help="Up to this many more seconds per page, defaults to 0")
+@click.option("--description_bytes", type=click.IntRange(min=0), default=4_000, help="Description size per patent, defaults to 4000")
+@click.option("--claims", type=click.IntRange(min=0), default=10, help="Claims per patent, defaults to 10")
+@click.option("--error_rate", type=click.FloatRange(min=0, max=1), default=0.0, help="Share of page requests failing with a 500, defaults to 0")
+@click.option("--seed", type=int, default=0, help="Seed of the synthetic patents, latencies and errors, defaults to 0")
+@click.option("--output", type=click.Choice(OUTPUTS), multiple=True, help="Sink to benchmark, repeatable, defaults to all")
+@click.option("--baseline", type=click.Path(dir_okay=False, path_type=Path), default=DEFAULT_BASELINE, help="Baseline file to compare against")
+@click.option("--save_baseline", is_flag=True, help="Records this run as the baseline instead of comparing against it")
+@click.option("--tolerance", type=click.FloatRange(min=0), default=0.2, help="Relative slack before a change is a regression, defaults to 0.2")
+def main(
+        items: int,
+        page_size: int,
+        concurrency: int,
+        flush_workers: int,
+        process_workers: int,
+        latency: float,
+        jitter: float,
+        description_bytes: int,
+        claims: int,
+        error_rate: float,
+        seed: int,
+        output: tuple[str, ...],
+        baseline: Path,
+        save_baseline: bool,
+        tolerance: float
+) -> None:
+    """
+    Benchmarks fetch_patents end to end against a local synthetic patents api, with each output sink
+    """
+    config = BenchmarkConfig(
+        api=SyntheticApiConfig(
+            total_items=items,
+            latency_seconds=latency,
+            latency_jitter_seconds=jitter,
+            description_bytes=description_bytes,
+            claims=claims,
+            error_rate=error_rate,
+            seed=seed,
+        ),
+        page_size=page_size,
+        concurrency=concurrency,
+        flush_workers=flush_workers,
+        process_workers=process_workers,
+    )
+    report = run_benchmark(config, output or OUTPUTS)
+
+    click.echo(f"{'output':<12} {'items':>9} {'items/s':>12} {'p50':>10} {'p99':>10} {'peak rss':>10}")
+    for sink, result in report.results.items():
+        click.echo(_format_result(sink, result))
+
+    if save_baseline:
+        baseline.write_text(report.model_dump_json(indent=2) + "\n", encoding="utf-8")
+        click.echo(f"Saved baseline to {baseline}")
+        return
+    if not baseline.exists():
+        click.echo(f"No baseline at {baseline}, record one with --save_baseline")
+        return
+    base = BenchmarkReport.model_validate_json(baseline.read_text(encoding="utf-8"))
+    if base.config != report.config:
+        click.echo(f"Baseline at {baseline} was recorded with a different config, nothing to compare against")
+        return
+    regressions = compare(report, base, tolerance)
+    for regression in regressions:
+        click.echo(f"REGRESSION {regression}", err=True)
+    if regressions:
+        sys.exit(1)
+    click.echo(f"No regressions against {baseline} (tolerance {tolerance:.0%})")
@@ -0,0 +1,160 @@
+﻿import json
+import random
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pydantic import BaseModel, Field
+
+
+class SyntheticApiConfig(BaseModel):
+    """
+    Shape of the synthetic patents api - the same config always serves the same patents, whatever the page size
+    """
+    total_items: int = Field(default=20_000, ge=0)
+    latency_seconds: float = Field(default=0.005, ge=0) # added to every /patents response
+    latency_jitter_seconds: float = Field(default=0.0, ge=0) # up to this much more, per request
+    description_bytes: int = Field(default=4_000, ge=0) # size of each patent's description
+    claims: int = Field(default=10, ge=0) # claims per patent
+    error_rate: float = Field(default=0.0, ge=0, le=1) # share of /patents requests answered with a 500
+    seed: int = 0
+
+
+class SyntheticPatentsApi(ThreadingHTTPServer):
+    """
+    Local stand-in for the patents api (/health and /patents) serving deterministic synthetic patents, for benchmarks.
+
+    Patent i is generated from the seed and i alone, so runs are comparable across page sizes and concurrency.
+    Latency and errors are drawn from the seed, the page and how often that page has been asked for, so a retried
+    page doesn't fail forever and a rerun sees the same errors in the same places.
+
+    Pages can be rendered up front (see prerender), so the benchmarked client isn't held back by this server building
+    json on the same machine - at the cost of holding every page in memory.
+    """
+    daemon_threads = True
+    TEXT_POOL_BYTES = 1024 ** 2
+
+    def __init__(self, config: SyntheticApiConfig, port: int = 0):
+        super().__init__(("127.0.0.1", port), _SyntheticPatentsApiHandler)
+        self.config = config
+        self.requests = 0
+        self.errors = 0
+        self._attempts: dict[int, int] = {}
+        self._rendered: dict[tuple[int, int, str, str], bytes] = {}
+        self._lock = threading.Lock()
+        # Descriptions and claims are slices of one pool of words, so generating a page costs next to nothing
+        rng = random.Random(config.seed)
+        words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 10))) for _ in range(2_000)]
+        pool = []
+        size = 0
+        while size < self.TEXT_POOL_BYTES + config.description_bytes:
+            word = rng.choice(words)
+            pool.append(word)
+            size += len(word) + 1
+        self._text = " ".join(pool)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def patent(self, i: int, grant_from_date: date, days: int) -> dict:
+        rng = random.Random(self.config.seed * 1_000_003 + i)
+        offset = rng.randrange(self.TEXT_POOL_BYTES)
+        return {
+            "patent_number": f"US{i:08d}",
+            "title": self._text[offset:offset + 80],
+            "grant_date": (grant_from_date + timedelta(days=i % days)).isoformat(),
+            "abstract": self._text[offset:offset + 600],
+            "claims": [self._text[offset + 10 * c:offset + 10 * c + 200] for c in range(self.config.claims)],
+            "assignees": [f"Assignee {i % 97}"],
+            "inventors": [f"Inventor {i % 1009}", f"Inventor {(i * 7) % 1009}"],
+            "description": self._text[offset:offset + self.config.description_bytes],
+        }
+
+    def patents_page(self, page: int, page_size: int, grant_from_date: str, grant_to_date: str) -> dict:
+        total_items = self.config.total_items
+        start = date.fromisoformat(grant_from_date)
+        days = max((date.fromisoformat(grant_to_date) - start).days, 1)
+        first = (page - 1) * page_size
+        return {
+            "patents": [self.patent(i, start, days) for i in range(first, min(first + page_size, total_items))],
+            "pagination": {
+                "page": page,
+                "page_size": page_size,
+                "total_pages": -(-total_items // page_size),
+                "total_items": total_items,
+            },
+        }
+
+    def prerender(self, page_size: int, grant_from_date: date, grant_to_date: date) -> None:
+        """
+        Renders every page of the given request up front, served as-is from then on
+        """
+        for page in range(1, max(-(-self.config.total_items // page_size), 1) + 1):
+            key = (page, page_size, grant_from_date.isoformat(), grant_to_date.isoformat())
+            self._rendered[key] = json.dumps(self.patents_page(*key)).encode("utf-8")
+
+    def rendered_page(self, page: int, page_size: int, grant_from_date: str, grant_to_date: str) -> bytes:
+        key = (page, page_size, grant_from_date, grant_to_date)
+        if (rendered := self._rendered.get(key)) is not None:
+            return rendered
+        return json.dumps(self.patents_page(*key)).encode("utf-8")
+
+    def draw(self, page: int) -> tuple[float, bool]:
+        """
+        :return: the latency and whether to fail this request for the page
+        """
+        with self._lock:
+            self.requests += 1
+            attempt = self._attempts[page] = self._attempts.get(page, 0) + 1
+        rng = random.Random(f"{self.config.seed}:{page}:{attempt}")
+        latency = self.config.latency_seconds + rng.uniform(0, self.config.latency_jitter_seconds)
+        failed = rng.random() < self.config.error_rate
+        if failed:
+            with self._lock:
+                self.errors += 1
+        return latency, failed
+
+
+class _SyntheticPatentsApiHandler(BaseHTTPRequestHandler):
+    server: SyntheticPatentsApi
+    protocol_version = "HTTP/1.1" # keep-alive, like the real api behind a load balancer
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._respond(404, {"detail": "not found"})
+        self._respond(200, {"status": "healthy", "service": "synthetic-patents-api"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/patents":
+            return self._respond(404, {"detail": "not found"})
+        pagination = body["pagination"]
+        latency, failed = self.server.draw(pagination["page"])
+        if latency:
+            threading.Event().wait(latency)
+        if failed:
+            return self._respond(500, {"detail": "synthetic failure"})
+        self._respond(200, self.server.rendered_page(
+            pagination["page"], pagination["page_size"], body["grant_from_date"], body["grant_to_date"]
+        ))
+
+    def _respond(self, status: int, body: dict | bytes):
+        raw = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *_):
+        pass
@@ -1,15 +1,20 @@
 ﻿import json
 import logging
 import sys
+from collections.abc import Callable
+from contextlib import closing
 from datetime import datetime
+from typing import TYPE_CHECKING
 
 import click
 
-from patent_fetcher.clients.patent_client import PatentClient
-from patent_fetcher.constants import Output, OUTPUT_CLIENT
-from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage, HealthApiResponse
-from patent_fetcher.models.patent_client import PatentsClientResponse, PatentsClientRequest
-from patent_fetcher.settings import cli_settings
+from patent_fetcher.constants import CacheMode, DedupMode, OUTPUT_CLIENT
+
+# Everything past click is imported by the command that needs it, so --help and quick commands like check-health
+# don't pay for importing every client, model and output, or for reading the settings
+if TYPE_CHECKING:
+    from patent_fetcher.models.api import HealthApiResponse, Patent
+    from patent_fetcher.models.patent_client import PatentsClientResponse
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,10 +25,43 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+class OutputChoice(click.Choice):
+    """
+    Choice of the outputs in OUTPUT_CLIENT, only looked up once an --output is given or help is shown
+    """
+
+    def __init__(self):
+        self.case_sensitive = False
+
+    @property
+    def choices(self) -> tuple[str, ...]:
+        return tuple(OUTPUT_CLIENT.names())
+
+
+def _with_metrics(fetch: Callable[[], "PatentsClientResponse"]) -> "PatentsClientResponse":
+    """
+    Runs a fetch, writing its metrics to METRICS_FILE (if set) whether it succeeds or fails part way through
+    """
+    from patent_fetcher.clients.metrics import write_metrics
+    from patent_fetcher.exceptions import PatentFetchError
+    from patent_fetcher.settings import cli_settings
+
+    response = None
+    try:
+        response = fetch()
+        return response
+    except PatentFetchError as e:
+        response = e.response
+        raise
+    finally:
+        if cli_settings.metrics_file and response and response.metrics:
+            write_metrics(response.metrics, cli_settings.metrics_file, cli_settings.metrics_format)
+
+
 @click.command()
 @click.argument("start_date", type=click.DateTime())
 @click.argument("end_date", type=click.DateTime())
-def patent_fetcher(start_date: datetime, end_date: datetime) -> PatentsClientResponse:
+def patent_fetcher(start_date: datetime, end_date: datetime) -> "PatentsClientResponse":
     """
     This was a conscious decision to add an extra function so that the example from the readme can be executed as-is,
     otherwise - this is just a passthrough to the main CLI
@@ -52,11 +90,69 @@ def patent_fetcher(start_date: datetime, end_date: datetime) -> PatentsClientRes
 @click.option(
     "--page_size",
     type=int,
-    help=f"Optional - number of items to fetch per page, defaults to {cli_settings.max_page_size}")
+    help="Optional - number of items to fetch per page, defaults to MAX_PAGE_SIZE")
 @click.option(
     "--output",
-    type=click.Choice(Output, case_sensitive=False),
-    help="Optional - specifies output location, defaults to none"
+    type=OutputChoice(),
+    multiple=True,
+    help="Optional - specifies output location, defaults to none. Repeat to write every flush to several outputs at once"
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    help="Optional - number of pages to fetch in parallel once the page count is known, defaults to 1"
+)
+@click.option(
+    "--flush_workers",
+    type=click.IntRange(min=0),
+    help="Optional - number of background threads writing to the output while fetching continues, defaults to 0 (inline). "
+         "Checkpointed runs (STATE_DB) write each output's batches in turn, so --resume never re-writes a batch"
+)
+@click.option(
+    "--shard_days",
+    type=click.IntRange(min=1),
+    help="Optional - splits the date range into shards of this many days, fetched in parallel worker processes"
+)
+@click.option(
+    "--max_shard_pages",
+    type=click.IntRange(min=1),
+    help="Optional - halves any shard whose first page reports more than this many pages, implies sharding"
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Optional - number of worker processes for sharded fetches, defaults to the number of cores"
+)
+@click.option(
+    "--no_cache",
+    is_flag=True,
+    help="Optional - bypasses the page cache entirely, neither reading nor writing it"
+)
+@click.option(
+    "--refresh_cache",
+    is_flag=True,
+    help="Optional - always fetches from the api, overwriting any cached pages"
+)
+@click.option(
+    "--prune_cache",
+    is_flag=True,
+    help="Optional - removes expired pages and evicts down to the cache byte budget before fetching"
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Optional - continues an identical earlier run from the page after its last flushed page"
+)
+@click.option(
+    "--dedup",
+    type=click.Choice([d.value for d in DedupMode]),
+    default=DedupMode.AUTO.value,
+    help="Optional - drops patents repeated across pages, auto uses a Bloom filter past DEDUP_EXACT_MAX_ITEMS, defaults to auto"
+)
+@click.option(
+    "--skip_existing",
+    is_flag=True,
+    help="Optional - drops patents already in the sqlite output before they are buffered, needs --output sqlite"
 )
 def fetch_patents(
         start_date: datetime,
@@ -64,36 +160,228 @@ def fetch_patents(
         start_page: int | None = 1,
         num_pages: int | None = None,
         page_size: int | None = None,
-        output: Output | None = None
-) -> PatentsClientResponse:
+        output: tuple[str, ...] = (),
+        concurrency: int | None = None,
+        flush_workers: int | None = None,
+        shard_days: int | None = None,
+        max_shard_pages: int | None = None,
+        workers: int | None = None,
+        no_cache: bool = False,
+        refresh_cache: bool = False,
+        prune_cache: bool = False,
+        resume: bool = False,
+        dedup: str = DedupMode.AUTO.value,
+        skip_existing: bool = False
+) -> "PatentsClientResponse":
     """
-    Fetches patents from the patent API between START_DATE and END_DATE and outputs them to OUTPUT.
+    Fetches patents from the patent API between START_DATE and END_DATE and outputs them to each OUTPUT.
     Optionally, NUM_PAGES can be fetched of PAGE_SIZE each, starting from a specific START_PAGE.
 
     :return: PatentsClientResponse containing information about the fetched patents
     """
     logger.info(f"Beginning patents fetching using {json.dumps(locals(), default=str)}")
+    if no_cache and refresh_cache:
+        raise click.UsageError("--no_cache and --refresh_cache cannot be used together")
+    from patent_fetcher.clients.patent_client import PatentClient
+    from patent_fetcher.clients.sharding import ShardedPatentClient
+    from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+    from patent_fetcher.models.patent_client import PatentsClientRequest
+
+    cache_mode = CacheMode.USE
+    if no_cache:
+        cache_mode = CacheMode.BYPASS
+    elif refresh_cache:
+        cache_mode = CacheMode.REFRESH
+
     client_request = PatentsClientRequest(
         api_request=PatentsApiRequest(
             grant_from_date=start_date.date(),
             grant_to_date=end_date.date(),
             pagination=PatentsApiRequestPage(page=start_page, page_size=page_size)
         ),
-        output_client=OUTPUT_CLIENT.get(output),
+        output_client=[OUTPUT_CLIENT[o] for o in output] or None,
         num_pages=num_pages,
-        start_page=start_page
+        start_page=start_page,
+        concurrency=concurrency,
+        flush_workers=flush_workers,
+        shard_days=shard_days,
+        max_shard_pages=max_shard_pages,
+        cache_mode=cache_mode,
+        resume=resume,
+        dedup=DedupMode(dedup),
+        skip_existing=skip_existing
     )
-    client = PatentClient()
-    return client.fetch_patents(client_request)
+    with closing(PatentClient()) as client:
+        if prune_cache and client.cache:
+            client.cache.prune()
+        if shard_days or max_shard_pages:
+            return _with_metrics(lambda: ShardedPatentClient(workers=workers).fetch_patents(client_request))
+        return _with_metrics(lambda: client.fetch_patents(client_request))
+
+
+@click.command()
+@click.option(
+    "--output",
+    type=OutputChoice(),
+    multiple=True,
+    required=True,
+    help="Required - output to sync, each keeps its own sync mark. Repeat to sync several outputs at once"
+)
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    help="Optional - grant date to start from for outputs that have never been synced"
+)
+@click.option(
+    "--overlap_days",
+    type=click.IntRange(min=0),
+    help="Optional - days re-fetched before the sync mark, for patents published late, defaults to SYNC_OVERLAP_DAYS"
+)
+@click.option(
+    "--page_size",
+    type=int,
+    help="Optional - number of items to fetch per page, defaults to MAX_PAGE_SIZE")
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    help="Optional - number of pages to fetch in parallel once the page count is known, defaults to 1"
+)
+@click.option(
+    "--flush_workers",
+    type=click.IntRange(min=0),
+    help="Optional - number of background threads writing to the output while fetching continues, defaults to 0 (inline). "
+         "Checkpointed runs (STATE_DB) write each output's batches in turn, so --resume never re-writes a batch"
+)
+def sync(
+        output: tuple[str, ...],
+        since: datetime | None = None,
+        overlap_days: int | None = None,
+        page_size: int | None = None,
+        concurrency: int | None = None,
+        flush_workers: int | None = None
+) -> "PatentsClientResponse":
+    """
+    Fetches the patents granted since each OUTPUT was last synced, up to today, and moves its sync mark forward.
+
+    :return: PatentsClientResponse containing information about the fetched patents
+    """
+    logger.info(f"Beginning patents sync using {json.dumps(locals(), default=str)}")
+    from patent_fetcher.clients.patent_client import PatentClient
+
+    with closing(PatentClient()) as client:
+        return _with_metrics(lambda: client.sync_patents(
+            [OUTPUT_CLIENT[o] for o in output],
+            since=since.date() if since else None,
+            overlap_days=overlap_days,
+            page_size=page_size,
+            concurrency=concurrency,
+            flush_workers=flush_workers
+        ))
 
 
 @click.command()
-def check_health() -> HealthApiResponse:
+def fetch_failed_pages() -> "PatentsClientResponse":
+    """
+    Re-fetches only the pages earlier fetch_patents runs gave up on after exhausting their retries, writing them to
+    the same outputs those runs used.
+
+    :return: PatentsClientResponse, with any pages that failed again in failed_pages
+    """
+    logger.info(f"Beginning re-fetch of failed pages")
+    from patent_fetcher.clients.patent_client import PatentClient
+
+    with closing(PatentClient()) as client:
+        return _with_metrics(client.fetch_failed_pages)
+
+
+@click.command()
+def check_health() -> "HealthApiResponse":
     """
     Performs a health check against the patent API.
     """
     logger.info(f"Beginning patents api health check")
-    return PatentClient().check_health()
+    from patent_fetcher.clients.patent_client import PatentClient
+
+    with closing(PatentClient()) as client:
+        return client.check_health()
+
+
+@click.command()
+@click.argument("text", required=False)
+@click.option("--patent_number", help="Optional - only the patent with this number")
+@click.option("--assignee", help="Optional - only patents assigned to this exact assignee, case insensitive")
+@click.option("--inventor", help="Optional - only patents with this exact inventor, case insensitive")
+@click.option("--start_date", type=click.DateTime(), help="Optional - only patents granted on or after this date")
+@click.option("--end_date", type=click.DateTime(), help="Optional - only patents granted before this date")
+@click.option("--limit", type=click.IntRange(min=1), default=20, help="Optional - max number of patents returned, defaults to 20")
+@click.option("--sqlite_db", help="Optional - database to search, defaults to SQLITE_DB")
+def search(
+        text: str | None = None,
+        patent_number: str | None = None,
+        assignee: str | None = None,
+        inventor: str | None = None,
+        start_date: datetime | None = None,
+        end_date: datetime | None = None,
+        limit: int = 20,
+        sqlite_db: str | None = None
+) -> list["Patent"]:
+    """
+    Searches patents previously written with --output sqlite, printing one json patent per line.
+    TEXT is an optional full text query over titles, abstracts and claims, eg "battery AND lithium".
+    """
+    logger.info(f"Beginning patents search using {json.dumps(locals(), default=str)}")
+    from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+    from patent_fetcher.settings import cli_settings
+
+    patents = SQLiteOutputClient.search(
+        sqlite_db or cli_settings.sqlite_db,
+        text=text,
+        patent_number=patent_number,
+        assignee=assignee,
+        inventor=inventor,
+        grant_from_date=start_date.date() if start_date else None,
+        grant_to_date=end_date.date() if end_date else None,
+        limit=limit
+    )
+    for patent in patents:
+        click.echo(patent.model_dump_json())
+    return patents
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Optional - interface to serve the job api on, defaults to 127.0.0.1")
+@click.option("--port", type=click.IntRange(min=0, max=65535), default=8750, help="Optional - port to serve the job api on, defaults to 8750")
+@click.option("--socket", "socket_path", help="Optional - serves the job api on this Unix socket instead of a port")
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Optional - number of jobs run at once, each on its own warm client, defaults to SERVE_WORKERS"
+)
+@click.option(
+    "--queue_size",
+    type=click.IntRange(min=1),
+    help="Optional - number of jobs waiting on a worker before new ones are turned away, defaults to SERVE_QUEUE_SIZE"
+)
+def serve(
+        host: str = "127.0.0.1",
+        port: int = 8750,
+        socket_path: str | None = None,
+        workers: int | None = None,
+        queue_size: int | None = None
+) -> None:
+    """
+    Runs as a daemon taking fetch jobs over a local job api, keeping its clients, connections and outputs loaded between
+    jobs instead of starting a new process for each. A job is a PatentsClientRequest as json, eg
+
+    curl -X POST localhost:8750/jobs -d '{"api_request": {"grant_from_date": "2024-01-01", "grant_to_date": "2024-01-02", "pagination": {}}, "output_client": "sqlite"}'
+
+    and its status and PatentsClientResponse are at /jobs/<id>.
+    """
+    logger.info(f"Beginning serve daemon using {json.dumps(locals(), default=str)}")
+    from patent_fetcher.clients.jobs import JobRunner
+    from patent_fetcher.server import serve as serve_jobs
+
+    serve_jobs(host=host, port=port, socket_path=socket_path, runner=JobRunner(workers=workers, queue_size=queue_size))
 
 
 @click.group()
@@ -102,4 +390,8 @@ def cli():
 
 
 cli.add_command(fetch_patents)
+cli.add_command(fetch_failed_pages)
+cli.add_command(sync)
 cli.add_command(check_health)
+cli.add_command(search)
+cli.add_command(serve)
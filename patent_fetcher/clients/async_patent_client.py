@@ -0,0 +1,295 @@
+﻿import asyncio
+import json
+import logging
+from collections import deque
+from collections.abc import Iterable
+from typing import ClassVar, Self
+
+import httpx
+from requests import HTTPError
+
+from patent_fetcher.clients.dedup import make_deduplicator
+from patent_fetcher.clients.flush_policy import flush_policy_from_settings
+from patent_fetcher.clients.output.base_client import OutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.clients.process_pool import process_pool
+from patent_fetcher.models.api import HealthApiResponse, PatentsApiRequest, PatentsApiResponse, PatentLike, decode_patents_page
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import PatentsClientRequest, PatentsClientResponse
+from patent_fetcher.settings import cli_settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AsyncPatentClient:
+    """
+    asyncio counterpart to the PatentClient, for embedding the fetcher inside an async service.
+
+    All pages of a run are fetched concurrently on the running event loop over one pooled httpx.AsyncClient,
+    and output flushes are handed off to a worker thread so a slow sink never stalls the loop.
+    Page bookkeeping (which pages to fetch, payload copies, flushing) is shared with the PatentClient.
+    """
+    HEALTH_PATH: ClassVar[str] = PatentClient.HEALTH_PATH
+    PATENTS_PATH: ClassVar[str] = PatentClient.PATENTS_PATH
+
+    def __init__(self, max_in_flight: int | None = None, pool_size: int | None = None, keep_alive: bool | None = None):
+        """
+        :param max_in_flight: max number of requests in flight at once across every run on this client,
+                              defaults to HTTP_POOL_SIZE
+        :param pool_size: max number of pooled connections, defaults to HTTP_POOL_SIZE
+        :param keep_alive: whether connections are kept alive between requests, defaults to HTTP_KEEP_ALIVE
+        """
+        self.pool_size = pool_size or cli_settings.http_pool_size
+        self.max_in_flight = max_in_flight or self.pool_size
+        self.keep_alive = cli_settings.http_keep_alive if keep_alive is None else keep_alive
+        self._client: httpx.AsyncClient | None = None
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """
+        Closes the underlying http client and all of its pooled connections
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Lazily creates the shared http client with the default headers cached on it
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=str(cli_settings.api_url),
+                headers={
+                    "Authorization": f"Bearer {cli_settings.api_token.get_secret_value()}",
+                    "Content-Type": "application/json",
+                },
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size if self.keep_alive else 0
+                ),
+                timeout=cli_settings.http_timeout,
+            )
+        return self._client
+
+    async def _request(self, method: str, endpoint: str, payload: str | None = None) -> dict | list:
+        """
+        Makes an HTTP request against the given endpoint, waiting for a free in-flight slot first.
+
+        :param method: HTTP method (GET/POST/etc)
+        :param endpoint: endpoint to be appended to base url
+        :param payload: optional json payload
+        :return: the decoded json response
+        :raises: HTTPError if anything goes wrong
+        """
+        raw_response = await self._request_raw(method, endpoint, payload)
+        try:
+            return json.loads(raw_response)
+        except Exception as e:
+            logger.error(f"Invalid json response from {method} on {endpoint} with payload {payload} - {e}")
+            raise HTTPError(e)
+
+    async def _request_raw(self, method: str, endpoint: str, payload: str | None = None) -> bytes:
+        """
+        Makes an HTTP request against the given endpoint, without decoding the response body.
+
+        :return: the raw response body
+        :raises: HTTPError if anything goes wrong
+        """
+        async with self._in_flight:
+            try:
+                logger.info(f"Attempting to send request to {endpoint} with payload={payload}")
+                response = await self.client.request(method, url=endpoint, content=payload)
+                response.raise_for_status()
+                return response.content
+            except Exception as e:
+                # Same generic HTTPError as the sync client, so callers can handle both the same way
+                logger.error(f"Exception when trying to {method} on {endpoint} with payload {payload} - {e}")
+                raise HTTPError(e)
+
+    async def check_health(self) -> HealthApiResponse:
+        """
+        Performs a health ping before the start of a new patent fetch request
+
+        :return: HealthResponse containing health check information
+        :raises: HTTPError if health check fails
+        """
+        raw_response = await self._request(method="GET", endpoint=self.HEALTH_PATH)
+        health_response = HealthApiResponse.model_validate(raw_response)
+        logger.info(f"Health check success - service={health_response.service} status={health_response.status}")
+        return health_response
+
+    async def fetch_patents(self, request: PatentsClientRequest) -> PatentsClientResponse:
+        """
+        Attempts to fetch patents from upstream, with the same page/buffer semantics as PatentClient.fetch_patents.
+
+        Up to request.concurrency pages (further capped by max_in_flight) are requested at once, and one instance of
+        each output client is opened for the whole run. Every flush is written to all of them concurrently, a sink that
+        fails is reported in sink_errors and dropped while the run carries on with the others. Duplicates are dropped
+        the same way as well (request.dedup, request.skip_existing).
+
+        :return: PatentsClientResponse
+        :raises: ValueError if anything goes wrong
+        """
+        logger.info(f"Beginning async patent fetch with payload {request.model_dump_json()}")
+        health_status = await self.check_health()
+        if health_status.status != "healthy":
+            raise ValueError(f"Health check failed with status {health_status}")
+
+        cur_page = request.start_page
+        buffer, output_info = [], []
+        num_patents_fetched, num_pages_fetched, duplicates_dropped = 0, 0, 0
+        payload = request.api_request
+        pending: deque[tuple[int, asyncio.Task]] = deque()
+        flush_policy = flush_policy_from_settings()
+        output_clients = await asyncio.to_thread(PatentClient._open_output_clients, request)
+        sink_errors: dict[str, list[str]] = {}
+        closed = False
+        try:
+            logger.info(f"Fetching initial page {cur_page}")
+            first_response = await self._fetch_patent_page(payload)
+            total_pages = first_response.pagination.total_pages
+            total_items = first_response.pagination.total_items
+
+            if total_pages == 0 or total_items == 0:
+                logger.info(f"No patents found for {payload.model_dump_json()}")
+                closed = True
+                await asyncio.to_thread(PatentClient._close_output_clients, output_clients, sink_errors)
+                return PatentsClientResponse(sink_errors=sink_errors)
+
+            deduplicator = make_deduplicator(
+                request.dedup, total_items, cli_settings.dedup_exact_max_items, cli_settings.dedup_error_rate
+            )
+            existing_client = next(
+                (client for client in output_clients.values() if isinstance(client, SQLiteOutputClient)), None
+            ) if request.skip_existing else None
+            # In a worker thread, as checking for existing patents is a database lookup
+            patents = await asyncio.to_thread(
+                PatentClient._drop_duplicates, first_response.patents, deduplicator, existing_client
+            )
+            duplicates_dropped += len(first_response.patents) - len(patents)
+            buffer.extend(patents)
+            flush_policy.add(patents)
+            num_patents_fetched += len(first_response.patents)
+            num_pages_fetched += 1
+            logger.info(f"Successfully fetched initial page {cur_page} (total_pages={total_pages}, total_items={total_items})")
+            cur_page += 1
+
+            pages = iter(PatentClient._remaining_pages(request, total_pages))
+            self._schedule_pages(pending, payload, pages, request.concurrency)
+            while pending:
+                page, task = pending.popleft()
+                patents_resp = await task
+                self._schedule_pages(pending, payload, pages, request.concurrency)
+
+                patents = await asyncio.to_thread(
+                    PatentClient._drop_duplicates, patents_resp.patents, deduplicator, existing_client
+                )
+                duplicates_dropped += len(patents_resp.patents) - len(patents)
+                buffer.extend(patents)
+                flush_policy.add(patents)
+                num_patents_fetched += len(patents_resp.patents)
+                num_pages_fetched += 1
+                logger.info(f"Successfully fetched a total of {len(patents_resp.patents)} patents from page {page}")
+
+                if flush_policy.should_flush():
+                    # Hand the full buffer to a thread and keep fetching into a fresh one
+                    flushed, buffer = buffer, []
+                    flush_policy.reset()
+                    output_info.extend(await self._flush_patent_buffer(output_clients, flushed, sink_errors))
+
+                cur_page = page + 1
+
+            output_info.extend(await self._flush_patent_buffer(output_clients, buffer, sink_errors))
+            buffer = []
+            closed = True
+            output_info.extend(await asyncio.to_thread(PatentClient._close_output_clients, output_clients, sink_errors))
+            return PatentsClientResponse(
+                total_items_found=total_items,
+                total_items_fetched=num_patents_fetched,
+                total_pages_fetched=num_pages_fetched,
+                total_items_outputted=PatentsClientResponse.items_outputted(output_info, output_clients),
+                duplicates_dropped=duplicates_dropped,
+                output_info=output_info,
+                errors=[error for sink in sink_errors.values() for error in sink],
+                sink_errors=sink_errors
+            )
+        except Exception as e:
+            logger.error(f"Exception occurred when attempting to fetch page {cur_page} with payload {payload.model_dump_json()} - {e}")
+            if buffer and (not output_clients or len(sink_errors) < len(output_clients)):
+                await self._flush_patent_buffer(output_clients, buffer, sink_errors)
+            raise ValueError(e)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+            if not closed:
+                # Also reached when the run itself is cancelled (asyncio.CancelledError is not an Exception), so the
+                # sinks' files and connections are never left open
+                await asyncio.to_thread(PatentClient._close_output_clients, output_clients, sink_errors)
+
+    def _schedule_pages(self, pending: deque, payload: PatentsApiRequest, pages: Iterable[int], concurrency: int) -> None:
+        """
+        Tops up the pending window with page fetch tasks, so at most `concurrency` pages are outstanding
+        """
+        while len(pending) < max(concurrency, 1) and (page := next(pages, None)) is not None:
+            logger.info(f"Attempting to fetch page {page}")
+            task = asyncio.create_task(self._fetch_patent_page(PatentClient._page_payload(payload, page)))
+            pending.append((page, task))
+
+    async def _fetch_patent_page(self, payload: PatentsApiRequest) -> PatentsApiResponse:
+        """
+        Fetches a single page of patents
+        :return: the raw response from the api as a PatentsApiResponse object
+        """
+        raw_response = await self._request_raw(
+            method="POST",
+            endpoint=self.PATENTS_PATH,
+            payload=payload.model_dump_json(),
+        )
+        strict, compact = cli_settings.strict_decoding, cli_settings.compact_records
+        if (pool := process_pool()) is not None:
+            # Off the event loop, so other pages keep being fetched while this one is validated
+            return await asyncio.get_running_loop().run_in_executor(pool, decode_patents_page, raw_response, strict, compact)
+        # Still off the event loop without a pool, in a worker thread instead
+        return await asyncio.to_thread(decode_patents_page, raw_response, strict, compact)
+
+    @staticmethod
+    async def _flush_patent_buffer(
+            output_clients: dict[str, OutputClient],
+            patents: list[PatentLike],
+            sink_errors: dict[str, list[str]]
+    ) -> list[OutputClientResponse]:
+        """
+        Flushes the buffer to every sink not in sink_errors at once, each in a worker thread as output clients are
+        blocking (file/database I/O). A sink that fails is added to sink_errors, and so skipped from then on.
+
+        :raises: ValueError once every sink has failed
+        """
+        if not output_clients:
+            return [await asyncio.to_thread(PatentClient._flush_patent_buffer, None, patents)]
+
+        sinks = [sink for sink in output_clients if sink not in sink_errors]
+        results = await asyncio.gather(
+            *(asyncio.to_thread(PatentClient._flush_patent_buffer, output_clients[sink], patents) for sink in sinks),
+            return_exceptions=True
+        )
+        responses = []
+        for sink, result in zip(sinks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Dropping sink {sink} for the rest of the run - {result}")
+                sink_errors[sink] = [str(result)]
+            else:
+                responses.append(result)
+        if len(sink_errors) == len(output_clients):
+            raise ValueError(f"Every output failed - {sink_errors}")
+        return responses
@@ -0,0 +1,119 @@
+﻿import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date
+
+from patent_fetcher.models.api import PatentsApiRequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class PageCache:
+    """
+    Persistent cache of raw patents api pages, keyed on the exact request payload.
+
+    Backed by a local SQLite file so it survives across runs. Entries expire after a TTL, and once the cached bodies
+    exceed the byte budget the least recently used entries are evicted first.
+    Only pages of grant dates entirely in the past are cached (see cacheable), as those can no longer change.
+    A single connection is shared between fetch threads, guarded by a lock.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Shard worker processes share the file, so wait on each other's writes rather than failing with "locked"
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS page_cache ("
+            " key TEXT PRIMARY KEY, body TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS page_cache_accessed_at ON page_cache (accessed_at)")
+
+    @staticmethod
+    def key(payload: PatentsApiRequest) -> str:
+        """
+        Canonical hash of the request payload (dates, page and page size) - key order and formatting independent
+        """
+        canonical = json.dumps(payload.model_dump(mode="json"), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def cacheable(payload: PatentsApiRequest) -> bool:
+        """
+        Whether a page can be cached - not if its range reaches today or later, where patents may still be granted
+        """
+        # grant_to_date is exclusive
+        return payload.grant_to_date <= date.today()
+
+    def get(self, key: str) -> str | None:
+        """
+        :return: the cached body for the key, or None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, created_at FROM page_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            body, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM page_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE page_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return body
+
+    def put(self, key: str, body: str) -> None:
+        """
+        Stores (or replaces) the body for the key, evicting least recently used entries if over the byte budget
+        """
+        now = time.time()
+        size = len(body.encode("utf-8"))
+        if size > self.max_bytes:
+            logger.info(f"Not caching page {key}, {size} bytes exceeds the cache budget of {self.max_bytes} bytes")
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_cache (key, body, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, body, size, now, now)
+            )
+            self._evict()
+
+    def prune(self) -> int:
+        """
+        Removes expired entries, and evicts down to the byte budget
+
+        :return: number of entries removed
+        """
+        with self._lock:
+            expired = self._conn.execute("DELETE FROM page_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)).rowcount
+            evicted = self._evict()
+        logger.info(f"Pruned page cache {self.path} - {expired} expired, {evicted} evicted")
+        return expired + evicted
+
+    def _evict(self) -> int:
+        # Keeps the most recently used entries whose running size fits in the budget, drops the rest
+        return self._conn.execute(
+            "DELETE FROM page_cache WHERE key IN ("
+            " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS running FROM page_cache)"
+            " WHERE running > ?)",
+            (self.max_bytes,)
+        ).rowcount
+
+    def size(self) -> int:
+        """
+        :return: total bytes of cached bodies
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM page_cache").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
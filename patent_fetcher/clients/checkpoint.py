@@ -0,0 +1,190 @@
+﻿import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date
+from typing import NamedTuple
+
+from patent_fetcher.models.patent_client import FailedPage, PatentsClientRequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Checkpoint(NamedTuple):
+    last_page: int # last page whose patents have been fully flushed to the output
+    final_page: int # last page the run intends to fetch
+
+
+class CheckpointStore:
+    """
+    Records how far each fetch run has got, so a failed run can be resumed instead of restarted.
+
+    A run is identified by a fingerprint of its request (date range, page size, page window and output), and the
+    checkpoint only ever moves forward after the output client has returned from a flush. Since pages are always
+    buffered in order, and written in order per output while checkpointing (see PatentClient's flush pipeline),
+    everything up to the checkpoint is in the output - apart from pages that failed every retry, which are recorded as
+    failed pages (before the checkpoint can move past them) instead.
+
+    Each output's own last flushed page is kept as well, recorded right after every batch written to it along with the
+    position the output reported (see OutputClient.recover). A failed output is dropped while the others carry on past
+    the run's checkpoint, so a resumed run leaves out the pages an output already holds, and first cuts back whatever
+    a crash left written past its position - nothing after the checkpoint is then in the output. Outputs that store
+    the checkpoint in the same transaction as each batch (see OutputClient.stores_checkpoints) are read on resume too,
+    as they can be a batch ahead of what was recorded here.
+
+    Also keeps the sync marks of incremental syncs - the latest grant date each sink has fully ingested.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Shard worker processes share the file, so wait on each other's writes rather than failing with "locked"
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint ("
+            " fingerprint TEXT PRIMARY KEY, last_page INTEGER NOT NULL, final_page INTEGER NOT NULL,"
+            " request TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sink_checkpoint ("
+            " fingerprint TEXT NOT NULL, sink TEXT NOT NULL, last_page INTEGER NOT NULL, position TEXT,"
+            " updated_at REAL NOT NULL, PRIMARY KEY (fingerprint, sink))"
+        )
+        # Positions came after sink checkpoints, so older state databases are missing the column
+        if "position" not in {row[1] for row in self._conn.execute("PRAGMA table_info(sink_checkpoint)")}:
+            self._conn.execute("ALTER TABLE sink_checkpoint ADD COLUMN position TEXT")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS failed_page ("
+            " fingerprint TEXT NOT NULL, page INTEGER NOT NULL, error TEXT NOT NULL, request TEXT NOT NULL,"
+            " failed_at REAL NOT NULL, PRIMARY KEY (fingerprint, page))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_mark (sink TEXT PRIMARY KEY, grant_date TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def fingerprint(request: PatentsClientRequest) -> str:
+        """
+        Hash of everything that defines which pages a run writes where - the page being fetched and
+        execution options like concurrency are deliberately left out
+        """
+        api_request = request.api_request
+        identity = {
+            "grant_from_date": api_request.grant_from_date.isoformat(),
+            "grant_to_date": api_request.grant_to_date.isoformat(),
+            "page_size": api_request.pagination.page_size,
+            "start_page": request.start_page,
+            "num_pages": request.num_pages,
+            "output_client": request.model_dump(include={"output_client"})["output_client"],
+        }
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, fingerprint: str) -> Checkpoint | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_page, final_page FROM checkpoint WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        return Checkpoint(*row) if row else None
+
+    def save(self, fingerprint: str, checkpoint: Checkpoint, request: PatentsClientRequest) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoint (fingerprint, last_page, final_page, request, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, checkpoint.last_page, checkpoint.final_page, request.model_dump_json(), time.time())
+            )
+        logger.info(f"Checkpointed run {fingerprint[:12]} at page {checkpoint.last_page}/{checkpoint.final_page}")
+
+    def clear(self, fingerprint: str) -> None:
+        """
+        Forgets a run's checkpoint and failed pages, eg when it is started over from scratch
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoint WHERE fingerprint = ?", (fingerprint,))
+            self._conn.execute("DELETE FROM sink_checkpoint WHERE fingerprint = ?", (fingerprint,))
+            self._conn.execute("DELETE FROM failed_page WHERE fingerprint = ?", (fingerprint,))
+
+    def save_sink(self, fingerprint: str, sink: str, last_page: int, position: dict | None = None) -> None:
+        """
+        Moves an output's own checkpoint within a run up to last_page - never back - along with the position the output
+        reported for it, if any
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sink_checkpoint (fingerprint, sink, last_page, position, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (fingerprint, sink) DO UPDATE SET last_page = max(last_page, excluded.last_page),"
+                " position = coalesce(excluded.position, position), updated_at = excluded.updated_at",
+                (fingerprint, sink, last_page, json.dumps(position) if position else None, time.time())
+            )
+
+    def sink_pages(self, fingerprint: str) -> dict[str, int]:
+        """
+        :return: the last page each output of a run has flushed, for the outputs that have flushed any
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sink, last_page FROM sink_checkpoint WHERE fingerprint = ?", (fingerprint,)
+            ).fetchall()
+        return dict(rows)
+
+    def sink_positions(self, fingerprint: str) -> dict[str, dict]:
+        """
+        :return: the position each output of a run reported for its last recorded batch, for the outputs that report any
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sink, position FROM sink_checkpoint WHERE fingerprint = ? AND position IS NOT NULL",
+                (fingerprint,)
+            ).fetchall()
+        return {sink: json.loads(position) for sink, position in rows}
+
+    def add_failed_page(self, fingerprint: str, failed_page: FailedPage, request: PatentsClientRequest) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO failed_page (fingerprint, page, error, request, failed_at) VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, failed_page.page, failed_page.error, request.model_dump_json(), time.time())
+            )
+        logger.warning(f"Recorded page {failed_page.page} of run {fingerprint[:12]} as failed - {failed_page.error}")
+
+    def remove_failed_page(self, fingerprint: str, page: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM failed_page WHERE fingerprint = ? AND page = ?", (fingerprint, page))
+
+    def failed_pages(self) -> dict[str, tuple[PatentsClientRequest, list[int]]]:
+        """
+        :return: the request and failed page numbers of every run with failed pages, by fingerprint
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT fingerprint, page, request FROM failed_page ORDER BY fingerprint, page").fetchall()
+        failed: dict[str, tuple[PatentsClientRequest, list[int]]] = {}
+        for fingerprint, page, request in rows:
+            if fingerprint not in failed:
+                failed[fingerprint] = (PatentsClientRequest.model_validate_json(request), [])
+            failed[fingerprint][1].append(page)
+        return failed
+
+    def sync_mark(self, sink: str) -> date | None:
+        with self._lock:
+            row = self._conn.execute("SELECT grant_date FROM sync_mark WHERE sink = ?", (sink,)).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def save_sync_mark(self, sink: str, grant_date: date) -> None:
+        """
+        Moves the sink's sync mark up to grant_date - never back, as a later sync can re-fetch an overlap without
+        finding anything newer
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_mark (sink, grant_date, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (sink) DO UPDATE SET grant_date = max(grant_date, excluded.grant_date), updated_at = excluded.updated_at",
+                (sink, grant_date.isoformat(), time.time())
+            )
+        logger.info(f"Sync mark of {sink} at {grant_date}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,96 @@
+﻿import hashlib
+import logging
+import math
+from abc import ABC, abstractmethod
+
+from patent_fetcher.constants import DedupMode
+from patent_fetcher.models.api import PatentLike
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Deduplicator(ABC):
+    """
+    Abstract base class for the de-duplication stage between fetching and flushing, keyed on patent_number.
+    """
+
+    @abstractmethod
+    def add(self, key: str) -> bool:
+        """
+        Records the key as seen
+
+        :return: whether the key had (probably) been seen before
+        """
+        pass
+
+    def filter(self, patents: list[PatentLike]) -> list[PatentLike]:
+        """
+        :return: the patents not seen before, in order - a patent repeated within the list is only kept once
+        """
+        return [patent for patent in patents if not self.add(patent.patent_number)]
+
+
+class ExactDeduplicator(Deduplicator):
+    """
+    Remembers every key in a set - exact, but memory grows with the run.
+    """
+
+    def __init__(self):
+        self._seen: set[str] = set()
+
+    def add(self, key: str) -> bool:
+        if key in self._seen:
+            return True
+        self._seen.add(key)
+        return False
+
+
+class BloomDeduplicator(Deduplicator):
+    """
+    Remembers keys in a Bloom filter, sized up front for a number of keys and a false positive rate, so memory stays
+    fixed (about 2.4 bytes per key at a 1e-4 rate) however long the run.
+
+    A false positive drops a patent that was not actually a duplicate, at roughly error_rate per patent while the
+    filter holds no more than its capacity - past it, the rate climbs quickly.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        :param capacity: number of keys the filter is sized for
+        :param error_rate: false positive rate at capacity
+        """
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.num_bits = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        logger.info(f"Sized Bloom filter for {self.capacity} patents at a {error_rate} false positive rate - "
+                    f"{len(self._bits)} bytes, {self.num_hashes} hashes")
+
+    def add(self, key: str) -> bool:
+        # Double hashing - every position is derived from two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        seen = True
+        for i in range(self.num_hashes):
+            byte, bit = divmod((h1 + i * h2) % self.num_bits, 8)
+            if not self._bits[byte] & (1 << bit):
+                seen = False
+                self._bits[byte] |= 1 << bit
+        return seen
+
+
+def make_deduplicator(mode: DedupMode, expected_items: int, exact_max_items: int, error_rate: float) -> Deduplicator | None:
+    """
+    Picks the de-duplication stage for a run
+
+    :param mode: the requested mode - AUTO picks exact for runs of up to exact_max_items patents, Bloom past that
+    :param expected_items: number of patents the run expects to fetch (eg total_items of the first page)
+    :return: the deduplicator, or None if de-duplication is off
+    """
+    if mode == DedupMode.OFF:
+        return None
+    if mode == DedupMode.EXACT or (mode == DedupMode.AUTO and expected_items <= exact_max_items):
+        return ExactDeduplicator()
+    return BloomDeduplicator(expected_items, error_rate)
@@ -0,0 +1,141 @@
+﻿import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+
+from patent_fetcher.models.api import PatentLike
+from patent_fetcher.settings import cli_settings
+
+# Rough per patent and per list item overheads of the python objects around the text, in bytes
+PATENT_OVERHEAD_BYTES = 600
+ITEM_OVERHEAD_BYTES = 60
+
+
+def approximate_size(patent: PatentLike) -> int:
+    """
+    Approximate memory a buffered patent takes up - its text plus fixed object overheads, cheap enough to run on every
+    patent rather than measuring it properly
+    """
+    lists = (patent.claims, patent.assignees, patent.inventors)
+    return (
+        PATENT_OVERHEAD_BYTES
+        + len(patent.patent_number) + len(patent.title) + len(patent.abstract) + len(patent.description)
+        + sum(len(item) + ITEM_OVERHEAD_BYTES for items in lists for item in items)
+    )
+
+
+class FlushPolicy(ABC):
+    """
+    Abstract base class deciding when a run's buffer is flushed to the output.
+
+    Told about every page of patents added to the buffer, and reset once the buffer has been handed off. It is only
+    asked as pages arrive, so a page is never split across flushes, and a max age can be overrun by one slow page.
+    """
+
+    @abstractmethod
+    def add(self, patents: list[PatentLike]) -> None:
+        pass
+
+    @abstractmethod
+    def should_flush(self) -> bool:
+        pass
+
+    @abstractmethod
+    def reset(self) -> None:
+        pass
+
+
+class MaxItemsPolicy(FlushPolicy):
+    """
+    Flushes once the buffer holds max_items patents
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.items = 0
+
+    def add(self, patents: list[PatentLike]) -> None:
+        self.items += len(patents)
+
+    def should_flush(self) -> bool:
+        return self.items >= self.max_items
+
+    def reset(self) -> None:
+        self.items = 0
+
+
+class MaxBytesPolicy(FlushPolicy):
+    """
+    Flushes once the buffered patents take up roughly max_bytes (see approximate_size), so a run of pages with long
+    descriptions and claims can't hold much more memory than one of short ones
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def add(self, patents: list[PatentLike]) -> None:
+        self.bytes += sum(approximate_size(patent) for patent in patents)
+
+    def should_flush(self) -> bool:
+        return self.bytes >= self.max_bytes
+
+    def reset(self) -> None:
+        self.bytes = 0
+
+
+class MaxAgePolicy(FlushPolicy):
+    """
+    Flushes once the oldest buffered patent has waited max_age_seconds, so slow trickling runs still reach the output
+    """
+
+    def __init__(self, max_age_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.max_age_seconds = max_age_seconds
+        self.clock = clock
+        self.oldest: float | None = None
+
+    def add(self, patents: list[PatentLike]) -> None:
+        if patents and self.oldest is None:
+            self.oldest = self.clock()
+
+    def should_flush(self) -> bool:
+        return self.oldest is not None and self.clock() - self.oldest >= self.max_age_seconds
+
+    def reset(self) -> None:
+        self.oldest = None
+
+
+class AnyFlushPolicy(FlushPolicy):
+    """
+    Flushes as soon as any of its policies would
+    """
+
+    def __init__(self, policies: list[FlushPolicy]):
+        self.policies = policies
+
+    def add(self, patents: list[PatentLike]) -> None:
+        for policy in self.policies:
+            policy.add(patents)
+
+    def should_flush(self) -> bool:
+        return any(policy.should_flush() for policy in self.policies)
+
+    def reset(self) -> None:
+        for policy in self.policies:
+            policy.reset()
+
+
+def make_flush_policy(max_items: int, max_bytes: int | None = None, max_age_seconds: float | None = None) -> FlushPolicy:
+    """
+    Builds the flush policy of a run - on max_items, and on max_bytes and/or max_age_seconds if given, whichever comes
+    first (eg from BUFFER_SIZE, BUFFER_MAX_BYTES and BUFFER_MAX_AGE_SECONDS)
+    """
+    policies: list[FlushPolicy] = [MaxItemsPolicy(max_items)]
+    if max_bytes:
+        policies.append(MaxBytesPolicy(max_bytes))
+    if max_age_seconds:
+        policies.append(MaxAgePolicy(max_age_seconds))
+    return policies[0] if len(policies) == 1 else AnyFlushPolicy(policies)
+
+
+def flush_policy_from_settings() -> FlushPolicy:
+    return make_flush_policy(cli_settings.buffer_size, cli_settings.buffer_max_bytes, cli_settings.buffer_max_age_seconds)
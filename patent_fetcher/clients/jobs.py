@@ -0,0 +1,176 @@
+﻿import logging
+import queue
+import threading
+from collections.abc import Callable
+from datetime import datetime, timezone
+from typing import Self
+from uuid import uuid4
+
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.clients.process_pool import process_pool
+from patent_fetcher.clients.sharding import ShardedPatentClient
+from patent_fetcher.constants import JobStatus, OUTPUT_CLIENT
+from patent_fetcher.exceptions import JobQueueFullError, PatentFetchError
+from patent_fetcher.models.jobs import FetchJob, JobServerStatus
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class JobRunner:
+    """
+    Runs fetch jobs on a bounded pool of worker threads fed by a bounded job queue, for the serve daemon.
+
+    Every worker holds its own PatentClient for as long as the runner runs (a client runs one fetch at a time), so
+    jobs reuse its warm session, page cache and checkpoint store, and a healthy check for SERVE_HEALTH_CHECK_SECONDS,
+    instead of setting them up per job. Outputs are imported and the process pool (if any) started up front, but each
+    job still opens and closes its own output clients, so its files and transactions are complete once it's finished.
+
+    Jobs are kept (with their responses) until SERVE_MAX_JOBS have finished, dropping the oldest finished ones first.
+    """
+
+    def __init__(
+            self,
+            workers: int | None = None,
+            queue_size: int | None = None,
+            max_jobs: int | None = None,
+            client_factory: Callable[[], PatentClient] | None = None
+    ):
+        """
+        :param workers: jobs run at once, defaults to SERVE_WORKERS
+        :param queue_size: jobs waiting on a worker before submit turns new ones away, defaults to SERVE_QUEUE_SIZE
+        :param max_jobs: finished jobs kept for status queries, defaults to SERVE_MAX_JOBS
+        :param client_factory: creates each worker's client, defaults to one trusting a healthy check for
+                               SERVE_HEALTH_CHECK_SECONDS
+        """
+        self.workers = workers or cli_settings.serve_workers
+        self.max_jobs = max_jobs or cli_settings.serve_max_jobs
+        self.client_factory = client_factory or (lambda: PatentClient(health_check_ttl=cli_settings.serve_health_check_seconds))
+        self._queue: queue.Queue[FetchJob | None] = queue.Queue(maxsize=queue_size or cli_settings.serve_queue_size)
+        self._jobs: dict[str, FetchJob] = {} # in submission order
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def __enter__(self) -> Self:
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def start(self) -> Self:
+        """
+        Warms up and starts the workers - every registered output is imported, and every worker's client runs a
+        health check (which also opens its first pooled connection)
+        """
+        logger.info(f"Loaded outputs {", ".join(output.__name__ for output in OUTPUT_CLIENT.values())}")
+        process_pool()
+        for i in range(self.workers):
+            client = self.client_factory()
+            try:
+                client.ensure_healthy()
+            except Exception as e:
+                # Not fatal, the api may well be back by the time jobs come in - each job checks again
+                logger.warning(f"Worker {i} health check failed on startup - {e}")
+            thread = threading.Thread(target=self._work, args=(client,), name=f"patent-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers")
+        return self
+
+    def stop(self) -> None:
+        """
+        Cancels the jobs still queued, and waits on the running ones to finish before closing the workers' clients
+        """
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                with self._lock:
+                    job.status, job.finished_at = JobStatus.CANCELLED, datetime.now(timezone.utc)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        logger.info("Stopped job workers")
+
+    def submit(self, request: PatentsClientRequest) -> FetchJob:
+        """
+        Queues a fetch job
+
+        :return: a snapshot of the queued job, its id is what get looks it up by
+        :raises JobQueueFullError: if SERVE_QUEUE_SIZE jobs are already waiting on a worker
+        """
+        job = FetchJob(id=uuid4().hex, request=request, submitted_at=datetime.now(timezone.utc))
+        with self._lock:
+            self._jobs[job.id] = job
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                del self._jobs[job.id]
+                raise JobQueueFullError(f"{self._queue.maxsize} jobs are already queued, try again later")
+            logger.info(f"Queued job {job.id}")
+            return job.model_copy()
+
+    def get(self, job_id: str) -> FetchJob | None:
+        """
+        :return: a snapshot of the job, None if there's no such job (or it was dropped past SERVE_MAX_JOBS)
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    def jobs(self) -> list[FetchJob]:
+        """
+        :return: snapshots of every job kept, oldest first
+        """
+        with self._lock:
+            return [job.model_copy() for job in self._jobs.values()]
+
+    def status(self) -> JobServerStatus:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return JobServerStatus(
+            workers=len(self._threads),
+            queued=statuses.count(JobStatus.QUEUED),
+            running=statuses.count(JobStatus.RUNNING),
+            finished=len(statuses) - statuses.count(JobStatus.QUEUED) - statuses.count(JobStatus.RUNNING),
+        )
+
+    def _work(self, client: PatentClient) -> None:
+        with client:
+            while (job := self._queue.get()) is not None:
+                self._run(client, job)
+
+    def _run(self, client: PatentClient, job: FetchJob) -> None:
+        with self._lock:
+            job.status, job.started_at = JobStatus.RUNNING, datetime.now(timezone.utc)
+        logger.info(f"Running job {job.id}")
+        response, error = None, None
+        try:
+            if job.request.sharded:
+                response = ShardedPatentClient().fetch_patents(job.request)
+            else:
+                response = client.fetch_patents(job.request)
+        except PatentFetchError as e:
+            response, error = e.response, str(e)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        with self._lock:
+            job.response, job.error = response, error
+            job.status = JobStatus.FAILED if error else JobStatus.SUCCEEDED
+            job.finished_at = datetime.now(timezone.utc)
+            self._drop_finished()
+        if error:
+            logger.error(f"Job {job.id} failed - {error}")
+        else:
+            logger.info(f"Job {job.id} succeeded, {response.total_items_outputted} patents outputted")
+
+    def _drop_finished(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.max_jobs, 0)]:
+            del self._jobs[job_id]
@@ -0,0 +1,103 @@
+﻿import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Literal
+
+from patent_fetcher.models.metrics import HistogramSnapshot, RunMetrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds, from a fast local response up to a slow sink flush
+DEFAULT_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self, num_buckets: int):
+        self.counts = [0] * num_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class MetricsRecorder:
+    """
+    Thread safe timers and counters of a run, snapshotted into the RunMetrics of its response.
+
+    Timings go into fixed bucket histograms (like Prometheus histograms), so recording stays constant in memory however
+    many pages a run has.
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters: dict[str, float] = {}
+        self._histograms: dict[tuple[str, tuple[tuple[str, str], ...]], _Histogram] = {}
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if (histogram := self._histograms.get(key)) is None:
+                histogram = self._histograms[key] = _Histogram(len(self.bounds) + 1)
+            histogram.counts[bisect_left(self.bounds, seconds)] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+            histogram.max = max(histogram.max, seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """
+        Observes how long the block took, whether or not it raised
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self, items: int = 0) -> RunMetrics:
+        """
+        :param items: patents fetched by the run so far, for its throughput
+        """
+        elapsed = time.monotonic() - self._started
+        with self._lock:
+            return RunMetrics(
+                elapsed_seconds=elapsed,
+                items_per_second=items / elapsed if elapsed else 0.0,
+                counters=dict(self._counters),
+                histograms=[
+                    HistogramSnapshot(
+                        name=name,
+                        labels=dict(labels),
+                        bounds=list(self.bounds),
+                        counts=list(histogram.counts),
+                        count=histogram.count,
+                        sum=histogram.sum,
+                        max=histogram.max,
+                    )
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+            )
+
+
+def write_metrics(metrics: RunMetrics, path: str, metrics_format: Literal["json", "prometheus"] = "json") -> None:
+    """
+    Writes a run's metrics to path, replacing it in one go so a scraper never reads a half written file
+    """
+    body = metrics.to_prometheus() if metrics_format == "prometheus" else metrics.model_dump_json(indent=2)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote run metrics to {path}")
@@ -1,19 +1,94 @@
 ﻿from abc import ABC, abstractmethod
+from typing import Any, ClassVar, Self
 
-from patent_fetcher.models.api import Patent
+from patent_fetcher.models.api import PatentLike
 from patent_fetcher.models.output_client import OutputClientResponse
 
 
 class OutputClient(ABC):
     """
     Abstract base class for other output clients.
+
+    A run drives one instance through open -> write_batch (once per flushed buffer) -> close, or as a context manager,
+    so sinks can hold connections and file handles across flushes. Sinks that only implement output_patents still work
+    as-is, write_batch simply delegates to it.
+
+    A sink whose batches can be undone reports where each one left the output in output_info["position"], which a
+    checkpointed run records with the batch and hands back to recover when resumed. A transactional sink can instead
+    store the run's checkpoint itself (stores_checkpoints), committed along with each batch in write_checkpointed.
     """
+    stores_checkpoints: ClassVar[bool] = False
+
+    def __enter__(self) -> Self:
+        return self.open()
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def open(self) -> Self:
+        """
+        Acquires whatever the sink needs for the run (connections, files, etc)
+        """
+        return self
+
+    def write_batch(self, patents: list[PatentLike]) -> OutputClientResponse:
+        """
+        Writes one flushed buffer of the run, may be called from writer threads.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :return: OutputClientResponse for this batch
+        """
+        return self.output_patents(patents)
+
+    def write_checkpointed(self, patents: list[PatentLike], fingerprint: str, last_page: int) -> OutputClientResponse:
+        """
+        Writes one flushed buffer like write_batch, along with the checkpoint of the run it belongs to - sinks that
+        store checkpoints commit both at once, so the batch is never in the output without its checkpoint.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :param fingerprint: the run the batch belongs to (see CheckpointStore.fingerprint)
+        :param last_page: the last page whose patents are in the output once the batch is
+        :return: OutputClientResponse for this batch
+        """
+        return self.write_batch(patents)
+
+    def checkpointed_page(self, fingerprint: str) -> int | None:
+        """
+        :return: the last page of a run committed by write_checkpointed, if the sink stores checkpoints and has any
+        """
+        return None
+
+    def clear_checkpoint(self, fingerprint: str) -> None:
+        """
+        Forgets a run's stored checkpoint, eg when it is started over from scratch
+        """
+        pass
+
+    def recover(self, position: dict[str, Any]) -> None:
+        """
+        Brings the output back to a position reported by an earlier run's batch, before a resumed run writes anything -
+        whatever was written past it (eg by a batch a crash interrupted) is dropped.
+
+        :param position: output_info["position"] of the last batch the run recorded
+        """
+        pass
+
+    def close(self) -> OutputClientResponse | None:
+        """
+        Releases the sink's resources at the end of the run.
+
+        :return: OutputClientResponse for anything finished on close (eg files completed), if any
+        """
+        return None
+
     @abstractmethod
-    def output_patents(self, patents: list[Patent]) -> OutputClientResponse:
+    def output_patents(self, patents: list[PatentLike]) -> OutputClientResponse:
         """
         Outputs the given list of patents according to the implementation.
 
-        :param patents: List of Patent objects to write out
+        Sinks with a lifecycle implement this as a single self-contained write (open, write one batch, close).
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
         :return: OutputClientResponse containing any relevant output information/metrics
         """
         pass
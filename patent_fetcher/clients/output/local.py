@@ -1,38 +1,86 @@
 ﻿import gzip
 import json
 import logging
-from datetime import datetime
+import os
+import re
+from pathlib import Path
+from typing import Any, ClassVar
 
 from patent_fetcher.clients.output.base_client import OutputClient
-from patent_fetcher.models.api import Patent
+from patent_fetcher.clients.output.ndjson import FileSeries
+from patent_fetcher.clients.process_pool import process_pool
+from patent_fetcher.models.api import PatentLike
 from patent_fetcher.models.output_client import OutputClientResponse
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SERIES_FILE = re.compile(r"_(?P<series>[0-9a-f]{12})_(?P<part>\d+)\.json\.gz(?:\.tmp)?$")
+
 
 class LocalOutputClient(OutputClient):
-    def output_patents(self, patents: list[Patent]) -> OutputClientResponse:
+    POOL_CHUNK_RECORDS: ClassVar[int] = 500 # patents per chunk serialized and compressed in the process pool
+
+    def __init__(self):
+        # Every archive of the run is a numbered part, so its position tells apart the archives written after it
+        self.series = FileSeries()
+
+    def output_patents(self, patents: list[PatentLike]) -> OutputClientResponse:
         """
         Writes out patents to local-disk as a gzip json with an arbitrary file name & location.
 
-        Each gzip contains up to BUFFER number of items
+        Each gzip contains up to BUFFER number of items. With PROCESS_WORKERS set, the json array is serialized and
+        compressed in chunks in the process pool, each chunk a gzip member of the same file
 
-        :param patents: List of Patent objects to write out
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :raises ValueError: if the archive couldn't be written, none of it is left behind
         """
-        fname = f"./patents_{datetime.now().strftime("%y%m%d_%H%M%S")}.json.gz"
+        # Suffixed so that two flushes within the same second don't overwrite each other
+        fname = f"./{self.series.next_name("json.gz")}"
         logger.info(f"Attempting to flush {len(patents)} patents to {fname}")
         try:
-            with gzip.open(fname, "wt", encoding="utf-8") as archive:
-                archive.write(json.dumps([p.model_dump() for p in patents], default=str))
+            # Written under a temporary name and renamed once complete, so a crash never leaves a partial archive
+            if (pool := process_pool()) is not None and patents:
+                chunks = [patents[i:i + self.POOL_CHUNK_RECORDS] for i in range(0, len(patents), self.POOL_CHUNK_RECORDS)]
+                # Only the first chunk opens the array and the last closes it, gzip members simply concatenate
+                prefixes = ["["] + [", "] * (len(chunks) - 1)
+                suffixes = [""] * (len(chunks) - 1) + ["]"]
+                with open(f"{fname}.tmp", "wb") as archive:
+                    for member in pool.map(json_array_member, chunks, prefixes, suffixes):
+                        archive.write(member)
+            else:
+                with gzip.open(f"{fname}.tmp", "wt", encoding="utf-8") as archive:
+                    archive.write(json.dumps([p.model_dump() for p in patents], default=str))
+            os.replace(f"{fname}.tmp", fname)
             logger.info(f"Successfully dumped {len(patents)} patents to {fname}")
         except Exception as e:
-            # Does not halt execution on output failure - could be just this page/batch
-            logger.error(f"Failed to dump {len(patents)} patents to {fname} - {e}")
+            # Raised rather than logged, so the flush fails and a checkpoint never moves past the lost batch
+            if os.path.exists(f"{fname}.tmp"):
+                os.remove(f"{fname}.tmp")
+            raise ValueError(f"Failed to dump {len(patents)} patents to {fname} - {e}")
 
         return OutputClientResponse(
             num_items_outputted=len(patents),
             output_info={
                 "output_file": fname,
+                "position": {"series": self.series.id, "next_part": int(SERIES_FILE.search(fname)["part"]) + 1},
             }
-        )
\ No newline at end of file
+        )
+
+    def recover(self, position: dict[str, Any]) -> None:
+        """
+        Removes the archives an earlier run wrote after the position of its last recorded batch
+        """
+        removed = []
+        for path in sorted(Path(".").glob(f"patents_*_{position["series"]}_*.json.gz*")):
+            if (match := SERIES_FILE.search(path.name)) and int(match["part"]) >= position["next_part"]:
+                path.unlink()
+                removed.append(str(path))
+        logger.info(f"Removed {removed} written past the last checkpointed batch")
+
+def json_array_member(patents: list[PatentLike], prefix: str, suffix: str) -> bytes:
+    """
+    Serializes patents as a slice of a json array (between prefix and suffix) compressed as one gzip member, in a
+    process pool worker
+    """
+    return gzip.compress(f"{prefix}{json.dumps([p.model_dump() for p in patents], default=str)[1:-1]}{suffix}".encode("utf-8"))
@@ -0,0 +1,315 @@
+﻿import gzip
+import io
+import logging
+import os
+import re
+import threading
+from collections.abc import Iterator
+from concurrent.futures import Executor
+from contextlib import suppress
+from datetime import datetime
+from itertools import repeat
+from pathlib import Path
+from typing import Any, BinaryIO, ClassVar, Self
+from uuid import uuid4
+
+from patent_fetcher.clients.output.base_client import OutputClient
+from patent_fetcher.clients.process_pool import process_pool
+from patent_fetcher.models.api import Patent, PatentLike
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.settings import cli_settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SERIES_FILE = re.compile(r"_(?P<series>[0-9a-f]{12})_(?P<part>\d+)\.ndjson\.gz(?:\.tmp)?$")
+
+
+class FileSeries:
+    """
+    Names the files of one output client's run - numbered parts under an id of their own, so a position (see
+    NdjsonOutputClient) tells apart every file opened after it
+    """
+
+    def __init__(self):
+        self.id = uuid4().hex[:12]
+        self.next_part = 0
+        self._lock = threading.Lock()
+
+    def next_name(self, extension: str = "ndjson.gz") -> str:
+        with self._lock:
+            part = self.next_part
+            self.next_part += 1
+        return f"patents_{datetime.now().strftime("%y%m%d_%H%M%S")}_{self.id}_{part:06d}.{extension}"
+
+
+class NdjsonOutputClient(OutputClient):
+    """
+    Streams patents to gzipped newline-delimited json files under OUTPUT_DIR, one patent per line.
+
+    Each patent is serialized and compressed as it is written, so a flush never holds more than one line on top of the
+    buffer itself, and files can be read back a line at a time with read_patents. A file is rolled over to a new one
+    once it reaches OUTPUT_MAX_FILE_BYTES (compressed) or OUTPUT_MAX_FILE_RECORDS, and every file gets a unique name,
+    so flushes landing in the same second never overwrite each other.
+
+    Over a run, the current file stays open across batches and is only renamed from .tmp once rolled or closed. Every
+    batch ends its own gzip member and is synced to disk though, and reports where it left the output in
+    output_info["position"]. As the files of a run are numbered parts of one series, the output can be cut back to any
+    such position (see rollback) - which is how a failed batch is dropped, files it rolled over to included, and how
+    recover brings the output back to its last checkpointed batch after a crash.
+
+    With PROCESS_WORKERS set, a batch is instead split into chunks serialized and compressed in the process pool, each
+    its own gzip member, and written in order. Files then roll between chunks - still never past
+    OUTPUT_MAX_FILE_RECORDS, but up to a chunk past OUTPUT_MAX_FILE_BYTES.
+    """
+    POOL_CHUNK_RECORDS: ClassVar[int] = 500 # patents per chunk compressed in the process pool
+
+    def __init__(self, output_dir: str | Path | None = None, series: FileSeries | None = None):
+        """
+        :param output_dir: directory to write files to, defaults to OUTPUT_DIR
+        :param series: names the files, a new series by default
+        """
+        self.output_dir = Path(output_dir or cli_settings.output_dir)
+        self.series = series or FileSeries()
+        self.max_file_bytes = cli_settings.output_max_file_bytes
+        self.max_file_records = cli_settings.output_max_file_records
+        self.compression_level = cli_settings.output_compression_level
+        self.files: dict[str, int] = {}  # every completed file, with its record count
+        self._lock = threading.Lock()
+        self._fname: Path | None = None
+        self._raw: BinaryIO | None = None
+        self._archive: io.BufferedWriter | None = None
+        self._file_records = 0
+
+    def output_patents(self, patents: list[PatentLike]) -> OutputClientResponse:
+        """
+        Writes out patents to their own file(s), closed before returning.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :return: An OutputClientResponse listing every file written to
+        """
+        files_before = len(self.files)
+        with self:
+            response = self.write_batch(patents)
+        response.output_info["output_files"] = list(self.files)[files_before:]
+        return response
+
+    def write_batch(self, patents: list[PatentLike]) -> OutputClientResponse:
+        """
+        Writes out patents to the current file, rolling over to new files as they fill up.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :return: An OutputClientResponse listing the files completed by this batch, and the position it left the
+                 output at
+        :raises: ValueError if writing fails, whatever the batch wrote is discarded
+        """
+        logger.info(f"Attempting to stream {len(patents)} patents to {self.output_dir}")
+        with self._lock:
+            files_before = len(self.files)
+            batch_start = self._position()
+            try:
+                if (pool := process_pool()) is not None:
+                    self._write_chunks(pool, patents)
+                else:
+                    self._write_lines(patents)
+                self._sync()
+            except Exception as e:
+                self._discard_batch(batch_start)
+                raise ValueError(f"Failed to write {len(patents)} patents out to {self.output_dir} - {e}")
+            written = list(self.files)[files_before:]
+            position = self._position()
+
+        logger.info(f"Successfully streamed {len(patents)} patents to {self._fname or written}")
+        return OutputClientResponse(
+            num_items_outputted=len(patents),
+            output_info={
+                "output_files": written,
+                "position": position,
+            }
+        )
+
+    def recover(self, position: dict[str, Any]) -> None:
+        """
+        Cuts the files of an earlier run back to a position it reported, completing the files it left open
+        """
+        with self._lock:
+            completed, removed = rollback(self.output_dir, position)
+            self.files.update(completed)
+        logger.info(f"Recovered {list(completed)} and removed {removed} written past the last checkpointed batch")
+
+    def discard(self, position: dict[str, Any]) -> None:
+        """
+        Drops whatever was written after a position of this run, eg by a batch that failed elsewhere
+        """
+        with self._lock:
+            self._discard_batch(position)
+
+    def close(self) -> OutputClientResponse:
+        """
+        Completes the current file
+
+        :return: An OutputClientResponse listing every file written over the run
+        """
+        with self._lock:
+            self._close_file()
+            return OutputClientResponse(output_info={"output_files": list(self.files)})
+
+    def _write_lines(self, patents: list[PatentLike]) -> None:
+        for patent in patents:
+            if self._archive is None:
+                self._start_member()
+            self._archive.write(patent.model_dump_json().encode("utf-8") + b"\n")
+            self._file_records += 1
+            if self._should_roll():
+                self._close_file()
+        self._end_member()
+
+    def _sync(self) -> None:
+        # Every batch is on disk before it's reported written, so its position still holds after a crash
+        if self._raw is not None:
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+
+    def _position(self) -> dict[str, Any]:
+        """
+        Where the output stands between batches - the files opened so far, and how far into the current one
+        """
+        return {"series": self.series.id, "next_part": self.series.next_part, "open": self._open_files()}
+
+    def _open_files(self) -> dict[str, list[int]]:
+        if self._raw is None:
+            return {}
+        return {str(self._fname.absolute()): [self._raw.tell(), self._file_records]}
+
+    def _write_chunks(self, pool: Executor, patents: list[PatentLike]) -> None:
+        chunks = self._chunks(patents)
+        # map hands back the compressed chunks in order, while the later ones are still being compressed
+        for chunk, member in zip(chunks, pool.map(ndjson_member, chunks, repeat(self.compression_level))):
+            if self.max_file_records and self._file_records + len(chunk) > self.max_file_records:
+                self._close_file()
+            if self._raw is None:
+                self._open_file()
+            self._raw.write(member)
+            self._file_records += len(chunk)
+            if self._should_roll():
+                self._close_file()
+        if self._raw is not None:
+            self._raw.flush()
+
+    def _chunks(self, patents: list[PatentLike]) -> list[list[PatentLike]]:
+        """
+        Splits a batch into chunks of up to POOL_CHUNK_RECORDS, cut where the files roll by OUTPUT_MAX_FILE_RECORDS
+        """
+        chunks, start = [], 0
+        room = self.max_file_records - self._file_records if self.max_file_records else None
+        while start < len(patents):
+            size = min(self.POOL_CHUNK_RECORDS, room) if room else self.POOL_CHUNK_RECORDS
+            chunks.append(patents[start:start + size])
+            start += size
+            if room:
+                room = room - size or self.max_file_records
+        return chunks
+
+    def _should_roll(self) -> bool:
+        if self.max_file_records and self._file_records >= self.max_file_records:
+            return True
+        # Only counts what the compressor has emitted so far, so files run a little over rather than under
+        return bool(self.max_file_bytes) and self._raw.tell() >= self.max_file_bytes
+
+    def _open_file(self) -> None:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._fname = self.output_dir / self.series.next_name()
+        # Written under a temporary name and renamed once complete, so a crash never leaves a partial archive
+        self._raw = open(f"{self._fname}.tmp", "wb")
+        self._file_records = 0
+
+    def _start_member(self) -> None:
+        if self._raw is None:
+            self._open_file()
+        gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=self.compression_level)
+        self._archive = io.BufferedWriter(gz, buffer_size=1024 * 1024)
+
+    def _end_member(self) -> None:
+        # Finishes the gzip member but leaves the raw file open, a gzip file can hold any number of members
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+            self._raw.flush()
+
+    def _close_file(self) -> None:
+        self._end_member()
+        if self._raw is None:
+            return
+        self._sync()
+        self._raw.close()
+        os.replace(f"{self._fname}.tmp", self._fname)
+        logger.info(f"Rolled {self._fname} after {self._file_records} patents")
+        self.files[str(self._fname)] = self._file_records
+        self._raw, self._fname = None, None
+
+    def _discard_batch(self, position: dict[str, Any]) -> None:
+        """
+        Drops whatever a failed batch wrote by cutting the output back to where the batch started - files it rolled
+        over to are removed, and the file it started in is completed as it was before the batch
+        """
+        if self._archive is not None:
+            with suppress(Exception):
+                self._archive.close()
+            self._archive = None
+        if self._raw is not None:
+            with suppress(Exception):
+                self._raw.close()
+        self._raw, self._fname, self._file_records = None, None, 0
+        completed, removed = rollback(self.output_dir, position)
+        for file in removed:
+            self.files.pop(file, None)
+        self.files.update(completed)
+
+
+def rollback(output_dir: str | Path, position: dict[str, Any]) -> tuple[dict[str, int], list[str]]:
+    """
+    Cuts the files of a series under output_dir back to a position - files opened after it are removed, and the files
+    it had open are truncated back to it (on a gzip member boundary, as every batch ends its own) and completed.
+
+    :return: the files completed with their record counts, and the files removed
+    """
+    completed, removed = {}, []
+    for path in sorted(Path(output_dir).rglob(f"patents_*_{position["series"]}_*.ndjson.gz*")):
+        if not (match := SERIES_FILE.search(path.name)) or match["series"] != position["series"]:
+            continue
+        fname = path.with_name(path.name.removesuffix(".tmp"))
+        if (size_records := position["open"].get(str(fname.absolute()))) is not None:
+            size, records = size_records
+            with open(path, "r+b") as f:
+                f.truncate(size)
+                os.fsync(f.fileno())
+            os.replace(path, fname)
+            completed[str(fname)] = records
+        elif int(match["part"]) >= position["next_part"]:
+            path.unlink()
+            removed.append(str(fname))
+    return completed, removed
+
+
+def ndjson_member(patents: list[PatentLike], compression_level: int) -> bytes:
+    """
+    Serializes patents to json lines compressed as one gzip member, in a process pool worker
+    """
+    return gzip.compress(
+        b"".join(patent.model_dump_json().encode("utf-8") + b"\n" for patent in patents),
+        compresslevel=compression_level
+    )
+
+
+def read_patents(*paths: str | Path) -> Iterator[Patent]:
+    """
+    Streams patents back out of files written by the NdjsonOutputClient, one line at a time
+
+    :param paths: files to read, in order
+    :return: iterator of Patent objects
+    """
+    for path in paths:
+        with gzip.open(path, "rb") as archive:
+            for line in archive:
+                if line.strip():
+                    yield Patent.model_validate_json(line)
@@ -0,0 +1,253 @@
+﻿import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, ClassVar
+
+from patent_fetcher.clients.output.base_client import OutputClient
+from patent_fetcher.clients.output.ndjson import FileSeries, NdjsonOutputClient, read_patents, rollback
+from patent_fetcher.models.api import Patent, PatentLike
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.settings import cli_settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_NAME = "_manifest.json"
+
+
+def partition_path(grant_date: date, partition_by: str) -> str:
+    """
+    Hive style partition directory for a grant date, eg year=2024/month=01 or year=2024/month=01/day=15
+    """
+    path = f"year={grant_date.year:04d}/month={grant_date.month:02d}"
+    return f"{path}/day={grant_date.day:02d}" if partition_by == "day" else path
+
+
+class PartitionedOutputClient(OutputClient):
+    """
+    Routes patents by grant_date into Hive style partition directories under OUTPUT_DIR (by month, or by day with
+    OUTPUT_PARTITION_BY=day), each written as rolling ndjson files like the NdjsonOutputClient.
+
+    A manifest (_manifest.json, ignored by Hive style readers for its leading underscore) lists every partition with
+    its files and record counts, so downstream jobs can prune to the dates they need without listing directories.
+    Files are only added to it once completed (rolled over, evicted, or on close), and only once the whole batch
+    that completed them was written.
+
+    Every partition's files are parts of one series, so a batch is all or nothing across partitions - if any partition
+    fails, every partition is cut back to where the batch started (see ndjson.rollback). The position reported in
+    output_info["position"] covers every partition too, for recover to bring the whole output back to it.
+
+    Over a run, only the MAX_OPEN_PARTITIONS most recently written partitions keep their file open across batches - the
+    least recently written one is completed once more are touched, so a long backfill by day doesn't run out of file
+    descriptors. A partition written again after that simply starts a new file.
+    """
+    MAX_OPEN_PARTITIONS: ClassVar[int] = 32
+
+    # Every instance writing to an output directory shares its manifest, it's rewritten under this lock
+    _manifest_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, output_dir: str | Path | None = None):
+        """
+        :param output_dir: root directory of the partitions, defaults to OUTPUT_DIR
+        """
+        self.output_dir = Path(output_dir or cli_settings.output_dir)
+        self.partition_by = cli_settings.output_partition_by
+        self._writers: dict[str, NdjsonOutputClient] = {}
+        self._open: OrderedDict[str, None] = OrderedDict() # partitions that may hold an open file, least recent first
+        self._series = FileSeries()
+        self._lock = threading.Lock()
+
+    def output_patents(self, patents: list[PatentLike]) -> OutputClientResponse:
+        """
+        Writes out patents to their own partition files, closed before returning.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :return: An OutputClientResponse with the files written per partition
+        """
+        files_before = {partition: len(writer.files) for partition, writer in self._writers.items()}
+        with self:
+            response = self.write_batch(patents)
+        response.output_info["partitions"] = {
+            partition: list(writer.files)[files_before.get(partition, 0):]
+            for partition, writer in self._writers.items()
+            if len(writer.files) > files_before.get(partition, 0)
+        }
+        return response
+
+    def write_batch(self, patents: list[PatentLike]) -> OutputClientResponse:
+        """
+        Writes out each patent to the partition of its grant date, then records any completed files in the manifest.
+
+        :param patents: List of Patent (or compact PatentRecord) objects to write out
+        :return: An OutputClientResponse with the files completed per partition by this batch, and the position it
+                 left the output at
+        :raises: ValueError if writing a partition fails, whatever the batch wrote to any partition is discarded
+        """
+        partitions: dict[str, list[PatentLike]] = {}
+        for patent in patents:
+            partitions.setdefault(partition_path(patent.grant_date, self.partition_by), []).append(patent)
+        logger.info(f"Attempting to flush {len(patents)} patents across {len(partitions)} partitions of {self.output_dir}")
+
+        written: dict[str, dict[str, int]] = {}
+        with self._lock:
+            batch_start = self._position()
+            files_before = {partition: dict(writer.files) for partition, writer in self._writers.items()}
+            try:
+                for partition, partition_patents in partitions.items():
+                    written.setdefault(partition, {})
+                    writer = self._writers.setdefault(
+                        partition, NdjsonOutputClient(self.output_dir / partition, series=self._series)
+                    )
+                    files = writer.write_batch(partition_patents).output_info["output_files"]
+                    written[partition].update({file: writer.files[file] for file in files})
+                    self._open[partition] = None
+                    self._open.move_to_end(partition)
+                    # Evicted as the batch goes, a single batch can span more partitions than are kept open
+                    if len(self._open) > self.MAX_OPEN_PARTITIONS:
+                        evicted, _ = self._open.popitem(last=False)
+                        written.setdefault(evicted, {}).update(self._close_writer(evicted))
+            except Exception as e:
+                # Files completed by the cut are what earlier batches wrote, so those still go in the manifest
+                completed = {}
+                for partition in written:
+                    writer = self._writers[partition]
+                    writer.discard(batch_start)
+                    self._open.pop(partition, None)
+                    completed[partition] = {
+                        file: records for file, records in writer.files.items()
+                        if files_before.get(partition, {}).get(file) != records
+                    }
+                self._update_manifest(completed)
+                raise ValueError(f"Failed to write {len(patents)} patents out to {self.output_dir} - {e}")
+            self._update_manifest(written)
+            position = self._position()
+
+        return OutputClientResponse(
+            num_items_outputted=len(patents),
+            output_info={
+                "output_dir": str(self.output_dir),
+                "partitions": {partition: list(files) for partition, files in written.items() if files},
+                "position": position,
+            }
+        )
+
+    def recover(self, position: dict[str, Any]) -> None:
+        """
+        Cuts the partitions of an earlier run back to a position it reported, completing the files it left open, and
+        brings the manifest in line with them
+        """
+        with self._lock:
+            completed, removed = rollback(self.output_dir, position)
+            written: dict[str, dict[str, int]] = {}
+            for file, records in completed.items():
+                written.setdefault(self._partition_of(file), {})[file] = records
+            self._update_manifest(written, removed)
+        logger.info(f"Recovered {list(completed)} and removed {removed} written past the last checkpointed batch")
+
+    def close(self) -> OutputClientResponse:
+        """
+        Completes every partition's current file and records them in the manifest
+
+        :return: An OutputClientResponse with every file written per partition over the run
+        """
+        with self._lock:
+            written = {partition: self._close_writer(partition) for partition in self._open}
+            self._open.clear()
+            self._update_manifest(written)
+            return OutputClientResponse(
+                output_info={
+                    "output_dir": str(self.output_dir),
+                    "partitions": {partition: list(writer.files) for partition, writer in self._writers.items()},
+                }
+            )
+
+    def _position(self) -> dict[str, Any]:
+        """
+        Where the output stands between batches - the files opened so far, and how far into each partition's open one
+        """
+        open_files = {}
+        for partition in self._open:
+            open_files.update(self._writers[partition]._open_files())
+        return {"series": self._series.id, "next_part": self._series.next_part, "open": open_files}
+
+    def _partition_of(self, file: str) -> str:
+        return Path(file).parent.relative_to(self.output_dir).as_posix()
+
+    def _close_writer(self, partition: str) -> dict[str, int]:
+        """
+        Completes a partition's current file, if any
+
+        :return: the file completed, with its record count
+        """
+        writer = self._writers[partition]
+        already = set(writer.files)
+        writer.close()
+        return {file: records for file, records in writer.files.items() if file not in already}
+
+    def _update_manifest(self, written: dict[str, dict[str, int]], removed: list[str] | None = None) -> None:
+        if not any(written.values()) and not removed:
+            return
+        with self._manifest_lock:
+            manifest = read_manifest(self.output_dir)
+            for file in removed or []:
+                if (entry := manifest["partitions"].get(partition := self._partition_of(file))) is not None:
+                    entry["files"].pop(Path(file).relative_to(self.output_dir).as_posix(), None)
+                    entry["records"] = sum(entry["files"].values())
+                    if not entry["files"]:
+                        del manifest["partitions"][partition]
+            for partition, files in written.items():
+                if not files:
+                    continue
+                entry = manifest["partitions"].setdefault(partition, {"records": 0, "files": {}})
+                for file, records in files.items():
+                    entry["files"][Path(file).relative_to(self.output_dir).as_posix()] = records
+                entry["records"] = sum(entry["files"].values())
+            manifest["records"] = sum(entry["records"] for entry in manifest["partitions"].values())
+            manifest["partition_by"] = self.partition_by
+
+            # Same write-then-rename as the data files, so readers never see a half written manifest
+            path = self.output_dir / MANIFEST_NAME
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(f"{path}.tmp", path)
+
+
+def read_manifest(output_dir: str | Path) -> dict[str, Any]:
+    """
+    Loads the partition manifest of an output directory, or an empty one if nothing has been written yet
+    """
+    path = Path(output_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {"records": 0, "partitions": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_partitions(output_dir: str | Path, grant_from_date: date | None = None, grant_to_date: date | None = None) -> Iterator[Patent]:
+    """
+    Streams patents back out of a partitioned output, only opening files of partitions that overlap the date range
+
+    :param output_dir: root directory of the partitions
+    :param grant_from_date: earliest grant date, inclusive
+    :param grant_to_date: latest grant date, exclusive like the api
+    :return: iterator of Patent objects within the date range
+    """
+    manifest = read_manifest(output_dir)
+    for partition, entry in sorted(manifest["partitions"].items()):
+        keys = {key: int(value) for key, value in (part.split("=") for part in partition.split("/"))}
+        start = date(keys["year"], keys["month"], keys.get("day", 1))
+        if "day" in keys:
+            end = start + timedelta(days=1)
+        else:
+            end = date(start.year + 1, 1, 1) if start.month == 12 else date(start.year, start.month + 1, 1)
+        if (grant_to_date and start >= grant_to_date) or (grant_from_date and end <= grant_from_date):
+            continue
+        for patent in read_patents(*(Path(output_dir) / file for file in entry["files"])):
+            # Month partitions can straddle the range boundaries
+            if (not grant_from_date or patent.grant_date >= grant_from_date) and (not grant_to_date or patent.grant_date < grant_to_date):
+                yield patent
@@ -0,0 +1,101 @@
+﻿import logging
+import threading
+from collections.abc import Iterator, Mapping
+from enum import Enum
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from importlib.metadata import EntryPoint
+
+    from patent_fetcher.clients.output.base_client import OutputClient
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ENTRY_POINT_GROUP = "patent_fetcher.outputs"
+
+# Shipped outputs, also declared as entry points in pyproject.toml, so they resolve when running from a checkout that
+# was never installed
+BUILTIN_OUTPUTS = {
+    "local": "patent_fetcher.clients.output.local:LocalOutputClient",
+    "sqlite": "patent_fetcher.clients.output.sqlite:SQLiteOutputClient",
+    "ndjson": "patent_fetcher.clients.output.ndjson:NdjsonOutputClient",
+    "partitioned": "patent_fetcher.clients.output.partitioned:PartitionedOutputClient",
+}
+
+
+class OutputRegistry(Mapping[str | Enum, type["OutputClient"]]):
+    """
+    Output name (eg --output sqlite) to output client class, resolved lazily.
+
+    Outputs are the built-ins plus any installed package declaring an entry point in the patent_fetcher.outputs group,
+    eg in its pyproject.toml:
+
+        [project.entry-points."patent_fetcher.outputs"]
+        s3 = "my_package.outputs:S3OutputClient"
+
+    Entry points are only scanned the first time names are needed, and an output's module is only imported the first
+    time its class is, so listing or picking one output doesn't pay for importing all of them.
+    A built-in name can't be taken over by a plugin.
+    """
+
+    def __init__(self, builtins: Mapping[str, str] = BUILTIN_OUTPUTS, group: str = ENTRY_POINT_GROUP):
+        self.builtins = dict(builtins)
+        self.group = group
+        self._entry_points: dict[str, "EntryPoint"] | None = None
+        self._loaded: dict[str, type["OutputClient"]] = {}
+        self._lock = threading.Lock()
+
+    def _discover(self) -> dict[str, "EntryPoint"]:
+        if self._entry_points is not None:
+            return self._entry_points
+        from importlib.metadata import EntryPoint, entry_points
+
+        found = {name: EntryPoint(name=name, value=value, group=self.group) for name, value in self.builtins.items()}
+        for entry_point in entry_points(group=self.group):
+            known = found.get(entry_point.name)
+            if known is None:
+                found[entry_point.name] = entry_point
+            elif known.value != entry_point.value:
+                logger.warning(f"Ignoring output {entry_point.name} = {entry_point.value}, already registered as {known.value}")
+        self._entry_points = found
+        return found
+
+    @staticmethod
+    def _name(key: str | Enum) -> str:
+        return (key.value if isinstance(key, Enum) else key).lower()
+
+    def __getitem__(self, key: str | Enum) -> type["OutputClient"]:
+        """
+        :param key: output name, or an Output
+        :raises KeyError: if no output is registered under the name
+        """
+        name = self._name(key)
+        if (client := self._loaded.get(name)) is not None:
+            return client
+        entry_point = self._discover()[name]
+        with self._lock:
+            if name not in self._loaded:
+                self._loaded[name] = entry_point.load()
+            return self._loaded[name]
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str | Enum) and self._name(key) in self._discover()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._discover())
+
+    def __len__(self) -> int:
+        return len(self._discover())
+
+    def names(self) -> list[str]:
+        return list(self._discover())
+
+    def by_class_name(self, class_name: str) -> type["OutputClient"] | None:
+        """
+        Finds a registered output client by its class name (as serialized with requests), loading outputs until found
+        """
+        for name in self._discover():
+            if (client := self[name]).__name__ == class_name:
+                return client
+        return None
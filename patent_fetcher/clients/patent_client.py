@@ -1,15 +1,46 @@
-﻿import logging
+﻿import json
+import logging
+import random
 import sys
-from typing import ClassVar
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext, suppress
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from itertools import islice
+from typing import Any, ClassVar, Self
 from urllib.parse import urljoin
 
 import requests
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 
+from patent_fetcher.clients.cache import PageCache
+from patent_fetcher.clients.checkpoint import Checkpoint, CheckpointStore
+from patent_fetcher.clients.dedup import Deduplicator, make_deduplicator
+from patent_fetcher.clients.flush_policy import FlushPolicy, flush_policy_from_settings
+from patent_fetcher.clients.metrics import MetricsRecorder
 from patent_fetcher.clients.output.base_client import OutputClient
-from patent_fetcher.models.api import HealthApiResponse, PatentsApiRequest, PatentsApiResponse, Patent
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.clients.pipeline import FanOutPipeline, FlushPipeline
+from patent_fetcher.clients.process_pool import process_pool
+from patent_fetcher.clients.rate_limit import AdaptiveRateLimiter
+from patent_fetcher.constants import CacheMode
+from patent_fetcher.exceptions import ApiError, NonRetryableApiError, PatentFetchError, RetryableApiError
+from patent_fetcher.models.api import (
+    HealthApiResponse,
+    PatentsApiRequest,
+    PatentsApiRequestPage,
+    PatentsApiResponse,
+    PatentLike,
+    decode_patents_page
+)
 from patent_fetcher.models.output_client import OutputClientResponse
-from patent_fetcher.models.patent_client import PatentsClientRequest, PatentsClientResponse
+from patent_fetcher.models.patent_client import FailedPage, PatentsClientRequest, PatentsClientResponse
 from patent_fetcher.settings import cli_settings
 
 logger = logging.getLogger(__name__)
@@ -18,33 +49,202 @@ logger.setLevel(logging.INFO)
 class PatentClient:
     HEALTH_PATH: ClassVar[str] = "/health"
     PATENTS_PATH: ClassVar[str] = "/patents"
+    THROTTLE_STATUSES: ClassVar[frozenset[int]] = frozenset({429, 503})
+    RETRYABLE_STATUSES: ClassVar[frozenset[int]] = frozenset({408, 429})  # on top of every 5xx
 
-    @staticmethod
-    def _request(method: str, endpoint: str, payload: str | None = None) -> dict | list:
+    def __init__(
+            self,
+            pool_size: int | None = None,
+            keep_alive: bool | None = None,
+            cache: PageCache | None = None,
+            rate_limiter: AdaptiveRateLimiter | None = None,
+            flush_policy: Callable[[], FlushPolicy] | None = None,
+            health_check_ttl: float | None = None
+    ):
+        """
+        The client holds a single long-lived HTTP session, so every request in a run (health check included) reuses
+        warm pooled connections instead of setting up a new TCP/TLS connection per page.
+        The session is created on first use, and should be closed with close() or by using the client as a context manager.
+
+        :param pool_size: max number of pooled connections kept open, defaults to HTTP_POOL_SIZE
+        :param keep_alive: whether connections are kept alive between requests, defaults to HTTP_KEEP_ALIVE
+        :param cache: page cache to use, defaults to one at CACHE_DB (if set) opened on first use
+        :param rate_limiter: throttles every request of the client, defaults to one capped at RATE_LIMIT_RPS, with a
+                             window of up to pool_size requests in flight (narrowed to each run's concurrency)
+        :param flush_policy: creates the flush policy of each run, defaults to one built from the BUFFER_* settings
+        :param health_check_ttl: seconds a healthy check is trusted for by the following runs (eg of a long-lived
+                                 client serving many small jobs), None to check before every run
+        """
+        self.pool_size = pool_size or cli_settings.http_pool_size
+        self.keep_alive = cli_settings.http_keep_alive if keep_alive is None else keep_alive
+        self._session: requests.Session | None = None
+        self._session_lock = threading.Lock()
+        self._cache = cache
+        self._checkpoints: CheckpointStore | None = None
+        self.cache_mode = CacheMode.USE
+        self.cache_hits, self.cache_misses = 0, 0
+        self.metrics = MetricsRecorder()
+        self.flush_policy_factory = flush_policy or flush_policy_from_settings
+        self.health_check_ttl = health_check_ttl
+        self._healthy_at: float | None = None
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(
+            max_window=self.pool_size,
+            max_rate=cli_settings.rate_limit_rps,
+            burst=cli_settings.rate_limit_burst,
+            latency_spike_factor=cli_settings.latency_spike_factor,
+        )
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the underlying session and all of its pooled connections
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+            if self._checkpoints is not None:
+                self._checkpoints.close()
+                self._checkpoints = None
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Lazily creates the shared session with the default headers cached on it
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    @property
+    def cache(self) -> PageCache | None:
+        """
+        Lazily opens the page cache configured in the settings, None if caching is disabled
+        """
+        with self._session_lock:
+            if self._cache is None and cli_settings.cache_db:
+                self._cache = PageCache(cli_settings.cache_db, cli_settings.cache_ttl_seconds, cli_settings.cache_max_bytes)
+            return self._cache
+
+    @property
+    def checkpoints(self) -> CheckpointStore | None:
+        """
+        Lazily opens the checkpoint store configured in the settings, None if checkpointing is disabled
+        """
+        with self._session_lock:
+            if self._checkpoints is None and cli_settings.state_db:
+                self._checkpoints = CheckpointStore(cli_settings.state_db)
+            return self._checkpoints
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({
+            "Authorization": f"Bearer {cli_settings.api_token.get_secret_value()}",
+            "Content-Type": "application/json",
+        })
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        logger.info(f"Created HTTP session (pool_size={self.pool_size}, keep_alive={self.keep_alive})")
+        return session
+
+    def _request(self, method: str, endpoint: str, payload: str | None = None) -> dict | list:
         """
         Makes an HTTP request against the given endpoint using the given method and an optional payload.
 
         :param method: HTTP method (GET/POST/etc)
         :param endpoint: endpoint to be appended to base url
         :param payload: optional json payload
-        :return: the json response as a string
-        :raises: HTTPError if anything goes wrong
+        :return: the decoded json response
+        :raises: ApiError (an HTTPError) if anything goes wrong
+        """
+        raw_response = self._request_raw(method, endpoint, payload)
+        try:
+            return json.loads(raw_response)
+        except Exception as e:
+            logger.error(f"Invalid json response from {method} on {endpoint} with payload {payload} - {e}")
+            raise NonRetryableApiError(e)
+
+    def _request_raw(self, method: str, endpoint: str, payload: str | None = None) -> bytes:
+        """
+        Makes an HTTP request against the given endpoint, without decoding the response body.
+
+        Every request waits on the rate limiter first. A throttled response (429/503) is retried up to THROTTLE_RETRIES
+        times, after its Retry-After (or an exponential backoff without one), with the rate limiter backing off.
+
+        :return: the raw response body
+        :raises: RetryableApiError for transient failures, NonRetryableApiError for anything else (both HTTPErrors)
         """
         full_url = urljoin(str(cli_settings.api_url), endpoint)
-        headers = {
-            "Authorization": f"Bearer {cli_settings.api_token.get_secret_value()}",
-            "Content-Type": "application/json",
-        }
         try:
-            logger.info(f"Attempting to send request to {full_url} with payload={payload}")
-            response = requests.request(method, url=full_url, headers=headers, data=payload)
-            response.raise_for_status()
-            return response.json()
+            for attempt in range(cli_settings.throttle_retries + 1):
+                logger.info(f"Attempting to send request to {full_url} with payload={payload}")
+                with self.rate_limiter.slot():
+                    started = time.monotonic()
+                    response = self.session.request(method, url=full_url, data=payload, timeout=cli_settings.http_timeout)
+                    latency = time.monotonic() - started
+                self.metrics.observe("request_seconds", latency)
+                self.metrics.count("requests")
+                if response.status_code in self.THROTTLE_STATUSES:
+                    self.rate_limiter.on_throttled(self._retry_after(response, attempt))
+                    if attempt < cli_settings.throttle_retries:
+                        continue
+                response.raise_for_status()
+                self.rate_limiter.on_success(latency)
+                self.metrics.count("bytes_received", len(response.content))
+                return response.content
         except Exception as e:
-            # Conscious decision here to just catch-and-reraise a generic HTTPError,
-            # in production, better retry/error handling should happen for specific cases (eg failure notification)
             logger.error(f"Exception when trying to {method} on {endpoint} with payload {payload} - {e}")
-            raise HTTPError(e)
+            raise self._api_error(e)
+
+    @classmethod
+    def _api_error(cls, e: Exception) -> ApiError:
+        """
+        Classifies a failed request as retryable or not - pages are only retried (see _fetch_patent_page_retrying)
+        on a retryable error
+        """
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return RetryableApiError(e)
+        if isinstance(e, HTTPError) and e.response is not None:
+            status_code = e.response.status_code
+            error_cls = RetryableApiError if status_code in cls.RETRYABLE_STATUSES or status_code >= 500 else NonRetryableApiError
+            return error_cls(e, status_code=status_code)
+        return NonRetryableApiError(e)
+
+    @staticmethod
+    def _retry_after(response: requests.Response, attempt: int) -> float:
+        """
+        Seconds to wait before retrying a throttled response - its Retry-After (in seconds or as a date) if it has one,
+        otherwise an exponential backoff on the attempt number
+        """
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            with suppress(ValueError, TypeError):
+                return max(0.0, float(retry_after))
+            with suppress(ValueError, TypeError):
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        return cli_settings.throttle_backoff_seconds * 2 ** attempt
+
+    def _throttle_stats(self) -> dict:
+        """
+        What the rate limiter has settled on, for the run response
+        """
+        return {
+            "throttled_requests": self.rate_limiter.throttled,
+            "request_rate": self.rate_limiter.rate,
+            "concurrency_window": self.rate_limiter.window,
+        }
 
     def check_health(self) -> HealthApiResponse:
         """
@@ -58,34 +258,133 @@ class PatentClient:
         logger.info(f"Health check success - service={health_response.service} status={health_response.status}")
         return health_response
 
-    def fetch_patents(self, request: PatentsClientRequest) -> PatentsClientResponse:
+    def ensure_healthy(self) -> None:
         """
-        Attempts to fetch patents from upstream using the configs defined in the environment
+        Checks the api is healthy before a run, unless it was found healthy within the last health_check_ttl seconds
 
-        :return: PatentsClientResponse
-        :raises: ValueError if anything goes wrong
+        :raises: ValueError if the api reports itself unhealthy
         """
-        logger.info(f"Beginning patent fetch with payload {request.model_dump_json()}")
+        if self.health_check_ttl and self._healthy_at is not None and time.monotonic() - self._healthy_at < self.health_check_ttl:
+            return
         health_status = self.check_health()
         if health_status.status != "healthy":
             raise ValueError(f"Health check failed with status {health_status}")
+        self._healthy_at = time.monotonic()
 
-        cur_page = request.start_page
-        buffer, output_info = [], []
-        num_patents_fetched, num_pages_fetched = 0, 0
-        payload = request.api_request
+    def fetch_patents(
+            self,
+            request: PatentsClientRequest,
+            first_response: PatentsApiResponse | None = None
+    ) -> PatentsClientResponse:
+        """
+        Attempts to fetch patents from upstream using the configs defined in the environment
+
+        The buffer is flushed whenever the flush policy says so (on BUFFER_SIZE items, and optionally an approximate byte
+        budget or the age of the oldest buffered patent), on request.flush_workers background threads (or inline if 0),
+        overlapping with fetching.
+        One instance of each output client is opened for the whole run, written to once per flush and closed at the
+        end, with whatever it reports on close (eg completed files) added to the output info.
+        With several output clients, every flush is written to all of them concurrently (see FanOutPipeline), and a
+        sink that fails is reported in sink_errors while the run carries on with the others. Resuming such a run
+        refills the failed sink, leaving out the batches the others already hold.
+        Pages failing with a retryable error are retried with backoff, and set aside as failed pages (see
+        fetch_failed_pages) once out of retries, so one flaky page doesn't cost the rest of the run.
+        Patents repeated across pages are dropped before reaching the buffer (see request.dedup), as are patents
+        already in the SQLite output with request.skip_existing.
+
+        :param first_response: the request's first page if already fetched (eg a shard's probe), so it isn't fetched
+                               again - ignored when resuming past it
+        :return: PatentsClientResponse
+        :raises: ValueError if anything goes wrong - a PatentFetchError carrying the partial response and errors
+                 from both the fetch and the output side once fetching has started, or once every sink has failed
+        """
+        logger.info(f"Beginning patent fetch with payload {request.model_dump_json()}")
+        self.metrics = MetricsRecorder()
+        self.ensure_healthy()
+
+        if request.concurrency > self.pool_size:
+            logger.warning(f"Concurrency {request.concurrency} exceeds the connection pool size {self.pool_size}, "
+                           f"connections past the pool size will not be reused")
+
+        self.cache_mode = request.cache_mode
+        self.cache_hits, self.cache_misses = 0, 0
+        self.rate_limiter.resize(request.concurrency)
+        self.rate_limiter.throttled = 0
+
+        checkpoints = self.checkpoints
+        fingerprint = CheckpointStore.fingerprint(request)
+        first_page = request.start_page
+        sink_pages: dict[str, int] = {}
+        positions: dict[str, dict] = {}
+        if checkpoints and request.resume and (checkpoint := checkpoints.get(fingerprint)):
+            sink_pages = checkpoints.sink_pages(fingerprint)
+            # Outputs storing the checkpoint with their batches are authoritative, they can be ahead of STATE_DB
+            for sink, page in self._stored_sink_pages(request, fingerprint).items():
+                sink_pages[sink] = max(sink_pages.get(sink, 0), page)
+            # Outputs record their pages as they write, so a crash can leave all of them ahead of the run's checkpoint
+            sinks_last_page = min((sink_pages.get(client.__name__, 0) for client in request.output_clients), default=0)
+            last_page = max(checkpoint.last_page, sinks_last_page)
+            if last_page >= checkpoint.final_page:
+                logger.info(f"Nothing to resume, run already completed up to page {checkpoint.final_page}")
+                return PatentsClientResponse()
+            first_page = last_page + 1
+            logger.info(f"Resuming from page {first_page}, pages up to {last_page} were already flushed")
+            positions = checkpoints.sink_positions(fingerprint)
+            # Outputs that carried on past the run's checkpoint (while another failed) leave out what they already hold
+            sink_pages = {sink: page for sink, page in sink_pages.items() if page >= first_page}
+            for sink, page in sink_pages.items():
+                logger.info(f"Resuming {sink} from page {page + 1}, it already holds the pages before")
+        elif checkpoints:
+            checkpoints.clear(fingerprint)
+            self._stored_sink_pages(request, fingerprint, clear=True)
+
+        cur_page, final_page = first_page, first_page
+        buffer, failed_pages = [], []
+        num_patents_fetched, num_pages_fetched, duplicates_dropped = 0, 0, 0
+        total_items = 0
+        latest_grant_date = None
+        payload = self._page_payload(request.api_request, first_page)
+        flush_policy = self.flush_policy_factory()
+        output_clients = self._open_output_clients(request, positions)
+        pipeline = self._flush_pipeline(
+            request,
+            output_clients,
+            on_flushed=lambda checkpoint: self._save_checkpoint(request, fingerprint, checkpoint),
+            written=lambda sink, checkpoint: sink in sink_pages and sink_pages[sink] >= checkpoint.last_page,
+            fingerprint=fingerprint if checkpoints else None,
+            on_sink_written=(
+                lambda sink, checkpoint, response: checkpoints.save_sink(
+                    fingerprint, sink, checkpoint.last_page, response.output_info.get("position")
+                )
+            ) if checkpoints else None
+        )
         try:
             # First request fetches metadata
-            logger.info(f"Fetching initial page {cur_page}")
-            first_response = self._fetch_patent_page(payload)
+            if first_response is None or first_page != request.start_page:
+                logger.info(f"Fetching initial page {cur_page}")
+                first_response = self._fetch_patent_page_retrying(payload)
             total_pages = first_response.pagination.total_pages
             total_items = first_response.pagination.total_items
 
             if total_pages == 0 or total_items == 0:
                 logger.info(f"No patents found for {payload.model_dump_json()}")
-                return PatentsClientResponse()
+                pipeline.close()
+                sink_errors = {}
+                self._close_output_clients(output_clients, sink_errors, self.metrics)
+                return PatentsClientResponse(cache_hits=self.cache_hits, cache_misses=self.cache_misses, sink_errors=sink_errors,
+                                             metrics=self.metrics.snapshot(), **self._throttle_stats())
 
-            buffer.extend(first_response.patents)
+            deduplicator = make_deduplicator(
+                request.dedup, total_items, cli_settings.dedup_exact_max_items, cli_settings.dedup_error_rate
+            )
+            existing_client = next(
+                (client for client in output_clients.values() if isinstance(client, SQLiteOutputClient)), None
+            ) if request.skip_existing else None
+            patents = self._drop_duplicates(first_response.patents, deduplicator, existing_client)
+            duplicates_dropped += len(first_response.patents) - len(patents)
+            buffer.extend(patents)
+            flush_policy.add(patents)
+            latest_grant_date = self._latest_grant_date(first_response.patents, latest_grant_date)
             num_patents_fetched += len(first_response.patents)
             logger.info(f"Successfully fetched initial page {cur_page} (total_pages={total_pages}, total_items={total_items})")
             logger.info(f"Successfully fetched a total of {len(first_response.patents)} patents from page {cur_page}")
@@ -93,68 +392,599 @@ class PatentClient:
             num_pages_fetched += 1
             cur_page += 1
 
-            while (not request.num_pages and cur_page <= total_pages) or (request.num_pages is not None and num_pages_fetched < request.num_pages):
-                logger.info(f"Attempting to fetch page {cur_page}")
-                payload.pagination.page = cur_page
-                patents_resp = self._fetch_patent_page(payload)
-                buffer.extend(patents_resp.patents)
+            pages = self._remaining_pages(request, total_pages, first_page)
+            final_page = max(pages.stop - 1, first_page)
+            # Batches end where a resumed output's pages do, so each batch is either entirely in it or not at all
+            resume_boundaries = set(sink_pages.values())
+            if buffer and first_page in resume_boundaries:
+                pipeline.submit(buffer, Checkpoint(first_page, final_page))
+                buffer = []
+                flush_policy.reset()
+            for page, patents_resp in self._iter_patent_pages(payload, pages, request.concurrency):
+                if isinstance(patents_resp, FailedPage):
+                    # Recorded before the checkpoint can move past the page, so it's never lost
+                    failed_pages.append(patents_resp)
+                    if checkpoints:
+                        checkpoints.add_failed_page(fingerprint, patents_resp, request)
+                else:
+                    patents = self._drop_duplicates(patents_resp.patents, deduplicator, existing_client)
+                    duplicates_dropped += len(patents_resp.patents) - len(patents)
+                    buffer.extend(patents)
+                    flush_policy.add(patents)
+                    latest_grant_date = self._latest_grant_date(patents_resp.patents, latest_grant_date)
 
-                num_patents_fetched += len(patents_resp.patents)
-                num_pages_fetched += 1
+                    num_patents_fetched += len(patents_resp.patents)
+                    num_pages_fetched += 1
 
-                logger.info(f"Successfully fetched a total of {len(patents_resp.patents)} patents from page {cur_page}")
-                if len(buffer) >= cli_settings.buffer_size:
-                    output_info.append(self._flush_patent_buffer(request.output_client, buffer))
-                    buffer.clear()
+                    logger.info(f"Successfully fetched a total of {len(patents_resp.patents)} patents from page {page}")
+                if flush_policy.should_flush() or (buffer and page in resume_boundaries):
+                    # The pipeline owns the submitted buffer from here on, so carry on into a fresh one
+                    pipeline.submit(buffer, Checkpoint(page, final_page))
+                    buffer = []
+                    flush_policy.reset()
 
-                cur_page += 1
+                cur_page = page + 1
 
             # Flush after final iteration
-            output_info.append(self._flush_patent_buffer(request.output_client, buffer))
-            return PatentsClientResponse(
+            pipeline.submit(buffer, Checkpoint(final_page, final_page))
+            buffer = []
+            output_info = pipeline.close()
+            if pipeline.failed:
+                raise pipeline.errors[0]
+        except Exception as e:
+            # On fetch failure, attempt to flush remaining buffer and reraise the exception
+            # The buffer holds every page before the failed one, so the checkpoint can move up to it for --resume
+            logger.error(f"Exception occurred when attempting to fetch page {cur_page} with payload {payload.model_dump_json()} - {e}")
+            errors = [str(e)]
+            if buffer and not pipeline.failed:
+                try:
+                    pipeline.submit(buffer, Checkpoint(cur_page - 1, final_page) if cur_page > first_page else None)
+                except Exception as flush_error:
+                    errors.append(str(flush_error))
+            output_info = pipeline.close()
+            errors.extend(str(error) for error in pipeline.errors if str(error) not in errors)
+            # Still closed on failure, so everything written before it is completed (eg files renamed into place)
+            sink_errors = self._sink_errors(pipeline)
+            output_info.extend(self._close_output_clients(output_clients, sink_errors, self.metrics))
+            errors.extend(error for sink in sink_errors.values() for error in sink if error not in errors)
+            raise PatentFetchError(e, response=PatentsClientResponse(
                 total_items_found=total_items,
                 total_items_fetched=num_patents_fetched,
                 total_pages_fetched=num_pages_fetched,
-                total_items_outputted=sum(output.num_items_outputted for output in output_info),
-                output_info=output_info
+                total_items_outputted=PatentsClientResponse.items_outputted(output_info, output_clients),
+                output_info=output_info,
+                cache_hits=self.cache_hits,
+                cache_misses=self.cache_misses,
+                errors=errors,
+                sink_errors=sink_errors,
+                failed_pages=failed_pages,
+                duplicates_dropped=duplicates_dropped,
+                latest_grant_date=latest_grant_date,
+                metrics=self.metrics.snapshot(num_patents_fetched),
+                **self._throttle_stats()
+            ))
+
+        sink_errors = self._sink_errors(pipeline)
+        output_info.extend(self._close_output_clients(output_clients, sink_errors, self.metrics))
+        logger.info(f"Finished fetching {num_pages_fetched} pages, {self.rate_limiter.throttled} requests throttled, "
+                    f"settled on {self.rate_limiter.describe()}")
+        if failed_pages:
+            logger.warning(f"Pages {[p.page for p in failed_pages]} failed every retry, "
+                           f"re-fetch them with fetch_failed_pages once the api has recovered")
+        response = PatentsClientResponse(
+            total_items_found=total_items,
+            total_items_fetched=num_patents_fetched,
+            total_pages_fetched=num_pages_fetched,
+            total_items_outputted=PatentsClientResponse.items_outputted(output_info, output_clients),
+            output_info=output_info,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            errors=[error for sink in sink_errors.values() for error in sink],
+            sink_errors=sink_errors,
+            failed_pages=failed_pages,
+            duplicates_dropped=duplicates_dropped,
+            latest_grant_date=latest_grant_date,
+            metrics=self.metrics.snapshot(num_patents_fetched),
+            **self._throttle_stats()
+        )
+        if output_clients and len(sink_errors) == len(output_clients):
+            raise PatentFetchError(response.errors[0], response=response)
+        return response
+
+    def sync_patents(
+            self,
+            output_client: type[OutputClient] | list[type[OutputClient]],
+            since: date | None = None,
+            overlap_days: int | None = None,
+            page_size: int | None = None,
+            **request_options
+    ) -> PatentsClientResponse:
+        """
+        Incrementally fetches the patents granted since the outputs were last synced, up to today.
+
+        Every sink has a sync mark in STATE_DB - the latest grant date it has fully ingested. A sync starts overlap_days
+        before the earliest mark of its sinks, so patents the api publishes late for an already synced date are still
+        picked up. A sink's mark only moves once a sync has written to it without any failed pages.
+
+        :param output_client: the outputs to sync, each with its own mark
+        :param since: grant date to start from for outputs that have never been synced
+        :param overlap_days: days re-fetched before the mark, defaults to SYNC_OVERLAP_DAYS
+        :param request_options: any other PatentsClientRequest options, eg concurrency
+        :return: PatentsClientResponse of the fetch, empty if already up to date
+        :raises: ValueError if STATE_DB is disabled, or an output has never been synced and no since is given
+        """
+        checkpoints = self.checkpoints
+        if not checkpoints:
+            raise ValueError("Sync marks are kept in STATE_DB, which is disabled")
+        output_clients = output_client if isinstance(output_client, list) else [output_client]
+        overlap = timedelta(days=cli_settings.sync_overlap_days if overlap_days is None else overlap_days)
+
+        start_dates = []
+        for sink in (client.__name__ for client in output_clients):
+            if mark := checkpoints.sync_mark(sink):
+                start_dates.append(mark - overlap)
+            elif since:
+                start_dates.append(since)
+            else:
+                raise ValueError(f"{sink} has never been synced, a date to sync it from is needed")
+        grant_from_date, grant_to_date = min(start_dates), date.today()
+        if grant_from_date >= grant_to_date:
+            logger.info(f"Nothing to sync, outputs are synced up to {grant_to_date}")
+            return PatentsClientResponse()
+
+        logger.info(f"Syncing patents granted from {grant_from_date} to {grant_to_date}")
+        response = self.fetch_patents(PatentsClientRequest(
+            api_request=PatentsApiRequest(
+                grant_from_date=grant_from_date,
+                grant_to_date=grant_to_date,
+                pagination=PatentsApiRequestPage(page_size=page_size)
+            ),
+            output_client=output_clients,
+            **request_options
+        ))
+        if response.failed_pages:
+            logger.warning("Sync marks not moved as pages failed, re-fetch them with fetch_failed_pages and sync again")
+        elif response.latest_grant_date:
+            for sink in (client.__name__ for client in output_clients):
+                if sink not in response.sink_errors:
+                    checkpoints.save_sync_mark(sink, response.latest_grant_date)
+        return response
+
+    @staticmethod
+    def _open_output_clients(
+            request: PatentsClientRequest,
+            positions: dict[str, dict] | None = None
+    ) -> dict[str, OutputClient]:
+        """
+        Opens one instance of each requested output client for the run, keyed on its name.
+
+        Nothing has been fetched yet at this point, so a sink that cannot even be opened fails the run straight away
+        rather than leaving it short of a sink.
+
+        :param positions: where each output of a resumed run was left by its last recorded batch, it's recovered to it
+                          (see OutputClient.recover) before anything is written
+        """
+        output_clients = {}
+        try:
+            for output_client_cls in request.output_clients:
+                sink = output_client_cls.__name__
+                output_clients[sink] = output_client_cls().open()
+                if positions and sink in positions:
+                    output_clients[sink].recover(positions[sink])
+        except Exception:
+            PatentClient._close_output_clients(output_clients, {})
+            raise
+        return output_clients
+
+    @staticmethod
+    def _stored_sink_pages(request: PatentsClientRequest, fingerprint: str, clear: bool = False) -> dict[str, int]:
+        """
+        Reads (or with clear, forgets) the checkpoint of a run stored by each requested output that stores checkpoints
+        itself (see OutputClient.stores_checkpoints), on an instance of its own
+
+        :return: the last page of the run each of those outputs committed, for the outputs that have committed any
+        """
+        pages = {}
+        for output_client_cls in request.output_clients:
+            if not output_client_cls.stores_checkpoints:
+                continue
+            with output_client_cls() as output_client:
+                if clear:
+                    output_client.clear_checkpoint(fingerprint)
+                elif (page := output_client.checkpointed_page(fingerprint)) is not None:
+                    pages[output_client_cls.__name__] = page
+        return pages
+
+    @staticmethod
+    def _close_output_clients(
+            output_clients: dict[str, OutputClient],
+            sink_errors: dict[str, list[str]],
+            metrics: MetricsRecorder | None = None
+    ) -> list[OutputClientResponse]:
+        """
+        Closes every output client, recording any that fail to close in sink_errors
+
+        :param metrics: records how long each output client took to close (eg finishing its files), if given
+        :return: the responses the output clients returned on close
+        """
+        closed = []
+        for sink, output_client in output_clients.items():
+            try:
+                with metrics.timer("close_seconds", sink=sink) if metrics else nullcontext():
+                    response = output_client.close()
+                if response:
+                    response.sink = sink
+                    closed.append(response)
+            except Exception as e:
+                logger.error(f"Failed to close output {sink} - {e}")
+                sink_errors.setdefault(sink, []).append(str(e))
+        return closed
+
+    @staticmethod
+    def _sink_errors(pipeline: FlushPipeline | FanOutPipeline) -> dict[str, list[str]]:
+        # A lone sink fails the whole run instead, so only a fan out has errors per sink
+        if isinstance(pipeline, FanOutPipeline):
+            return {sink: [str(error) for error in errors] for sink, errors in pipeline.sink_errors.items()}
+        return {}
+
+    def _flush_pipeline(
+            self,
+            request: PatentsClientRequest,
+            output_clients: dict[str, OutputClient],
+            on_flushed: Callable[[Any], None],
+            written: Callable[[str, Any], bool] | None = None,
+            fingerprint: str | None = None,
+            on_sink_written: Callable[[str, Any, OutputClientResponse], None] | None = None
+    ) -> FlushPipeline | FanOutPipeline:
+        """
+        Builds the pipeline flushed buffers are written through, fanning out when there is more than one sink (see
+        FanOutPipeline for written, which only applies then). on_sink_written is called with the sink, marker and
+        response of every batch a sink has written, right after writing it and before any later batch is.
+
+        With the fingerprint of a checkpointed run, whose markers are Checkpoints, sinks that store checkpoints commit
+        each marker along with its batch (see OutputClient.write_checkpointed).
+
+        While a checkpoint is kept, the writers of a sink write its batches in submission order - otherwise a batch could
+        be written after an earlier one failed, and --resume (or fetch_failed_pages) would then write it again.
+        """
+        workers = request.flush_workers
+        ordered = self.checkpoints is not None
+        flushes = {
+            sink: partial(self._flush_sink, sink, output_client, fingerprint, on_sink_written)
+            for sink, output_client in output_clients.items()
+        }
+        if len(output_clients) > 1:
+            return FanOutPipeline(
+                flushes=flushes,
+                on_flushed=on_flushed,
+                workers=workers,
+                queue_size=cli_settings.flush_queue_size,
+                written=written,
+                with_markers=True,
+                ordered=ordered,
             )
+        return FlushPipeline(
+            flush=next(iter(flushes.values()), partial(self._flush_sink, None, None, None, None)),
+            on_flushed=on_flushed,
+            workers=workers,
+            queue_size=cli_settings.flush_queue_size,
+            with_markers=True,
+            ordered=ordered,
+        )
+
+    def _flush_sink(
+            self,
+            sink: str | None,
+            output_client: OutputClient | None,
+            fingerprint: str | None,
+            on_written: Callable[[str, Any, OutputClientResponse], None] | None,
+            patents: list[PatentLike],
+            marker: Any
+    ) -> OutputClientResponse | None:
+        """
+        _timed_flush to one sink, handing the response to on_written once the batch is written
+        """
+        checkpoint = None
+        if fingerprint and marker is not None and output_client is not None and output_client.stores_checkpoints:
+            checkpoint = (fingerprint, marker.last_page)
+        response = self._timed_flush(output_client, patents, checkpoint)
+        if on_written and marker is not None:
+            on_written(sink, marker, response)
+        return response
+
+    def fetch_failed_pages(self) -> PatentsClientResponse:
+        """
+        Re-fetches only the failed pages recorded by earlier runs (see fetch_patents), writing them to the output of
+        the run they belong to. Pages that make it to the output are dropped from the failed pages, pages that fail
+        again are kept for next time.
+
+        :return: the merged PatentsClientResponse of every run's failed pages, failed_pages holding those still failing
+        :raises: ValueError if checkpointing (STATE_DB), which keeps the failed pages, is disabled
+        """
+        checkpoints = self.checkpoints
+        if not checkpoints:
+            raise ValueError("Failed pages are kept in STATE_DB, which is disabled")
+        failed = checkpoints.failed_pages()
+        if not failed:
+            logger.info("No failed pages to re-fetch")
+            return PatentsClientResponse()
+
+        self.metrics = MetricsRecorder()
+        self.ensure_healthy()
+        self.rate_limiter.throttled = 0
+        responses = [self._refetch_pages(fingerprint, request, pages) for fingerprint, (request, pages) in failed.items()]
+        response = PatentsClientResponse.merge(responses)
+        response.throttled_requests = self.rate_limiter.throttled
+        response.metrics = self.metrics.snapshot(response.total_items_fetched)
+        return response
+
+    def _refetch_pages(self, fingerprint: str, request: PatentsClientRequest, pages: list[int]) -> PatentsClientResponse:
+        """
+        Re-fetches the given failed pages of one run, each written out as its own batch
+        """
+        logger.info(f"Re-fetching failed pages {pages} of run {fingerprint[:12]}")
+        self.cache_mode = request.cache_mode
+        self.cache_hits, self.cache_misses = 0, 0
+        checkpoints = self.checkpoints
+        still_failed, errors, output_info = [], [], []
+        num_patents_fetched, num_pages_fetched = 0, 0
+        output_clients = self._open_output_clients(request)
+        pipeline = self._flush_pipeline(
+            request, output_clients, on_flushed=lambda page: checkpoints.remove_failed_page(fingerprint, page)
+        )
+        try:
+            for page in pages:
+                payload = self._page_payload(request.api_request, page)
+                try:
+                    patents_resp = self._fetch_page_or_failed(payload)
+                except ApiError as e:
+                    # Already failed once, so just keep it with the new error rather than stopping the others
+                    patents_resp = FailedPage(
+                        page=page,
+                        grant_from_date=payload.grant_from_date,
+                        grant_to_date=payload.grant_to_date,
+                        error=str(e)
+                    )
+                if isinstance(patents_resp, FailedPage):
+                    still_failed.append(patents_resp)
+                    checkpoints.add_failed_page(fingerprint, patents_resp, request)
+                    continue
+                num_patents_fetched += len(patents_resp.patents)
+                num_pages_fetched += 1
+                pipeline.submit(list(patents_resp.patents), page)
         except Exception as e:
-            # On fetch failure, attempt to flush remaining buffer and reraise the exception
-            logger.error(f"Exception occurred when attempting to fetch page {cur_page} with payload {payload.model_dump_json()} - {e}")
-            if buffer:
-                self._flush_patent_buffer(request.output_client, buffer)
-            raise ValueError(e)
+            logger.error(f"Failed to write re-fetched pages of run {fingerprint[:12]} - {e}")
+            errors.append(str(e))
+        finally:
+            output_info.extend(pipeline.close())
+        errors.extend(str(error) for error in pipeline.errors if str(error) not in errors)
+        sink_errors = self._sink_errors(pipeline)
+        output_info.extend(self._close_output_clients(output_clients, sink_errors, self.metrics))
+        return PatentsClientResponse(
+            total_items_fetched=num_patents_fetched,
+            total_pages_fetched=num_pages_fetched,
+            total_items_outputted=PatentsClientResponse.items_outputted(output_info, output_clients),
+            output_info=output_info,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            errors=errors,
+            sink_errors=sink_errors,
+            failed_pages=still_failed
+        )
+
+    @staticmethod
+    def _latest_grant_date(patents: list[PatentLike], latest: date | None) -> date | None:
+        page_latest = max((patent.grant_date for patent in patents), default=None)
+        return max(latest, page_latest) if latest and page_latest else latest or page_latest
+
+    @staticmethod
+    def _drop_duplicates(
+            patents: list[PatentLike],
+            deduplicator: Deduplicator | None,
+            existing_client: SQLiteOutputClient | None
+    ) -> list[PatentLike]:
+        """
+        Drops the patents of a page already seen in the run, and (with an existing_client) those already stored in it
+
+        :return: the patents left to buffer, in order
+        """
+        kept = deduplicator.filter(patents) if deduplicator else list(patents)
+        if existing_client and kept:
+            existing = existing_client.existing_patent_numbers([patent.patent_number for patent in kept])
+            kept = [patent for patent in kept if patent.patent_number not in existing]
+        if dropped := len(patents) - len(kept):
+            logger.info(f"Dropped {dropped} duplicate patents")
+        return kept
+
+    def _save_checkpoint(self, request: PatentsClientRequest, fingerprint: str, checkpoint: Checkpoint) -> None:
+        """
+        Records progress after a successful flush - only ever called once the output client has returned
+        """
+        if self.checkpoints:
+            self.checkpoints.save(fingerprint, checkpoint, request)
+
+    @staticmethod
+    def _remaining_pages(request: PatentsClientRequest, total_pages: int, first_page: int | None = None) -> range:
+        """
+        Works out which pages are left to fetch after the initial page.
+
+        Fetches up to the last page if num_pages is omitted, otherwise num_pages in total counted from start_page.
+        Either way, pages past the total reported by the api are never requested.
+
+        :param first_page: the page fetched first, if not start_page (eg when resuming)
+        """
+        last_page = total_pages
+        if request.num_pages:
+            last_page = min(total_pages, request.start_page + request.num_pages - 1)
+        return range((first_page or request.start_page) + 1, last_page + 1)
+
+    def _iter_patent_pages(
+            self,
+            payload: PatentsApiRequest,
+            pages: Iterable[int],
+            concurrency: int = 1
+    ) -> Iterator[tuple[int, PatentsApiResponse | FailedPage]]:
+        """
+        Fetches the given pages (with retries) and yields them back in page order, or a FailedPage for a page that
+        failed every retry.
+
+        With a concurrency above 1, pages are fetched by a bounded thread pool. At most `concurrency` pages are ever
+        in flight or waiting to be consumed, so a slow consumer (eg a buffer flush) also throttles the fetching.
+
+        :param payload: the base api request, each page gets its own copy
+        :param pages: the page numbers to fetch, in order
+        :param concurrency: max number of pages to fetch at once
+        :return: iterator of (page number, page response or FailedPage)
+        """
+        pages = iter(pages)
+        if concurrency <= 1:
+            for page in pages:
+                logger.info(f"Attempting to fetch page {page}")
+                yield page, self._fetch_page_or_failed(self._page_payload(payload, page))
+            return
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="patent-fetch")
+        in_flight: deque[tuple[int, Future]] = deque()
+
+        def _submit(page: int) -> None:
+            logger.info(f"Attempting to fetch page {page}")
+            in_flight.append((page, executor.submit(self._fetch_page_or_failed, self._page_payload(payload, page))))
+
+        try:
+            for page in islice(pages, concurrency):
+                _submit(page)
+            while in_flight:
+                page, future = in_flight.popleft()
+                response = future.result()
+                if (next_page := next(pages, None)) is not None:
+                    _submit(next_page)
+                yield page, response
+        finally:
+            # Don't leave pages being fetched in the background on failure
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _page_payload(payload: PatentsApiRequest, page: int) -> PatentsApiRequest:
+        """
+        Copies the given api request for a specific page, so pages can be fetched independently of each other
+        """
+        return payload.model_copy(update={"pagination": payload.pagination.model_copy(update={"page": page})})
+
+    def _fetch_page_or_failed(self, payload: PatentsApiRequest) -> PatentsApiResponse | FailedPage:
+        """
+        Fetches a single page with retries, returning a FailedPage instead of raising once it's out of retries.
+        Non-retryable errors are still raised, retrying the page later wouldn't fix them either.
+        """
+        try:
+            return self._fetch_patent_page_retrying(payload)
+        except RetryableApiError as e:
+            return FailedPage(
+                page=payload.pagination.page,
+                grant_from_date=payload.grant_from_date,
+                grant_to_date=payload.grant_to_date,
+                error=str(e)
+            )
+
+    def _fetch_patent_page_retrying(self, payload: PatentsApiRequest) -> PatentsApiResponse:
+        """
+        Fetches a single page, retrying up to PAGE_RETRIES times on a retryable error with a jittered exponential
+        backoff, so concurrent pages failing together don't all retry at once.
+
+        :raises: the last RetryableApiError once out of retries, any other error straight away
+        """
+        retries = cli_settings.page_retries
+        for attempt in range(retries + 1):
+            try:
+                return self._fetch_patent_page(payload)
+            except RetryableApiError as e:
+                if attempt == retries:
+                    raise
+                backoff = min(cli_settings.page_retry_max_backoff_seconds, cli_settings.page_retry_backoff_seconds * 2 ** attempt)
+                delay = random.uniform(0, backoff)
+                logger.warning(f"Page {payload.pagination.page} failed ({e}), retry {attempt + 1}/{retries} in {delay:.2f}s")
+                time.sleep(delay)
 
     def _fetch_patent_page(self, payload: PatentsApiRequest) -> PatentsApiResponse:
         """
-        Fetches a single page of patents
+        Fetches a single page of patents, served from the page cache where possible (depending on cache_mode).
+
+        The raw response body is validated directly (see decode_patents_page) rather than decoded to a dict first.
         :return: the raw response from the api as a PatentsApiResponse object
         """
-        patents_response = self._request(
+        cache = self.cache if self.cache_mode != CacheMode.BYPASS and PageCache.cacheable(payload) else None
+        key = PageCache.key(payload) if cache else None
+        if cache and self.cache_mode == CacheMode.USE and (cached := cache.get(key)) is not None:
+            with self._session_lock:
+                self.cache_hits += 1
+            logger.info(f"Page cache hit for page {payload.pagination.page}")
+            return self._decode_page(cached)
+
+        raw_response = self._request_raw(
             method="POST",
             endpoint=self.PATENTS_PATH,
             payload=payload.model_dump_json(),
         )
-        return PatentsApiResponse.model_validate(patents_response)
+        validated = self._decode_page(raw_response)
+        if cache:
+            # Only cache pages that validated, so a bad response is never replayed
+            with self._session_lock:
+                self.cache_misses += 1
+            cache.put(key, raw_response.decode("utf-8"))
+        return validated
+
+    def _decode_page(self, raw: bytes | str) -> PatentsApiResponse:
+        """
+        Validates a raw page, in the process pool if PROCESS_WORKERS is set. This (fetch) thread waits on the result, so
+        pages still come back in order, and up to `concurrency` pages are validated at once
+        """
+        strict, compact = cli_settings.strict_decoding, cli_settings.compact_records
+        with self.metrics.timer("decode_seconds"):
+            if (pool := process_pool()) is not None:
+                return pool.submit(decode_patents_page, raw, strict, compact).result()
+            return decode_patents_page(raw, strict=strict, compact=compact)
+
+    def _timed_flush(
+            self,
+            output_client: OutputClient | None,
+            patents: list[PatentLike],
+            checkpoint: tuple[str, int] | None = None
+    ) -> OutputClientResponse | None:
+        """
+        _flush_patent_buffer, timed per sink
+        """
+        with self.metrics.timer("flush_seconds", sink=type(output_client).__name__ if output_client else "none"):
+            if checkpoint:
+                return self._flush_patent_buffer(output_client, patents, checkpoint)
+            return self._flush_patent_buffer(output_client, patents)
 
     @staticmethod
-    def _flush_patent_buffer(output_client_cls: type[OutputClient] | None, patents: list[Patent]) -> OutputClientResponse | None:
+    def _flush_patent_buffer(
+            output_client: OutputClient | None,
+            patents: list[PatentLike],
+            checkpoint: tuple[str, int] | None = None
+    ) -> OutputClientResponse | None:
         """
-        Attempts to dump the given buffer of patents either to local disk or to a database
+        Attempts to dump the given buffer of patents either to local disk or to a database, as one batch of the
+        output client's run
+
+        :param checkpoint: fingerprint and last page of the run, committed with the batch (see write_checkpointed)
 
         :raises: ValueError if the clients fails to flush the buffer for any reason
         """
-        if not patents:
-            logger.info(f"No patents to flush")
-            return OutputClientResponse()
-
-        if not output_client_cls:
+        if not output_client:
             logger.info(f"No output client provided, skipping flush of {len(patents)} items")
             return OutputClientResponse(num_items_outputted=len(patents))
 
-        logger.info(f"Attempting to flush {len(patents)} patents using {output_client_cls.__name__}")
-        output_client = output_client_cls()
-        client_response = output_client.output_patents(patents)
+        if not patents:
+            logger.info(f"No patents to flush")
+            return OutputClientResponse(sink=type(output_client).__name__)
+
+        logger.info(f"Attempting to flush {len(patents)} patents using {type(output_client).__name__}")
+        if checkpoint:
+            client_response = output_client.write_checkpointed(patents, *checkpoint)
+        else:
+            client_response = output_client.write_batch(patents)
+        client_response.sink = type(output_client).__name__
         logger.info(f"Successfully flushed {client_response.num_items_outputted} patents "
-                    f"using {output_client_cls.__name__} - {client_response}")
+                    f"using {type(output_client).__name__} - {client_response}")
         return client_response
\ No newline at end of file
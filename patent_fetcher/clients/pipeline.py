@@ -0,0 +1,261 @@
+﻿import logging
+import queue
+import threading
+from collections.abc import Callable
+from functools import partial
+from typing import Any
+
+from patent_fetcher.models.api import PatentLike
+from patent_fetcher.models.output_client import OutputClientResponse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_STOP = object()
+
+
+class FlushPipeline:
+    """
+    Hands flushed buffers from the fetch loop over to writer threads, so fetching and writing overlap instead of
+    alternating.
+
+    The queue between the two is bounded, so a slow output applies backpressure to the fetcher and memory stays capped
+    at roughly (queue_size + workers + 1) buffers. With workers=0 every batch is written inline on submit, which is
+    the plain sequential behaviour.
+
+    Each batch carries an opaque marker (eg a checkpoint) which is passed to on_flushed once that batch, and every batch
+    submitted before it, has been written - so markers are always acknowledged in submission order, even when several
+    writers finish out of order. With with_markers, flush is handed the batch's marker too.
+
+    With ordered, writers also take turns - each batch is only written once every batch submitted before it has been,
+    and none is written after an earlier one failed - so several writers keep an output in submission order, as
+    checkpointed outputs (and the positions they report) need.
+    """
+
+    def __init__(
+            self,
+            flush: Callable[..., OutputClientResponse],
+            on_flushed: Callable[[Any], None] | None = None,
+            workers: int = 0,
+            queue_size: int = 2,
+            with_markers: bool = False,
+            ordered: bool = False
+    ):
+        """
+        :param flush: writes a batch, called as flush(patents), or flush(patents, marker) with with_markers
+        :param ordered: write batches strictly in submission order, whatever the number of workers
+        """
+        self.flush = flush
+        self.on_flushed = on_flushed
+        self.workers = workers
+        self.with_markers = with_markers
+        self.ordered = ordered
+        self.errors: list[Exception] = []
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._results: dict[int, OutputClientResponse | None] = {} # None for batches acknowledged without writing
+        self._markers: dict[int, Any] = {}
+        self._next_seq, self._next_ack = 0, 0
+        self._turn = threading.Condition()
+        self._next_write = 0
+        self._threads = [
+            threading.Thread(target=self._drain, name=f"patent-flush-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.errors)
+
+    def submit(self, patents: list[PatentLike], marker: Any = None, write: bool = True) -> None:
+        """
+        Queues a batch for writing, blocking while the queue is full. The batch must not be modified afterwards.
+
+        :param write: False to only acknowledge the batch's marker in turn, without writing it (eg a batch the output
+                      already holds)
+        :raises: the first writer error if a writer has already failed, no further batches are accepted after that
+        """
+        if self.errors:
+            raise self.errors[0]
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+        if not self._threads:
+            self._write(seq, patents, marker, write)
+            return
+        while True:
+            try:
+                self._queue.put((seq, patents, marker, write), timeout=0.1)
+                return
+            except queue.Full:
+                # Don't block forever behind writers that have died
+                if self.errors:
+                    raise self.errors[0]
+
+    def close(self) -> list[OutputClientResponse]:
+        """
+        Waits for every queued batch to be written and stops the writers.
+
+        :return: the output responses in submission order, any writer errors are left in self.errors
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        return [self._results[seq] for seq in sorted(self._results) if self._results[seq] is not None]
+
+    def _drain(self) -> None:
+        while (item := self._queue.get()) is not _STOP:
+            seq = item[0]
+            if self.ordered:
+                # Writers take their batches off the queue in order, so the one holding the next batch never waits
+                with self._turn:
+                    self._turn.wait_for(lambda: self._next_write == seq or bool(self.errors))
+            try:
+                if self.errors:
+                    # A writer already failed, drop the rest rather than writing around a gap
+                    continue
+                self._write(*item)
+            except Exception as e:
+                logger.error(f"Writer {threading.current_thread().name} failed to flush batch {seq} - {e}")
+                self.errors.append(e)
+            finally:
+                if self.ordered:
+                    with self._turn:
+                        self._next_write = seq + 1
+                        self._turn.notify_all()
+
+    def _write(self, seq: int, patents: list[PatentLike], marker: Any, write: bool = True) -> None:
+        result = None
+        if write:
+            result = self.flush(patents, marker) if self.with_markers else self.flush(patents)
+        with self._lock:
+            self._results[seq] = result
+            self._markers[seq] = marker
+            # Acknowledge the contiguous run of written batches only, so markers never skip an unwritten batch
+            while self._next_ack in self._results:
+                ack_marker = self._markers.pop(self._next_ack)
+                self._next_ack += 1
+                if self.on_flushed and ack_marker is not None:
+                    self.on_flushed(ack_marker)
+
+
+class FanOutPipeline:
+    """
+    Writes every submitted batch to several outputs (sinks) at once, each through its own FlushPipeline, so sinks write
+    concurrently and a slow sink only holds the fetcher back once its own queue is full.
+
+    A sink that fails is dropped for the rest of the run while the others carry on, its errors are kept per sink in
+    sink_errors. The pipeline as a whole only counts as failed once every sink has failed.
+
+    A marker is only passed to on_flushed once every sink has written its batch, so a checkpoint never moves past a
+    batch that any sink (including a failed one) is missing. Each sink's own progress is passed to on_sink_flushed as
+    it goes, so a resumed run can leave out the batches a sink already holds (see written) instead of writing the
+    healthy sinks' batches again.
+    """
+
+    def __init__(
+            self,
+            flushes: dict[str, Callable[[list[PatentLike]], OutputClientResponse]],
+            on_flushed: Callable[[Any], None] | None = None,
+            workers: int = 1,
+            queue_size: int = 2,
+            on_sink_flushed: Callable[[str, Any], None] | None = None,
+            written: Callable[[str, Any], bool] | None = None,
+            with_markers: bool = False,
+            ordered: bool = False
+    ):
+        """
+        :param flushes: flush callable per sink name, also handed each batch's marker with with_markers
+        :param workers: writer threads per sink, at least one so sinks never wait on each other
+        :param on_sink_flushed: called with a sink name and marker once that sink has written the batch (and every
+                                batch submitted before it)
+        :param written: tells whether a sink already holds the batch of a marker, which is then acknowledged for it
+                        without being written
+        :param ordered: write each sink's batches strictly in submission order (see FlushPipeline)
+        """
+        self.on_flushed = on_flushed
+        self.on_sink_flushed = on_sink_flushed
+        self.written = written
+        self._lock = threading.Lock()
+        self._acks: dict[int, int] = {}
+        self._markers: dict[int, Any] = {}
+        self._next_seq = 0
+        self._pipelines = {
+            sink: FlushPipeline(
+                flush=partial(self._flush_marked, flush) if with_markers else flush,
+                on_flushed=partial(self._acknowledge, sink),
+                workers=max(workers, 1),
+                queue_size=queue_size,
+                with_markers=with_markers,
+                ordered=ordered
+            )
+            for sink, flush in flushes.items()
+        }
+
+    @property
+    def sink_errors(self) -> dict[str, list[Exception]]:
+        return {sink: pipeline.errors for sink, pipeline in self._pipelines.items() if pipeline.errors}
+
+    @property
+    def errors(self) -> list[Exception]:
+        return [error for errors in self.sink_errors.values() for error in errors]
+
+    @property
+    def failed(self) -> bool:
+        return all(pipeline.failed for pipeline in self._pipelines.values())
+
+    def submit(self, patents: list[PatentLike], marker: Any = None) -> None:
+        """
+        Queues a batch on every sink still writing, blocking while any of their queues is full.
+
+        :raises: the first writer error once every sink has failed
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._markers[seq] = marker
+        for sink, pipeline in self._pipelines.items():
+            if pipeline.failed:
+                continue
+            try:
+                # Every sink gets the same batch, which none of them modify
+                write = marker is None or self.written is None or not self.written(sink, marker)
+                pipeline.submit(patents, seq, write=write)
+            except Exception as e:
+                logger.error(f"Dropping sink {sink} for the rest of the run - {e}")
+        if self.failed:
+            raise self.errors[0]
+
+    def close(self) -> list[OutputClientResponse]:
+        """
+        Waits for every sink to finish writing.
+
+        :return: the output responses of every sink, in sink then submission order
+        """
+        return [result for pipeline in self._pipelines.values() for result in pipeline.close()]
+
+    def _flush_marked(
+            self,
+            flush: Callable[[list[PatentLike], Any], OutputClientResponse],
+            patents: list[PatentLike],
+            seq: int
+    ) -> OutputClientResponse:
+        # Sink pipelines are given sequence numbers as markers, the submitted marker is kept until every sink has it
+        with self._lock:
+            marker = self._markers[seq]
+        return flush(patents, marker)
+
+    def _acknowledge(self, sink: str, seq: int) -> None:
+        with self._lock:
+            if self.on_sink_flushed and self._markers[seq] is not None:
+                self.on_sink_flushed(sink, self._markers[seq])
+            self._acks[seq] = self._acks.get(seq, 0) + 1
+            if self._acks[seq] < len(self._pipelines):
+                return
+            # Every sink acknowledges in submission order, so the last sink to acknowledge a batch does so in order too
+            del self._acks[seq]
+            marker = self._markers.pop(seq)
+            if self.on_flushed and marker is not None:
+                self.on_flushed(marker)
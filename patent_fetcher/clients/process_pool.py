@@ -0,0 +1,51 @@
+﻿import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from patent_fetcher.settings import cli_settings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def process_pool() -> Executor | None:
+    """
+    The process pool CPU bound work is offloaded to (decoding pages, serializing and compressing file outputs), so a
+    single run isn't held to one core by the GIL. Shared by every client and sink of the process, and started on first
+    use with PROCESS_WORKERS spawned workers (spawn rather than fork, since the parent already holds threads and
+    sessions by then).
+
+    Work is exchanged as bytes and picklable patents, and results are always collected in submission order.
+
+    :return: the pool, or None if PROCESS_WORKERS is 0 and the work should be done in the calling thread
+    """
+    global _pool
+    if not cli_settings.process_workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=cli_settings.process_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"Started process pool with {cli_settings.process_workers} workers")
+        return _pool
+
+
+def shutdown_process_pool() -> None:
+    """
+    Stops the shared process pool, if started - the next process_pool() call starts a new one
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+atexit.register(shutdown_process_pool)
@@ -0,0 +1,161 @@
+﻿import logging
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AdaptiveRateLimiter:
+    """
+    Client side throttling for a shared api - a token bucket capping the request rate, plus an AIMD window capping the
+    number of requests in flight.
+
+    Both are adjusted as responses come back. A throttled response (eg 429/503) halves the window and the rate, and
+    pauses every request for its Retry-After. A latency spike (a response much slower than the running average) shrinks
+    the window by a quarter. Healthy responses grow the window by one for every window's worth of them, and the rate by
+    a tenth of its cap, so the client settles just under whatever the api allows.
+
+    Decreases happen at most once per average response time, so a burst of throttled responses to requests that were
+    all sent at the same rate only counts once.
+    """
+    DECREASE_FACTOR = 0.5
+    SPIKE_DECREASE_FACTOR = 0.75
+    RATE_INCREASE = 0.1 # of max_rate, per window of healthy responses
+    MIN_LATENCY_SAMPLES = 5 # before latency spikes are looked for
+
+    def __init__(self, max_window: int, max_rate: float | None = None, burst: int = 1, latency_spike_factor: float = 3.0):
+        """
+        :param max_window: max number of requests in flight, the window starts here
+        :param max_rate: max requests per second, the rate starts here - None for no rate limit (the window still adapts)
+        :param burst: number of requests that can be sent at once after idling
+        :param latency_spike_factor: responses slower than this multiple of the average count as a latency spike
+        """
+        self.max_window = max_window
+        self.max_rate = max_rate
+        self.burst = burst
+        self.latency_spike_factor = latency_spike_factor
+        self.throttled = 0
+        self._window = float(max_window)
+        self._rate = max_rate
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._avg_latency: float | None = None
+        self._latency_samples = 0
+        self._healthy = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    @property
+    def window(self) -> int:
+        return max(1, int(self._window))
+
+    @property
+    def rate(self) -> float | None:
+        return self._rate
+
+    def resize(self, max_window: int) -> None:
+        """
+        Sets a new max window (eg a run's concurrency), restarting the window from it - a client reused across runs
+        (eg by the serve daemon) would otherwise start a wider run stuck at the previous run's window. The rate is kept,
+        so a throttled api is still eased back into.
+        """
+        with self._cond:
+            self.max_window = max_window
+            self._window = float(max_window)
+            self._healthy = 0
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Waits for room in the window and a token (and any Retry-After pause to pass), holding the window slot while
+        the request is made
+        """
+        with self._cond:
+            while self._in_flight >= self.window:
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            self._wait_for_token()
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        """
+        Records a healthy response, shrinking the window if it was a latency spike and growing it otherwise
+        """
+        with self._cond:
+            now = time.monotonic()
+            spike = (
+                self._latency_samples >= self.MIN_LATENCY_SAMPLES
+                and latency > self.latency_spike_factor * self._avg_latency
+            )
+            self._avg_latency = latency if self._avg_latency is None else 0.9 * self._avg_latency + 0.1 * latency
+            self._latency_samples += 1
+            if spike:
+                if self._can_decrease(now):
+                    self._decrease(now, self.SPIKE_DECREASE_FACTOR, rate=False)
+                    logger.info(f"Latency spike ({latency:.2f}s, average {self._avg_latency:.2f}s), {self.describe()}")
+                return
+
+            self._healthy += 1
+            if self._healthy >= self.window:
+                self._healthy = 0
+                if self._window < self.max_window or (self._rate and self._rate < self.max_rate):
+                    self._window = min(self.max_window, self._window + 1)
+                    if self._rate:
+                        self._rate = min(self.max_rate, self._rate + self.max_rate * self.RATE_INCREASE)
+                    logger.info(f"Healthy responses, {self.describe()}")
+            self._cond.notify_all()
+
+    def on_throttled(self, retry_after: float) -> None:
+        """
+        Records a throttled response - pauses every request for retry_after seconds and backs off the window and rate
+        """
+        with self._cond:
+            now = time.monotonic()
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, now + retry_after)
+            if self._can_decrease(now):
+                self._decrease(now, self.DECREASE_FACTOR, rate=True)
+            logger.warning(f"Throttled by the api, pausing for {retry_after:.2f}s, {self.describe()}")
+
+    def describe(self) -> str:
+        rate = f"{self._rate:.2f}/s" if self._rate else "unlimited"
+        return f"rate={rate} window={self.window}/{self.max_window}"
+
+    def _can_decrease(self, now: float) -> bool:
+        return now - self._last_decrease >= (self._avg_latency or 0.0)
+
+    def _decrease(self, now: float, factor: float, rate: bool) -> None:
+        self._last_decrease = now
+        self._healthy = 0
+        self._window = max(1.0, self._window * factor)
+        if rate and self._rate:
+            # Never all the way down to nothing, the api has to be probed to find out it has recovered
+            self._rate = max(self.max_rate / 100, self._rate * factor)
+
+    def _wait_for_token(self) -> None:
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    wait = self._paused_until - now
+                elif not self._rate:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self._rate)
+                    self._refilled_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
@@ -0,0 +1,134 @@
+﻿import logging
+import multiprocessing
+from collections.abc import Callable
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, timedelta
+
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.models.patent_client import PatentsClientRequest, PatentsClientResponse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DateRange = tuple[date, date]
+
+
+def split_date_range(start: date, end: date, span_days: int) -> list[DateRange]:
+    """
+    Splits [start, end) into consecutive sub-ranges of at most span_days each.
+
+    Ranges are treated as half-open with shared boundaries, as implied by the api request rejecting from == to,
+    so neighbouring shards are (start, start + span), (start + span, start + 2 * span), ...
+    """
+    if span_days < 1:
+        raise ValueError(f"Shard span must be at least one day, got {span_days}")
+    ranges, cur = [], start
+    while cur < end:
+        nxt = min(cur + timedelta(days=span_days), end)
+        ranges.append((cur, nxt))
+        cur = nxt
+    return ranges
+
+
+def halve_date_range(start: date, end: date) -> list[DateRange] | None:
+    """
+    Splits [start, end) into two halves, or returns None if the range is a single day and cannot be split further
+    """
+    days = (end - start).days
+    if days < 2:
+        return None
+    mid = start + timedelta(days=days // 2)
+    return [(start, mid), (mid, end)]
+
+
+def _shard_request(request: PatentsClientRequest, shard: DateRange) -> PatentsClientRequest:
+    api_request = request.api_request.model_copy(update={"grant_from_date": shard[0], "grant_to_date": shard[1]})
+    return request.model_copy(update={"api_request": api_request})
+
+
+def _fetch_shard(request: PatentsClientRequest, max_shard_pages: int | None) -> PatentsClientResponse | list[DateRange]:
+    """
+    Runs inside a worker - fetches a single shard end to end with its own client.
+
+    With max_shard_pages set, the first page is probed first and the shard is handed back as two halves instead
+    if it reports more pages than that (and is more than a day wide).
+
+    :return: the shard's PatentsClientResponse, or the sub-ranges to fetch instead
+    """
+    api_request = request.api_request
+    with PatentClient() as client:
+        first_response = None
+        if max_shard_pages:
+            client.cache_mode = request.cache_mode
+            # Handed on to the fetch, so the shard's first page isn't fetched twice
+            first_response = client._fetch_patent_page_retrying(client._page_payload(api_request, request.start_page))
+            total_pages = first_response.pagination.total_pages
+            if total_pages > max_shard_pages and (halves := halve_date_range(api_request.grant_from_date, api_request.grant_to_date)):
+                return halves
+        return client.fetch_patents(request, first_response=first_response)
+
+
+class ShardedPatentClient:
+    """
+    Fetches a large date range as independent date shards, each run end to end by PatentClient in its own
+    worker process, and merges the per-shard responses into one.
+    """
+
+    def __init__(self, workers: int | None = None, executor_factory: Callable[[int | None], Executor] | None = None):
+        """
+        :param workers: number of worker processes, defaults to the number of cores
+        :param executor_factory: builds the executor shards run on, defaults to a spawn-based process pool
+                                 (spawn rather than fork, since the parent may already hold threads and sessions)
+        """
+        self.workers = workers
+        self.executor_factory = executor_factory or (
+            lambda max_workers: ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        )
+
+    def fetch_patents(self, request: PatentsClientRequest) -> PatentsClientResponse:
+        """
+        Splits the request's date range into shards (request.shard_days wide, or the whole range if omitted),
+        fetches every shard in parallel and halves any shard whose first page reports more than
+        request.max_shard_pages pages.
+
+        :return: the merged PatentsClientResponse of every shard
+        :raises: ValueError if any shard fails, after the remaining shards have finished
+        """
+        api_request = request.api_request
+        start, end = api_request.grant_from_date, api_request.grant_to_date
+        shards = split_date_range(start, end, request.shard_days) if request.shard_days else [(start, end)]
+        logger.info(f"Beginning sharded patent fetch of {start} to {end} across {len(shards)} initial shards")
+
+        responses, failures = [], []
+        with self.executor_factory(self.workers) as executor:
+            pending: dict[Future, DateRange] = {}
+
+            def _submit(shard: DateRange) -> None:
+                future = executor.submit(_fetch_shard, _shard_request(request, shard), request.max_shard_pages)
+                pending[future] = shard
+
+            for shard in shards:
+                _submit(shard)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Shard {shard[0]} to {shard[1]} failed - {e}")
+                        failures.append((shard, e))
+                        continue
+
+                    if isinstance(result, list):
+                        logger.info(f"Shard {shard[0]} to {shard[1]} has too many pages, splitting into {result}")
+                        for sub_shard in result:
+                            _submit(sub_shard)
+                    else:
+                        logger.info(f"Shard {shard[0]} to {shard[1]} fetched {result.total_items_fetched} patents")
+                        responses.append(result)
+
+        if failures:
+            raise ValueError(f"{len(failures)} shard(s) failed: " + ", ".join(f"{s[0]} to {s[1]} ({e})" for s, e in failures))
+        return PatentsClientResponse.merge(responses)
@@ -1,7 +1,6 @@
 ﻿from enum import Enum
 
-from patent_fetcher.clients.output.local import LocalOutputClient
-from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.clients.output.registry import OutputRegistry
 
 
 class Output(Enum):
@@ -9,13 +8,55 @@ class Output(Enum):
     Enum indicating output location:
     - local: dump to disk as a json gzip
     - sqlite: write out to sqlite as defined in the environment settings
+    - ndjson: stream to disk as rolling gzipped json lines files
+    - partitioned: ndjson files in year=YYYY/month=MM (or per day) directories by grant date, with a manifest
     """
     LOCAL = "local"
     SQLITE = "sqlite"
+    NDJSON = "ndjson"
+    PARTITIONED = "partitioned"
 
-# Consciously doing a simple mapping of a user input to a concrete class
-# a better option might be something like a registry pattern
-OUTPUT_CLIENT = {
-    Output.LOCAL: LocalOutputClient,
-    Output.SQLITE: SQLiteOutputClient,
-}
\ No newline at end of file
+
+class CacheMode(Enum):
+    """
+    Enum indicating how the page cache is used for a fetch:
+    - use: serve pages from the cache when present, cache anything fetched
+    - bypass: neither read nor write the cache
+    - refresh: always fetch from the api, overwriting what is cached
+    """
+    USE = "use"
+    BYPASS = "bypass"
+    REFRESH = "refresh"
+
+
+class DedupMode(Enum):
+    """
+    Enum indicating how patents repeated within a fetch run are dropped before flushing:
+    - auto: exact for runs of up to DEDUP_EXACT_MAX_ITEMS patents, bloom past that
+    - exact: remember every patent number seen in a set
+    - bloom: remember patent numbers in a fixed size Bloom filter, may drop the odd unique patent (DEDUP_ERROR_RATE)
+    - off: write every fetched patent
+    """
+    AUTO = "auto"
+    EXACT = "exact"
+    BLOOM = "bloom"
+    OFF = "off"
+
+class JobStatus(Enum):
+    """
+    Enum indicating where a fetch job submitted to the serve daemon is at:
+    - queued: waiting on a free worker
+    - running: being fetched
+    - succeeded: fetched, its response holds the results (including any failed pages)
+    - failed: the fetch failed, its error says why and its response holds whatever was fetched before it did
+    - cancelled: still queued when the daemon stopped
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+# Output name (or Output) to output client class - the built-ins plus any installed through entry points, only
+# imported once used (see OutputRegistry)
+OUTPUT_CLIENT = OutputRegistry()
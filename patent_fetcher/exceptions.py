@@ -0,0 +1,50 @@
+﻿from typing import TYPE_CHECKING
+
+from requests import HTTPError
+
+if TYPE_CHECKING:
+    from patent_fetcher.models.patent_client import PatentsClientResponse
+
+
+class PatentFetchError(ValueError):
+    """
+    Raised when a patent fetch run fails part way through.
+
+    Still a ValueError for existing callers, but carries the partial PatentsClientResponse (what was fetched and
+    written before the failure, plus the errors from both the fetch and output side) for callers that want it.
+    """
+
+    def __init__(self, *args, response: "PatentsClientResponse | None" = None):
+        super().__init__(*args)
+        self.response = response
+
+
+class ApiError(HTTPError):
+    """
+    Raised when a request to the patents api fails.
+
+    Still an HTTPError for existing callers, split into retryable and non-retryable failures so callers can tell
+    a flaky api apart from a request that will never succeed.
+    """
+
+    def __init__(self, *args, status_code: int | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.status_code = status_code
+
+
+class RetryableApiError(ApiError):
+    """
+    A transient failure worth retrying - connection errors, timeouts, 408/429 and 5xx responses
+    """
+
+
+class NonRetryableApiError(ApiError):
+    """
+    A failure that retrying won't fix - any other 4xx response, or a response that isn't valid json
+    """
+
+
+class JobQueueFullError(RuntimeError):
+    """
+    Raised when a fetch job is submitted to the serve daemon while its job queue is full
+    """
@@ -0,0 +1,36 @@
+﻿from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+from patent_fetcher.constants import JobStatus
+from patent_fetcher.models.patent_client import PatentsClientRequest, PatentsClientResponse
+
+
+class FetchJob(BaseModel):
+    """
+    Model representing a fetch submitted to the serve daemon - its request, where it's at and, once finished, its
+    response (or error)
+    """
+    id: str
+    status: JobStatus = JobStatus.QUEUED
+    request: PatentsClientRequest
+    response: PatentsClientResponse | None = None
+    error: str | None = None
+    submitted_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class JobServerStatus(BaseModel):
+    """
+    Model representing the serve daemon's health - its workers and how many jobs are at each stage
+    """
+    status: str = "healthy"
+    workers: int
+    queued: int = 0
+    running: int = 0
+    finished: int = 0
@@ -0,0 +1,105 @@
+﻿from pydantic import BaseModel, Field, computed_field
+
+
+class HistogramSnapshot(BaseModel):
+    """
+    Model representing a timing histogram of a run, bucketed like a Prometheus histogram.
+
+    Quantiles are estimated from the buckets (interpolating within the bucket the quantile falls in), so they are only
+    as precise as the bucket bounds.
+    """
+    name: str
+    labels: dict[str, str] = Field(default_factory=dict)
+    bounds: list[float] # upper bound of each bucket, in seconds
+    counts: list[int] # observations per bucket, with one more than bounds for everything past the last bound
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    @computed_field
+    @property
+    def p50(self) -> float | None:
+        return self.quantile(0.5)
+
+    @computed_field
+    @property
+    def p99(self) -> float | None:
+        return self.quantile(0.99)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n and cumulative + n >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / n)
+            cumulative += n
+        return self.max
+
+
+class RunMetrics(BaseModel):
+    """
+    Root model representing where the time of a run went - see MetricsRecorder
+    """
+    elapsed_seconds: float = 0.0
+    items_per_second: float = 0.0 # patents fetched
+    counters: dict[str, float] = Field(default_factory=dict)
+    histograms: list[HistogramSnapshot] = Field(default_factory=list)
+
+    def histogram(self, name: str, **labels: str) -> HistogramSnapshot | None:
+        return next((h for h in self.histograms if h.name == name and h.labels == labels), None)
+
+    @classmethod
+    def merge(cls, metrics: list["RunMetrics"]) -> "RunMetrics":
+        """
+        Aggregates the metrics of independent runs side by side (eg date shards) - their throughputs add up
+        """
+        histograms: dict[tuple, HistogramSnapshot] = {}
+        for histogram in (h for m in metrics for h in m.histograms):
+            key = (histogram.name, tuple(sorted(histogram.labels.items())))
+            if (merged := histograms.get(key)) is None:
+                histograms[key] = histogram.model_copy(deep=True)
+            else:
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.max = max(merged.max, histogram.max)
+        counters: dict[str, float] = {}
+        for name, value in (c for m in metrics for c in m.counters.items()):
+            counters[name] = counters.get(name, 0) + value
+        return cls(
+            elapsed_seconds=max((m.elapsed_seconds for m in metrics), default=0.0),
+            items_per_second=sum(m.items_per_second for m in metrics),
+            counters=counters,
+            histograms=list(histograms.values()),
+        )
+
+    def to_prometheus(self, prefix: str = "patent_fetcher") -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format, eg for the node exporter's textfile collector
+        """
+        lines = [
+            f"# TYPE {prefix}_elapsed_seconds gauge",
+            f"{prefix}_elapsed_seconds {self.elapsed_seconds}",
+            f"# TYPE {prefix}_items_per_second gauge",
+            f"{prefix}_items_per_second {self.items_per_second}",
+        ]
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        typed = set()
+        for histogram in self.histograms:
+            metric = f"{prefix}_{histogram.name}"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            labels = "".join(f'{key}="{value}",' for key, value in histogram.labels.items())
+            cumulative = 0
+            for bound, n in zip([*map(str, histogram.bounds), "+Inf"], histogram.counts):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines += [f"{metric}_sum{labels} {histogram.sum}", f"{metric}_count{labels} {histogram.count}"]
+        return "\n".join(lines) + "\n"
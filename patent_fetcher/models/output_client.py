@@ -14,3 +14,4 @@ class OutputClientResponse(BaseModel):
     """
     num_items_outputted: Annotated[int, BeforeValidator(default_if_none)] = Field(default=0)
     output_info: dict[str, Any] | None = Field(default_factory=dict)
+    sink: str | None = None # the output client this came from, when a run writes to several
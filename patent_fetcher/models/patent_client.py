@@ -1,10 +1,15 @@
-﻿from typing import Annotated
+﻿from collections.abc import Collection
+from datetime import date
+from typing import Annotated, Any, Self
 
-from pydantic import Field, BaseModel, BeforeValidator, field_serializer
+from pydantic import Field, BaseModel, BeforeValidator, field_serializer, field_validator, model_validator
 
 from patent_fetcher.clients.output.base_client import OutputClient
 from patent_fetcher.clients.output.local import LocalOutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.constants import CacheMode, DedupMode, OUTPUT_CLIENT
 from patent_fetcher.models.api import PatentsApiRequest
+from patent_fetcher.models.metrics import RunMetrics
 from patent_fetcher.models.output_client import OutputClientResponse
 from patent_fetcher.models.utils import default_if_none
 
@@ -15,23 +20,150 @@ class PatentsClientRequest(BaseModel):
     Contains additional options that are local to program execution and not the api
     """
     api_request: PatentsApiRequest
-    output_client: type[OutputClient] | None = LocalOutputClient
+    output_client: type[OutputClient] | list[type[OutputClient]] | None = LocalOutputClient # several to fan out to each
     num_pages: int | None = None
     start_page: Annotated[int, BeforeValidator(default_if_none)] = Field(default=1, ge=1)
+    concurrency: Annotated[int, BeforeValidator(default_if_none)] = Field(default=1, ge=1)
+    shard_days: int | None = Field(default=None, ge=1)
+    max_shard_pages: int | None = Field(default=None, ge=1)
+    cache_mode: CacheMode = CacheMode.USE
+    resume: bool = False
+    flush_workers: Annotated[int, BeforeValidator(default_if_none)] = Field(default=0, ge=0)
+    dedup: DedupMode = DedupMode.AUTO
+    skip_existing: bool = False # drop patents already in the SQLite output, across runs
+
+    @field_validator("output_client", mode="before")
+    @classmethod
+    def parse_output(cls, output_client: Any) -> Any:
+        # Takes the serialized form (comma separated class names) back too, eg for requests stored with checkpoints,
+        # as well as output names like --output takes (eg "ndjson,sqlite" or ["ndjson", "sqlite"], eg from a job)
+        if isinstance(output_client, list) and all(isinstance(name, str) for name in output_client):
+            output_client = ",".join(output_client)
+        if not isinstance(output_client, str):
+            return output_client
+        # Registered outputs that were never imported aren't subclasses yet, so fall back on loading them
+        known = {client.__name__: client for client in _subclasses(OutputClient)}
+        names = [name for name in output_client.split(",") if name]
+        for name in names:
+            if name in known:
+                continue
+            if name in OUTPUT_CLIENT:
+                known[name] = OUTPUT_CLIENT[name]
+            elif (client := OUTPUT_CLIENT.by_class_name(name)) is not None:
+                known[name] = client
+        if unknown := [name for name in names if name not in known]:
+            raise ValueError(f"Unknown output client(s) {unknown}")
+        return [known[name] for name in names] or None
 
     @field_serializer("output_client")
-    def serialize_output(self, output_client: type[OutputClient]) -> str:
-        return output_client.__name__ if output_client else ""
+    def serialize_output(self, output_client: type[OutputClient] | list[type[OutputClient]] | None) -> str:
+        return ",".join(client.__name__ for client in self.output_clients)
+
+    @property
+    def output_clients(self) -> list[type[OutputClient]]:
+        if isinstance(self.output_client, list):
+            return self.output_client
+        return [self.output_client] if self.output_client else []
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.shard_days or self.max_shard_pages)
+
+    @model_validator(mode="after")
+    def check_outputs(self) -> Self:
+        # Sinks are told apart by name in the response
+        names = [client.__name__ for client in self.output_clients]
+        if len(names) != len(set(names)):
+            raise ValueError(f"Each output can only be given once, got {names}")
+        if self.skip_existing and SQLiteOutputClient not in self.output_clients:
+            raise ValueError("skip_existing checks the SQLite output, which isn't one of the outputs")
+        return self
+
+    @model_validator(mode="after")
+    def check_sharding(self) -> Self:
+        # Page selection is per date range, so it cannot be combined with splitting the range into shards
+        if self.sharded and (self.num_pages or self.start_page != 1):
+            raise ValueError("num_pages/start_page cannot be combined with sharding")
+        return self
+
+
+class FailedPage(BaseModel):
+    """
+    A page that still failed after exhausting its retries - set aside so the rest of the run could carry on
+    """
+    page: int
+    grant_from_date: date
+    grant_to_date: date
+    error: str
 
 
 class PatentsClientResponse(BaseModel):
     """
     Root models representing the expected patent clients response containing metrics and output information
 
-    Fetched/outputted metrics separated as not every item is guaranteed to be written out successfully
+    Fetched/outputted metrics separated as not every item is guaranteed to be written out successfully.
+    With several outputs, total_items_outputted counts the items written to every one of them, output_info holds the
+    responses of each (tagged by sink) and sink_errors the errors of any that failed.
     """
     total_items_found: Annotated[int, BeforeValidator(default_if_none)] = Field(default=0)
     total_items_fetched: int = 0
     total_pages_fetched: int = 0
     total_items_outputted: Annotated[int, BeforeValidator(default_if_none)] = Field(default=0)
     output_info: list[OutputClientResponse] | None = Field(default_factory=list)
+    cache_hits: int = 0
+    cache_misses: int = 0
+    errors: list[str] = Field(default_factory=list)
+    sink_errors: dict[str, list[str]] = Field(default_factory=dict)
+    failed_pages: list[FailedPage] = Field(default_factory=list) # see fetch_failed_pages
+    duplicates_dropped: int = 0 # repeated within the run, or already in the SQLite output with skip_existing
+    latest_grant_date: date | None = None # of any fetched patent, see sync_patents
+    metrics: RunMetrics | None = None # where the run's time went
+    throttled_requests: int = 0
+    request_rate: float | None = None # requests per second the client had settled on, None if uncapped
+    concurrency_window: int | None = None # requests in flight the client had settled on
+
+    @classmethod
+    def merge(cls, responses: list["PatentsClientResponse"]) -> "PatentsClientResponse":
+        """
+        Aggregates the responses of independent fetches (eg date shards) into a single response
+        """
+        return cls(
+            total_items_found=sum(r.total_items_found for r in responses),
+            total_items_fetched=sum(r.total_items_fetched for r in responses),
+            total_pages_fetched=sum(r.total_pages_fetched for r in responses),
+            total_items_outputted=sum(r.total_items_outputted for r in responses),
+            output_info=[info for r in responses for info in r.output_info or []],
+            cache_hits=sum(r.cache_hits for r in responses),
+            cache_misses=sum(r.cache_misses for r in responses),
+            errors=[error for r in responses for error in r.errors],
+            failed_pages=[page for r in responses for page in r.failed_pages],
+            duplicates_dropped=sum(r.duplicates_dropped for r in responses),
+            latest_grant_date=max((r.latest_grant_date for r in responses if r.latest_grant_date), default=None),
+            metrics=RunMetrics.merge([r.metrics for r in responses if r.metrics]) if any(r.metrics for r in responses) else None,
+            throttled_requests=sum(r.throttled_requests for r in responses),
+            # Independent fetches (eg shards) run side by side, so their rates and windows add up
+            request_rate=sum(r.request_rate for r in responses if r.request_rate) or None,
+            concurrency_window=sum(r.concurrency_window for r in responses if r.concurrency_window) or None,
+            sink_errors={
+                sink: [error for r in responses for error in r.sink_errors.get(sink, [])]
+                for sink in dict.fromkeys(sink for r in responses for sink in r.sink_errors)
+            },
+        )
+
+    @staticmethod
+    def items_outputted(output_info: list[OutputClientResponse], sinks: Collection[str] = ()) -> int:
+        """
+        Counts the items written out to every sink, ie the smallest total of any one sink
+
+        :param sinks: every sink of the run, so a sink that wrote nothing at all counts as 0
+        """
+        if len(sinks) < 2:
+            return sum(output.num_items_outputted for output in output_info)
+        per_sink = dict.fromkeys(sinks, 0)
+        for output in output_info:
+            per_sink[output.sink] = per_sink.get(output.sink, 0) + output.num_items_outputted
+        return min(per_sink.values())
+
+
+def _subclasses(cls: type) -> list[type]:
+    return [sub for direct in cls.__subclasses__() for sub in (direct, *_subclasses(direct))]
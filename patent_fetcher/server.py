@@ -0,0 +1,148 @@
+﻿import json
+import logging
+import os
+import signal
+import socketserver
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pydantic import ValidationError
+
+from patent_fetcher.clients.jobs import JobRunner
+from patent_fetcher.exceptions import JobQueueFullError
+from patent_fetcher.models.patent_client import PatentsClientRequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+"""
+Local job api of the serve daemon, over HTTP on a local port or over a Unix socket:
+- POST /jobs takes a PatentsClientRequest as json and queues it, answering 202 with the job (503 if the queue is full)
+- GET /jobs/<id> answers with the job - its status, and its PatentsClientResponse once finished
+- GET /jobs lists every job kept, without their responses
+- GET /health answers with the daemon's workers and jobs by stage
+"""
+
+
+class _JobRequestHandler(BaseHTTPRequestHandler):
+    server: "JobServer | UnixJobServer"
+    protocol_version = "HTTP/1.1" # keep-alive, so a scheduler can reuse one connection for its jobs
+
+    def do_GET(self):
+        runner = self.server.runner
+        if self.path == "/health":
+            return self._respond(200, runner.status().model_dump_json())
+        if self.path == "/jobs":
+            jobs = [job.model_dump(mode="json", exclude={"response"}) for job in runner.jobs()]
+            return self._respond(200, json.dumps({"jobs": jobs}))
+        if self.path.startswith("/jobs/") and (job := runner.get(self.path.removeprefix("/jobs/"))) is not None:
+            return self._respond(200, job.model_dump_json())
+        self._respond(404, json.dumps({"detail": "not found"}))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != "/jobs":
+            return self._respond(404, json.dumps({"detail": "not found"}))
+        try:
+            job = self.server.runner.submit(PatentsClientRequest.model_validate_json(body))
+        except ValidationError as e:
+            return self._respond(400, json.dumps({"detail": json.loads(e.json(include_url=False))}))
+        except JobQueueFullError as e:
+            return self._respond(503, json.dumps({"detail": str(e)}))
+        self._respond(202, job.model_dump_json())
+
+    def _respond(self, status: int, body: str):
+        raw = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class JobServer(ThreadingHTTPServer):
+    """
+    Serves the job api of a JobRunner over HTTP, on localhost unless told otherwise
+    """
+    daemon_threads = True
+
+    def __init__(self, runner: JobRunner, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _JobRequestHandler)
+        self.runner = runner
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_port}"
+
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the job api of a JobRunner over a Unix socket, only accessible to the user running the daemon
+    """
+    daemon_threads = True
+
+    def __init__(self, runner: JobRunner, path: str):
+        """
+        :raises FileExistsError: if something other than a socket is at path
+        """
+        # A socket left behind by a daemon that didn't shut down cleanly would fail the bind, anything else is left be
+        try:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(f"{path} exists and isn't a socket, refusing to serve on it")
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        super().__init__(path, _JobRequestHandler)
+        self.runner = runner
+
+    def server_bind(self) -> None:
+        # The socket is created with the umask's permissions, so it's never reachable by other users, even briefly
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    @property
+    def url(self) -> str:
+        return f"unix://{self.server_address}"
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            if stat.S_ISSOCK(os.lstat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 0, socket_path: str | None = None, runner: JobRunner | None = None) -> None:
+    """
+    Runs the serve daemon until interrupted (or sent SIGTERM) - jobs still queued then are cancelled, running ones
+    are finished first
+
+    :param socket_path: serves on this Unix socket instead of host and port
+    :param runner: runs the jobs, defaults to one configured by the SERVE_* settings
+    """
+    runner = runner or JobRunner()
+    server = UnixJobServer(runner, socket_path) if socket_path else JobServer(runner, host, port)
+    if threading.current_thread() is threading.main_thread():
+        # shutdown waits on serve_forever to return, so it can't be called from the thread running it
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    with runner:
+        logger.info(f"Serving fetch jobs on {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            logger.info("Stopping, waiting on running jobs")
@@ -1,4 +1,6 @@
-﻿from pydantic import HttpUrl, SecretStr, Field
+﻿from typing import Literal
+
+from pydantic import HttpUrl, SecretStr, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,6 +11,69 @@ class Settings(BaseSettings):
     api_token: SecretStr = "" # bearer token
     sqlite_db: str = ":memory:"
     buffer_size: int = Field(default=10000, ge=1, lt=100000) # arbitrary buffer size
+    buffer_max_bytes: int | None = Field(default=None, ge=1) # approximate, also flushes once the buffer is this big
+    buffer_max_age_seconds: float | None = Field(default=None, gt=0) # also flushes once the oldest buffered patent is this old
     max_page_size: int = Field(default=1000, ge=1)
+    http_pool_size: int = Field(default=10, ge=1) # pooled connections kept open per client
+    http_keep_alive: bool = True
+    http_timeout: float = Field(default=60, gt=0) # seconds
+    rate_limit_rps: float | None = Field(default=None, gt=0) # max requests per second, empty for no cap
+    rate_limit_burst: int = Field(default=1, ge=1) # requests that can go out at once after idling
+    throttle_retries: int = Field(default=5, ge=0) # retries of a request throttled with a 429/503
+    throttle_backoff_seconds: float = Field(default=1, ge=0) # wait before retrying without a Retry-After, doubling
+    latency_spike_factor: float = Field(default=3, gt=1) # responses this much slower than average shrink the window
+    page_retries: int = Field(default=3, ge=0) # retries of a page failing with a retryable error, before it's set aside
+    page_retry_backoff_seconds: float = Field(default=0.5, ge=0) # base of the jittered exponential backoff
+    page_retry_max_backoff_seconds: float = Field(default=30, ge=0)
+    dedup_exact_max_items: int = Field(default=1_000_000, ge=0) # runs expecting more patents de-duplicate with a Bloom filter
+    dedup_error_rate: float = Field(default=1e-4, gt=0, lt=1) # Bloom filter false positive rate
+    sync_overlap_days: int = Field(default=7, ge=0) # grant dates re-fetched before a sink's sync mark, for late records
+    strict_decoding: bool = False # validate api pages without type coercion
+    compact_records: bool = False # buffer patents as slotted PatentRecords instead of pydantic models
+    process_workers: int = Field(default=0, ge=0) # processes decoding pages and compressing file outputs, 0 for none
+    cache_db: str | None = None # page cache location, caching is off unless set
+    cache_ttl_seconds: int = Field(default=7 * 24 * 60 * 60, ge=0)
+    cache_max_bytes: int = Field(default=1024 ** 3, ge=0)
+    flush_queue_size: int = Field(default=2, ge=1) # buffers waiting on background writers before fetching blocks
+    state_db: str | None = ".patent_fetcher_state.db" # run checkpoints, empty disables checkpointing
+    output_dir: str = "." # where file outputs are written
+    output_max_file_bytes: int | None = Field(default=256 * 1024 ** 2, ge=1) # compressed, rolls to a new file past it
+    output_max_file_records: int | None = Field(default=None, ge=1) # rolls to a new file past it
+    output_compression_level: int = Field(default=6, ge=0, le=9)
+    output_partition_by: Literal["month", "day"] = "month" # partition directories of the partitioned output
+    metrics_file: str | None = None # run metrics written here at the end of every cli run, empty to skip
+    metrics_format: Literal["json", "prometheus"] = "json" # prometheus for the text exposition format
+    serve_workers: int = Field(default=2, ge=1) # jobs the serve daemon runs at once, each on its own warm client
+    serve_queue_size: int = Field(default=100, ge=1) # jobs waiting on a worker before new ones are turned away
+    serve_max_jobs: int = Field(default=1000, ge=1) # finished jobs kept for status queries, oldest dropped first
+    serve_health_check_seconds: float = Field(default=60, ge=0) # a healthy check is trusted by the daemon's jobs this long
+
+
+class _LazySettings:
+    """
+    Stands in for the Settings instance, only reading the environment and dotenv file the first time a setting is used,
+    so importing a module that holds on to cli_settings (eg to show --help) doesn't parse or validate them
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_settings", None)
+
+    def _load(self) -> Settings:
+        if self._settings is None:
+            object.__setattr__(self, "_settings", Settings())
+        return self._settings
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name: str) -> None:
+        delattr(self._load(), name)
+
+    def __repr__(self) -> str:
+        return repr(self._load())
+
 
-cli_settings = Settings()
+cli_settings: Settings = _LazySettings()
@@ -0,0 +1,133 @@
+﻿import json
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from pydantic import SecretStr
+
+from patent_fetcher.settings import cli_settings
+
+"""
+Shared fixtures:
+- isolated_local_state points the page cache and checkpoint store at per-test temporary files
+- fake_patents_api stands up a local stand-in for the patents api (/health and /patents) on a random port,
+  and points the settings at it for the duration of the test
+"""
+
+
+class FakePatentsApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, total_items: int = 25, delay: float = 0.0, items_per_day: int | None = None):
+        super().__init__(("127.0.0.1", 0), _FakePatentsApiHandler)
+        self.total_items = total_items
+        self.items_per_day = items_per_day
+        self.fail_pages: set[int] = set()
+        self.fail_status = 500
+        self.throttle_requests = 0 # number of upcoming requests answered with a 429
+        self.retry_after: str | None = "0"
+        self.delay = delay
+        self.requests: list[dict] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def patents_page(self, page: int, page_size: int, grant_from_date: str, grant_to_date: str) -> dict:
+        # With items_per_day set, the result size scales with the requested date range (eg for sharding)
+        total_items = self.total_items
+        if self.items_per_day is not None:
+            total_items = (date.fromisoformat(grant_to_date) - date.fromisoformat(grant_from_date)).days * self.items_per_day
+        total_pages = -(-total_items // page_size)
+        first = (page - 1) * page_size
+        return {
+            "patents": [
+                {
+                    "patent_number": f"US{i:08d}",
+                    "title": f"title {i}",
+                    "grant_date": date(2024, 1, 1 + i % 28).isoformat(),
+                    "abstract": "abstract",
+                    "claims": ["claim 1", "claim 2"],
+                    "assignees": ["assignee"],
+                    "inventors": ["inventor"],
+                    "description": "description",
+                }
+                for i in range(first, min(first + page_size, total_items))
+            ],
+            "pagination": {
+                "page": page,
+                "page_size": page_size,
+                "total_pages": total_pages,
+                "total_items": total_items,
+            },
+        }
+
+
+class _FakePatentsApiHandler(BaseHTTPRequestHandler):
+    server: FakePatentsApi
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._respond(404, {"detail": "not found"})
+        self._respond(200, {"status": "healthy", "service": "fake-patents-api"})
+
+    def do_POST(self):
+        if self.path != "/patents":
+            return self._respond(404, {"detail": "not found"})
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server._lock:
+            self.server.requests.append(body)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            if self.server.delay:
+                threading.Event().wait(self.server.delay)
+            pagination = body["pagination"]
+            if self.server.throttle_requests > 0:
+                with self.server._lock:
+                    self.server.throttle_requests -= 1
+                return self._respond(429, {"detail": "too many requests"}, retry_after=self.server.retry_after)
+            if pagination["page"] in self.server.fail_pages:
+                return self._respond(self.server.fail_status, {"detail": "failed"})
+            self._respond(200, self.server.patents_page(
+                pagination["page"], pagination["page_size"], body["grant_from_date"], body["grant_to_date"]
+            ))
+        finally:
+            with self.server._lock:
+                self.server.in_flight -= 1
+
+    def _respond(self, status: int, body: dict, retry_after: str | None = None):
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        if retry_after is not None:
+            self.send_header("Retry-After", retry_after)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def isolated_local_state(monkeypatch, tmp_path):
+    # Keeps the page cache and checkpoints out of the working directory, and stops runs in one test leaking into another
+    monkeypatch.setattr(cli_settings, "cache_db", str(tmp_path / "page_cache.db"))
+    monkeypatch.setattr(cli_settings, "state_db", str(tmp_path / "state.db"))
+
+
+@pytest.fixture
+def fake_patents_api(monkeypatch):
+    server = FakePatentsApi()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(cli_settings, "api_url", server.url)
+    monkeypatch.setattr(cli_settings, "api_token", SecretStr("fake-token"))
+    yield server
+    server.shutdown()
+    server.server_close()
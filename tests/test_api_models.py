@@ -1,4 +1,5 @@
-﻿from datetime import date, timedelta
+﻿import json
+from datetime import date, timedelta
 
 import pytest
 from pydantic import ValidationError
@@ -6,6 +7,7 @@ from pydantic import ValidationError
 from patent_fetcher.models.api import (
     PatentsApiResponsePage,
     Patent,
+    PatentRecord,
     HealthApiResponse,
     PatentsApiRequestPage,
     PatentsApiRequest,
@@ -79,3 +81,21 @@ def test_patents_api_request_invalid_dates():
             grant_to_date=date.today() - timedelta(days=1),
             pagination=PatentsApiRequestPage()
         )
+
+def test_patent_record_round_trip():
+    patent = Patent(
+        patent_number="number",
+        title="title",
+        grant_date=date.today(),
+        description="description",
+        abstract="abstract",
+        claims=["claim 1", "claim 2"],
+        assignees=["assignees"],
+        inventors=["inventors"],
+    )
+    record = PatentRecord.from_patent(patent)
+    assert not hasattr(record, "__dict__")
+    assert record.to_patent() == patent
+    # output clients can serialize either type the same way
+    assert json.loads(record.model_dump_json()) == json.loads(patent.model_dump_json())
+    assert json.dumps(record.model_dump(), default=str) == json.dumps(patent.model_dump(), default=str)
@@ -0,0 +1,169 @@
+﻿import asyncio
+import threading
+from datetime import date, timedelta
+
+import pytest
+from requests import HTTPError
+
+from patent_fetcher.clients import async_patent_client
+from patent_fetcher.clients.async_patent_client import AsyncPatentClient
+from patent_fetcher.clients.output.base_client import OutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.constants import DedupMode
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+"""
+Tests for the AsyncPatentClient, run against the local stand-in api from conftest rather than monkeypatching
+"""
+
+
+def _client_request(page_size: int = 5, output_client=None, **kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date.today(),
+            grant_to_date=date.today() + timedelta(days=1),
+            pagination=PatentsApiRequestPage(page=kwargs.get("start_page", 1), page_size=page_size)
+        ),
+        output_client=output_client,
+        **kwargs
+    )
+
+async def _fetch(request: PatentsClientRequest, **client_kwargs):
+    async with AsyncPatentClient(**client_kwargs) as client:
+        return await client.fetch_patents(request)
+
+
+def test_check_health(fake_patents_api):
+    async def _check():
+        async with AsyncPatentClient() as client:
+            return await client.check_health()
+
+    response = asyncio.run(_check())
+    assert response.status == "healthy"
+    assert response.service == "fake-patents-api"
+
+def test_fetch_patents_all_pages(fake_patents_api):
+    response = asyncio.run(_fetch(_client_request(concurrency=3)))
+
+    assert response.total_items_found == 25
+    assert response.total_items_fetched == 25
+    assert response.total_pages_fetched == 5
+    assert response.total_items_outputted == 25
+    assert sorted(r["pagination"]["page"] for r in fake_patents_api.requests) == [1, 2, 3, 4, 5]
+
+def test_fetch_patents_start_page_num_pages(fake_patents_api):
+    response = asyncio.run(_fetch(_client_request(start_page=2, num_pages=3, concurrency=4)))
+
+    assert response.total_pages_fetched == 3
+    assert response.total_items_fetched == 15
+    assert sorted(r["pagination"]["page"] for r in fake_patents_api.requests) == [2, 3, 4]
+
+def test_fetch_patents_caps_in_flight(fake_patents_api):
+    fake_patents_api.total_items = 100
+    fake_patents_api.delay = 0.05
+    response = asyncio.run(_fetch(_client_request(concurrency=20), max_in_flight=4))
+
+    assert response.total_pages_fetched == 20
+    assert 1 < fake_patents_api.max_in_flight <= 4
+
+def test_fetch_patents_page_error_raises_value_error(fake_patents_api):
+    async def _fetch_with_error():
+        async with AsyncPatentClient() as client:
+            fetch_page = client._fetch_patent_page
+
+            async def _fail_on_page_3(payload):
+                if payload.pagination.page == 3:
+                    raise HTTPError("test error")
+                return await fetch_page(payload)
+
+            client._fetch_patent_page = _fail_on_page_3
+            await client.fetch_patents(_client_request(concurrency=2))
+
+    with pytest.raises(ValueError):
+        asyncio.run(_fetch_with_error())
+
+class _RecordingOutputClient(OutputClient):
+    # Records the lifecycle calls of every instance
+    instances = []
+
+    def __init__(self):
+        self.calls = []
+        _RecordingOutputClient.instances.append(self)
+
+    def open(self):
+        self.calls.append("open")
+        return self
+
+    def write_batch(self, patents):
+        self.calls.append(len(patents))
+        return OutputClientResponse(num_items_outputted=len(patents))
+
+    def close(self):
+        self.calls.append("close")
+        return None
+
+    def output_patents(self, patents):
+        raise AssertionError("runs should write batches rather than single calls")
+
+def test_fetch_patents_cancelled_closes_output_clients(fake_patents_api):
+    fake_patents_api.delay = 0.5
+    _RecordingOutputClient.instances = []
+
+    async def _fetch_and_cancel():
+        async with AsyncPatentClient() as client:
+            task = asyncio.create_task(client.fetch_patents(_client_request(output_client=_RecordingOutputClient)))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(_fetch_and_cancel())
+    assert [instance.calls for instance in _RecordingOutputClient.instances] == [["open", "close"]]
+
+def test_fetch_patents_decodes_off_event_loop(fake_patents_api, monkeypatch):
+    decode_threads = []
+    decode = async_patent_client.decode_patents_page
+
+    def _recording_decode(*args, **kwargs):
+        decode_threads.append(threading.current_thread())
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(async_patent_client, "decode_patents_page", _recording_decode)
+    response = asyncio.run(_fetch(_client_request(concurrency=2)))
+
+    assert response.total_items_fetched == 25
+    assert decode_threads and threading.main_thread() not in decode_threads
+
+@pytest.mark.parametrize("dedup", [DedupMode.EXACT, DedupMode.BLOOM])
+def test_fetch_patents_drops_duplicates(fake_patents_api, dedup):
+    _RecordingOutputClient.instances = []
+
+    async def _fetch_with_repeats():
+        async with AsyncPatentClient() as client:
+            fetch_page = client._fetch_patent_page
+
+            async def _repeat_page_1(payload):
+                # every page comes back as page 1
+                first_page = payload.pagination.model_copy(update={"page": 1})
+                return await fetch_page(payload.model_copy(update={"pagination": first_page}))
+
+            client._fetch_patent_page = _repeat_page_1
+            return await client.fetch_patents(_client_request(output_client=_RecordingOutputClient, dedup=dedup))
+
+    response = asyncio.run(_fetch_with_repeats())
+
+    assert response.total_items_fetched == 25
+    assert response.duplicates_dropped == 20
+    assert response.total_items_outputted == 5
+
+def test_fetch_patents_skip_existing(fake_patents_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "sqlite_db", str(tmp_path / "patents.db"))
+    asyncio.run(_fetch(_client_request(start_page=1, num_pages=2, output_client=SQLiteOutputClient)))
+
+    response = asyncio.run(_fetch(_client_request(output_client=SQLiteOutputClient, skip_existing=True)))
+
+    assert response.duplicates_dropped == 10
+    assert response.total_items_outputted == 15
@@ -0,0 +1,66 @@
+﻿from datetime import date
+
+import pytest
+import requests
+
+from benchmarks.run import BenchmarkConfig, BenchmarkReport, SinkResult, compare
+from benchmarks.synthetic_api import SyntheticApiConfig, SyntheticPatentsApi
+
+
+def _result(items_per_second: float, p50: float = 0.05, peak_rss_bytes: int = 100) -> SinkResult:
+    return SinkResult(
+        items=100,
+        seconds=100 / items_per_second,
+        items_per_second=items_per_second,
+        page_latency_p50=p50,
+        page_latency_p99=p50 * 2,
+        peak_rss_bytes=peak_rss_bytes
+    )
+
+@pytest.fixture
+def synthetic_api():
+    api = SyntheticPatentsApi(SyntheticApiConfig(total_items=20, latency_seconds=0, description_bytes=100))
+    api.start()
+    yield api
+    api.stop()
+
+
+def test_synthetic_patents_independent_of_page_size(synthetic_api):
+    page = synthetic_api.patents_page(1, 10, "2024-01-01", "2024-02-01")
+    halves = [synthetic_api.patents_page(p, 5, "2024-01-01", "2024-02-01") for p in (1, 2)]
+
+    assert page["patents"] == halves[0]["patents"] + halves[1]["patents"]
+    assert page["pagination"]["total_pages"] == 2
+    assert len(page["patents"][0]["description"]) == 100
+
+def test_synthetic_api_serves_prerendered_pages(synthetic_api):
+    synthetic_api.prerender(10, date(2024, 1, 1), date(2024, 2, 1))
+    payload = {"grant_from_date": "2024-01-01", "grant_to_date": "2024-02-01", "pagination": {"page": 2, "page_size": 10}}
+    response = requests.post(f"{synthetic_api.url}/patents", json=payload)
+
+    assert response.json() == synthetic_api.patents_page(2, 10, "2024-01-01", "2024-02-01")
+
+def test_synthetic_api_error_rate(synthetic_api):
+    synthetic_api.config.error_rate = 1.0
+    payload = {"grant_from_date": "2024-01-01", "grant_to_date": "2024-02-01", "pagination": {"page": 1, "page_size": 10}}
+
+    assert requests.post(f"{synthetic_api.url}/patents", json=payload).status_code == 500
+    assert synthetic_api.errors == 1
+
+def test_compare_flags_regressions():
+    baseline = BenchmarkReport(config=BenchmarkConfig(), results={"ndjson": _result(1000), "sqlite": _result(1000)})
+    report = BenchmarkReport(config=BenchmarkConfig(), results={
+        "ndjson": _result(700),
+        "sqlite": _result(2000, p50=0.1, peak_rss_bytes=200),
+        "local": _result(10)
+    })
+
+    regressions = compare(report, baseline, tolerance=0.2)
+    assert len(regressions) == 3
+    assert regressions[0].startswith("ndjson: 700 items/s")
+    # improvements and sinks without a baseline are never regressions
+    assert not any(regression.startswith("local") for regression in regressions)
+
+def test_compare_needs_same_config():
+    with pytest.raises(ValueError):
+        compare(BenchmarkReport(config=BenchmarkConfig(page_size=10)), BenchmarkReport(config=BenchmarkConfig()), 0.2)
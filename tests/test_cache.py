@@ -0,0 +1,99 @@
+﻿from datetime import date, timedelta
+
+import pytest
+
+from patent_fetcher.clients.cache import PageCache
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.constants import CacheMode
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.patent_client import PatentsClientRequest
+
+
+@pytest.fixture
+def page_cache(tmp_path) -> PageCache:
+    cache = PageCache(str(tmp_path / "cache.db"), ttl_seconds=60, max_bytes=100)
+    yield cache
+    cache.close()
+
+def _api_request(page: int = 1, page_size: int = 5) -> PatentsApiRequest:
+    return PatentsApiRequest(
+        grant_from_date=date(2024, 1, 1),
+        grant_to_date=date(2024, 1, 2),
+        pagination=PatentsApiRequestPage(page=page, page_size=page_size)
+    )
+
+
+def test_key_is_canonical():
+    assert PageCache.key(_api_request()) == PageCache.key(_api_request())
+    assert PageCache.key(_api_request()) != PageCache.key(_api_request(page=2))
+    assert PageCache.key(_api_request()) != PageCache.key(_api_request(page_size=6))
+
+def test_get_put(page_cache):
+    assert page_cache.get("key") is None
+    page_cache.put("key", "body")
+    assert page_cache.get("key") == "body"
+
+def test_get_expired(page_cache, monkeypatch):
+    page_cache.put("key", "body")
+    monkeypatch.setattr(page_cache, "ttl_seconds", -1)
+    assert page_cache.get("key") is None
+
+def test_lru_eviction(page_cache):
+    page_cache.put("a", "x" * 40)
+    page_cache.put("b", "x" * 40)
+    page_cache.get("a")  # b is now the least recently used
+    page_cache.put("c", "x" * 40)
+
+    assert page_cache.size() <= 100
+    assert page_cache.get("b") is None
+    assert page_cache.get("a") is not None
+    assert page_cache.get("c") is not None
+
+def test_oversized_body_not_cached(page_cache):
+    page_cache.put("key", "x" * 101)
+    assert page_cache.get("key") is None
+
+def test_prune(page_cache, monkeypatch):
+    page_cache.put("a", "x")
+    page_cache.put("b", "x")
+    monkeypatch.setattr(page_cache, "ttl_seconds", -1)
+    assert page_cache.prune() == 2
+    assert page_cache.size() == 0
+
+@pytest.mark.parametrize("cache_mode, expected_hits, expected_requests", [
+    (CacheMode.USE, 5, 0),
+    (CacheMode.BYPASS, 0, 5),
+    (CacheMode.REFRESH, 0, 5),
+])
+def test_fetch_patents_rerun(fake_patents_api, cache_mode, expected_hits, expected_requests):
+    request = PatentsClientRequest(api_request=_api_request(), output_client=None, concurrency=2)
+    with PatentClient() as client:
+        first = client.fetch_patents(request)
+    assert first.cache_misses == 5
+
+    fake_patents_api.requests.clear()
+    with PatentClient() as client:
+        second = client.fetch_patents(request.model_copy(update={"cache_mode": cache_mode}))
+
+    assert second.total_items_fetched == first.total_items_fetched == 25
+    assert second.cache_hits == expected_hits
+    assert len(fake_patents_api.requests) == expected_requests
+
+def test_pages_reaching_today_not_cached(fake_patents_api):
+    # Patents may still be granted today, so those pages are always fetched
+    today = date.today()
+    api_request = PatentsApiRequest(
+        grant_from_date=today - timedelta(days=1),
+        grant_to_date=today + timedelta(days=1),
+        pagination=PatentsApiRequestPage(page_size=5)
+    )
+    assert not PageCache.cacheable(api_request)
+    assert PageCache.cacheable(_api_request())
+
+    request = PatentsClientRequest(api_request=api_request, output_client=None)
+    with PatentClient() as client:
+        client.fetch_patents(request)
+        fake_patents_api.requests.clear()
+        response = client.fetch_patents(request)
+    assert response.cache_hits == response.cache_misses == 0
+    assert len(fake_patents_api.requests) == 5
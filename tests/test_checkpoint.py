@@ -0,0 +1,242 @@
+﻿from datetime import date, timedelta
+
+import sqlite3
+
+import pytest
+
+from patent_fetcher.clients.checkpoint import Checkpoint, CheckpointStore
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient, read_patents
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import FailedPage, PatentsClientRequest, PatentsClientResponse
+from patent_fetcher.settings import cli_settings
+
+
+def _client_request(**kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=5)
+        ),
+        **{"output_client": None, **kwargs}
+    )
+
+@pytest.fixture
+def checkpoint_store(tmp_path) -> CheckpointStore:
+    store = CheckpointStore(str(tmp_path / "state.db"))
+    yield store
+    store.close()
+
+
+def test_fingerprint_ignores_execution_options():
+    assert CheckpointStore.fingerprint(_client_request()) == CheckpointStore.fingerprint(_client_request(concurrency=4))
+    assert CheckpointStore.fingerprint(_client_request()) != CheckpointStore.fingerprint(_client_request(num_pages=2))
+
+def test_save_get_clear(checkpoint_store):
+    request = _client_request()
+    fingerprint = CheckpointStore.fingerprint(request)
+    assert checkpoint_store.get(fingerprint) is None
+
+    checkpoint_store.save(fingerprint, Checkpoint(3, 10), request)
+    checkpoint_store.save(fingerprint, Checkpoint(5, 10), request)
+    assert checkpoint_store.get(fingerprint) == Checkpoint(5, 10)
+
+    checkpoint_store.clear(fingerprint)
+    assert checkpoint_store.get(fingerprint) is None
+
+def test_resume_after_failure(fake_patents_api, monkeypatch):
+    # 10 pages of 5, flushing every 2 pages
+    fake_patents_api.total_items = 50
+    fake_patents_api.fail_pages = {8}
+    # not worth retrying, so the run stops there rather than setting the page aside
+    fake_patents_api.fail_status = 400
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+
+    flushed = []
+    def _flush(_, patents):
+        flushed.extend(p.patent_number for p in patents)
+        return OutputClientResponse(num_items_outputted=len(patents))
+
+    with PatentClient() as client:
+        client._flush_patent_buffer = _flush
+        with pytest.raises(ValueError):
+            client.fetch_patents(_client_request(concurrency=2))
+        # pages 1-6 flushed on schedule, page 7 flushed on failure
+        assert client.checkpoints.get(CheckpointStore.fingerprint(_client_request())) == Checkpoint(7, 10)
+
+        fake_patents_api.fail_pages = set()
+        fake_patents_api.requests.clear()
+        # bypassing the cache, since page 9 may well have been fetched (and cached) before page 8 failed
+        response = client.fetch_patents(_client_request(resume=True, cache_mode="bypass"))
+
+    assert sorted(r["pagination"]["page"] for r in fake_patents_api.requests) == [8, 9, 10]
+    assert response.total_pages_fetched == 3
+    # every patent written exactly once across both runs
+    assert sorted(flushed) == [f"US{i:08d}" for i in range(50)]
+
+def test_resume_after_crash(fake_patents_api, tmp_path, monkeypatch):
+    # 10 pages of 5, flushing every 2 pages to one ndjson file
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path / "out"))
+    save_sink = CheckpointStore.save_sink
+
+    def _crash_before_recording_page_6(self, fingerprint, sink, last_page, position=None):
+        if last_page == 6:
+            # not an Exception, so nothing is closed - like the process dying once the batch is written
+            raise KeyboardInterrupt
+        save_sink(self, fingerprint, sink, last_page, position)
+
+    request = _client_request(output_client=NdjsonOutputClient)
+    with PatentClient() as client:
+        monkeypatch.setattr(CheckpointStore, "save_sink", _crash_before_recording_page_6)
+        with pytest.raises(KeyboardInterrupt):
+            client.fetch_patents(request)
+        monkeypatch.setattr(CheckpointStore, "save_sink", save_sink)
+        assert [p.name.endswith(".tmp") for p in (tmp_path / "out").iterdir()] == [True]
+
+        response = client.fetch_patents(request.model_copy(update={"resume": True}))
+
+    files = sorted((tmp_path / "out").iterdir())
+    assert response.total_pages_fetched == 6
+    assert not [p for p in files if p.name.endswith(".tmp")]
+    # the batch of pages 5-6 was cut from the crashed run's file, so every patent is there exactly once
+    assert sorted(p.patent_number for p in read_patents(*files)) == [f"US{i:08d}" for i in range(50)]
+
+def test_resume_after_crash_from_sqlite_checkpoint(fake_patents_api, tmp_path, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    monkeypatch.setattr(cli_settings, "sqlite_db", str(tmp_path / "patents.db"))
+    save_sink = CheckpointStore.save_sink
+
+    def _crash_before_recording_page_6(self, fingerprint, sink, last_page, position=None):
+        if last_page == 6:
+            raise KeyboardInterrupt
+        save_sink(self, fingerprint, sink, last_page, position)
+
+    request = _client_request(output_client=SQLiteOutputClient)
+    fingerprint = CheckpointStore.fingerprint(request)
+    with PatentClient() as client:
+        monkeypatch.setattr(CheckpointStore, "save_sink", _crash_before_recording_page_6)
+        with pytest.raises(KeyboardInterrupt):
+            client.fetch_patents(request)
+        monkeypatch.setattr(CheckpointStore, "save_sink", save_sink)
+        assert client.checkpoints.sink_pages(fingerprint) == {"SQLiteOutputClient": 4}
+
+        # the batch of pages 5-6 was committed along with its checkpoint, so it isn't written again
+        response = client.fetch_patents(request.model_copy(update={"resume": True}))
+
+    assert response.total_pages_fetched == 4
+    with sqlite3.connect(tmp_path / "patents.db") as conn:
+        assert conn.execute("SELECT count(*) FROM patent").fetchone() == (50,)
+        assert conn.execute("SELECT last_page FROM fetch_checkpoint").fetchall() == [(10,)]
+
+def test_resume_completed_run(fake_patents_api):
+    with PatentClient() as client:
+        client.fetch_patents(_client_request())
+        fake_patents_api.requests.clear()
+        response = client.fetch_patents(_client_request(resume=True))
+
+    assert response.total_pages_fetched == 0
+    assert fake_patents_api.requests == []
+
+def test_fetch_without_resume_starts_over(fake_patents_api):
+    with PatentClient() as client:
+        client.fetch_patents(_client_request())
+        response = client.fetch_patents(_client_request(cache_mode="bypass"))
+
+    assert response.total_pages_fetched == 5
+
+def test_failed_pages_set_aside_and_refetched(fake_patents_api, monkeypatch):
+    # 10 pages of 5, page 4 failing every retry
+    fake_patents_api.total_items = 50
+    fake_patents_api.fail_pages = {4}
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    monkeypatch.setattr(cli_settings, "page_retry_backoff_seconds", 0)
+
+    flushed = []
+    def _flush(_, patents):
+        flushed.extend(p.patent_number for p in patents)
+        return OutputClientResponse(num_items_outputted=len(patents))
+
+    with PatentClient() as client:
+        client._flush_patent_buffer = _flush
+        response = client.fetch_patents(_client_request(concurrency=3))
+        fingerprint = CheckpointStore.fingerprint(_client_request())
+
+        # the rest of the run carried on past the failed page
+        assert [p.page for p in response.failed_pages] == [4]
+        assert response.total_pages_fetched == 9
+        assert len(flushed) == 45
+        assert client.checkpoints.get(fingerprint) == Checkpoint(10, 10)
+        assert [r["pagination"]["page"] for r in fake_patents_api.requests].count(4) == cli_settings.page_retries + 1
+
+        fake_patents_api.fail_pages = set()
+        fake_patents_api.requests.clear()
+        response = client.fetch_failed_pages()
+
+        assert [r["pagination"]["page"] for r in fake_patents_api.requests] == [4]
+        assert response.total_pages_fetched == 1
+        assert response.failed_pages == []
+        assert client.checkpoints.failed_pages() == {}
+
+    assert sorted(flushed) == [f"US{i:08d}" for i in range(50)]
+
+def test_failed_pages_kept_when_failing_again(checkpoint_store, fake_patents_api, monkeypatch):
+    monkeypatch.setattr(cli_settings, "page_retries", 0)
+    request = _client_request()
+    fingerprint = CheckpointStore.fingerprint(request)
+    checkpoint_store.add_failed_page(fingerprint, FailedPage(page=2, grant_from_date=date(2024, 1, 1), grant_to_date=date(2024, 1, 2), error="first"), request)
+    fake_patents_api.fail_pages = {2}
+
+    with PatentClient() as client:
+        response = client.fetch_failed_pages()
+
+    assert [p.page for p in response.failed_pages] == [2]
+    stored_request, pages = checkpoint_store.failed_pages()[fingerprint]
+    assert pages == [2]
+    assert stored_request == request
+
+def test_sync_mark_only_moves_forward(checkpoint_store):
+    assert checkpoint_store.sync_mark("NdjsonOutputClient") is None
+    checkpoint_store.save_sync_mark("NdjsonOutputClient", date(2024, 1, 10))
+    checkpoint_store.save_sync_mark("NdjsonOutputClient", date(2024, 1, 5))
+    assert checkpoint_store.sync_mark("NdjsonOutputClient") == date(2024, 1, 10)
+
+def test_sync_from_mark(fake_patents_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path))
+    with PatentClient() as client:
+        with pytest.raises(ValueError):
+            client.sync_patents(NdjsonOutputClient)
+
+        response = client.sync_patents(NdjsonOutputClient, since=date(2024, 1, 1), page_size=10)
+        assert response.total_items_outputted == 25
+        assert fake_patents_api.requests[0]["grant_from_date"] == "2024-01-01"
+        assert fake_patents_api.requests[0]["grant_to_date"] == date.today().isoformat()
+        # the fake api grants its 25 patents on Jan 1st to 25th
+        assert client.checkpoints.sync_mark("NdjsonOutputClient") == date(2024, 1, 25)
+
+        fake_patents_api.requests.clear()
+        client.sync_patents(NdjsonOutputClient, since=date(2024, 1, 1), overlap_days=3)
+        assert fake_patents_api.requests[0]["grant_from_date"] == "2024-01-22"
+
+def test_sync_up_to_date(fake_patents_api, checkpoint_store):
+    checkpoint_store.save_sync_mark("NdjsonOutputClient", date.today() + timedelta(days=1))
+    with PatentClient() as client:
+        assert client.sync_patents(NdjsonOutputClient, overlap_days=0) == PatentsClientResponse()
+    assert fake_patents_api.requests == []
+
+def test_sync_mark_kept_on_failed_pages(fake_patents_api, checkpoint_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path))
+    monkeypatch.setattr(cli_settings, "page_retries", 0)
+    fake_patents_api.fail_pages = {2}
+    checkpoint_store.save_sync_mark("NdjsonOutputClient", date(2024, 1, 3))
+
+    with PatentClient() as client:
+        response = client.sync_patents(NdjsonOutputClient, overlap_days=2, page_size=10)
+
+    assert [p.page for p in response.failed_pages] == [2]
+    assert checkpoint_store.sync_mark("NdjsonOutputClient") == date(2024, 1, 3)
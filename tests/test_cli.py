@@ -1,13 +1,16 @@
-﻿from unittest.mock import patch
+﻿from datetime import date
+from unittest.mock import patch
 
 import pytest
 from click.testing import CliRunner
 
-from patent_fetcher.cli import fetch_patents, check_health
+from patent_fetcher.cli import fetch_patents, check_health, search, sync
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
 
 
-@patch("patent_fetcher.cli.PatentsClientRequest", autospec=True)
-@patch("patent_fetcher.cli.PatentClient", autospec=True)
+@patch("patent_fetcher.models.patent_client.PatentsClientRequest", autospec=True)
+@patch("patent_fetcher.clients.patent_client.PatentClient", autospec=True)
 def test_fetch_patents_valid_default(mock_client, mock_request):
     result = CliRunner().invoke(fetch_patents, ["2024-01-01", "2024-01-02"])
     mock_request.assert_called_once()
@@ -16,6 +19,28 @@ def test_fetch_patents_valid_default(mock_client, mock_request):
 
     assert result.exit_code == 0
 
+@patch("patent_fetcher.models.patent_client.PatentsClientRequest", autospec=True)
+@patch("patent_fetcher.clients.patent_client.PatentClient", autospec=True)
+def test_fetch_patents_multiple_outputs(mock_client, mock_request):
+    result = CliRunner().invoke(fetch_patents, ["2024-01-01", "2024-01-02", "--output", "ndjson", "--output", "sqlite"])
+    assert mock_request.call_args.kwargs["output_client"] == [NdjsonOutputClient, SQLiteOutputClient]
+
+    assert result.exit_code == 0
+
+@patch("patent_fetcher.clients.patent_client.PatentClient", autospec=True)
+def test_sync(mock_client):
+    result = CliRunner().invoke(sync, ["--output", "sqlite", "--since", "2024-01-01", "--overlap_days", "3"])
+    sync_patents = mock_client.return_value.sync_patents
+    sync_patents.assert_called_once()
+    assert sync_patents.call_args.args == ([SQLiteOutputClient],)
+    assert sync_patents.call_args.kwargs["since"] == date(2024, 1, 1)
+    assert sync_patents.call_args.kwargs["overlap_days"] == 3
+
+    assert result.exit_code == 0
+
+def test_sync_requires_output():
+    assert CliRunner().invoke(sync, []).exit_code != 0
+
 @pytest.mark.skip(reason="Full test coverage would check all inputs / edge cases, consciously skipped for brevity")
 def test_fetch_patents_valid():
     pass
@@ -36,10 +61,21 @@ def test_fetch_patents_invalid_page():
     # test edge cases for dates - such as bad formatting, start/end date overlap, etc
     pass
 
-@patch("patent_fetcher.cli.PatentClient", autospec=True)
+@patch("patent_fetcher.clients.patent_client.PatentClient", autospec=True)
 def test_check_health(mock_client):
     result = CliRunner().invoke(check_health)
     mock_client.assert_called_once()
     mock_client.return_value.check_health.assert_called_once()
 
     assert result.exit_code == 0
+
+
+@patch("patent_fetcher.clients.output.sqlite.SQLiteOutputClient", autospec=True)
+def test_search(mock_client):
+    result = CliRunner().invoke(search, ["battery", "--assignee", "Acme", "--start_date", "2024-01-01", "--sqlite_db", "patents.db"])
+    mock_client.search.assert_called_once()
+    assert mock_client.search.call_args.args == ("patents.db",)
+    assert mock_client.search.call_args.kwargs["text"] == "battery"
+    assert mock_client.search.call_args.kwargs["assignee"] == "Acme"
+
+    assert result.exit_code == 0
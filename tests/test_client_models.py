@@ -4,6 +4,7 @@ import pytest
 from pydantic import ValidationError
 
 from patent_fetcher.clients.output.local import LocalOutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
 from patent_fetcher.models.api import (
     PatentsApiRequestPage,
     PatentsApiRequest
@@ -46,6 +47,21 @@ def test_patents_client_request_serializer(valid_patents_api_request):
     client = PatentsClientRequest(api_request=valid_patents_api_request, output_client=None)
     assert not client.model_dump().get("output_client")
 
+    client = PatentsClientRequest(api_request=valid_patents_api_request, output_client=[LocalOutputClient, SQLiteOutputClient])
+    assert client.model_dump().get("output_client") == "LocalOutputClient,SQLiteOutputClient"
+    assert client.output_clients == [LocalOutputClient, SQLiteOutputClient]
+
+def test_patents_client_request_output_names(valid_patents_api_request):
+    # output names like --output takes, eg in a job submitted to the serve daemon
+    client = PatentsClientRequest(api_request=valid_patents_api_request, output_client="local,sqlite")
+    assert client.output_clients == [LocalOutputClient, SQLiteOutputClient]
+    client = PatentsClientRequest(api_request=valid_patents_api_request, output_client=["sqlite"])
+    assert client.output_clients == [SQLiteOutputClient]
+
+def test_patents_client_request_duplicate_outputs(valid_patents_api_request):
+    with pytest.raises(ValidationError):
+        PatentsClientRequest(api_request=valid_patents_api_request, output_client=[LocalOutputClient, LocalOutputClient])
+
 def test_patents_client_request_invalid(valid_patents_api_request):
     with pytest.raises(ValidationError):
         PatentsClientRequest(api_request=valid_patents_api_request, start_page=-1)
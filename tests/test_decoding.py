@@ -0,0 +1,120 @@
+﻿import gc
+import json
+import time
+import tracemalloc
+
+import pytest
+from pydantic import ValidationError
+
+from patent_fetcher.models.api import PatentRecord, PatentsApiResponse, decode_patents_page
+
+"""
+Micro-benchmarks for page decoding - the legacy path (response.json() then model_validate) against validating the raw
+body directly, and Patent models against compact PatentRecords. Run with `pytest -s tests/test_decoding.py` to see
+the numbers.
+"""
+
+
+def _synthetic_page(num_patents: int = 1000) -> bytes:
+    # Sized roughly like a real page - long descriptions and a couple of dozen claims per patent
+    return json.dumps({
+        "patents": [
+            {
+                "patent_number": f"US{i:08d}",
+                "title": f"Synthetic patent title {i} " * 4,
+                "grant_date": "2024-01-02",
+                "abstract": "abstract text " * 80,
+                "claims": [f"claim {c} " * 40 for c in range(20)],
+                "assignees": ["Assignee Corp", "Other Assignee LLC"],
+                "inventors": ["Inventor One", "Inventor Two", "Inventor Three"],
+                "description": "description text " * 1200,
+            }
+            for i in range(num_patents)
+        ],
+        "pagination": {"page": 1, "page_size": num_patents, "total_pages": 1, "total_items": num_patents},
+    }).encode("utf-8")
+
+def _legacy_decode(raw: bytes) -> PatentsApiResponse:
+    return PatentsApiResponse.model_validate(json.loads(raw))
+
+def _measure(decode, raw: bytes, repeat: int = 3) -> tuple[float, int]:
+    # Best-of wall time, and peak traced allocations of a single decode
+    best = min(_timed(decode, raw) for _ in range(repeat))
+    tracemalloc.start()
+    decode(raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def _timed(decode, raw: bytes) -> float:
+    start = time.perf_counter()
+    decode(raw)
+    return time.perf_counter() - start
+
+
+def test_decode_matches_legacy():
+    raw = _synthetic_page(10)
+    assert decode_patents_page(raw) == _legacy_decode(raw)
+    assert decode_patents_page(raw, strict=True) == _legacy_decode(raw)
+
+def test_decode_strict_rejects_coercion():
+    page = json.loads(_synthetic_page(1))
+    page["pagination"]["page"] = "1"
+    raw = json.dumps(page)
+
+    assert decode_patents_page(raw).pagination.page == 1
+    with pytest.raises(ValidationError):
+        decode_patents_page(raw, strict=True)
+
+def test_decode_benchmark(record_property):
+    raw = _synthetic_page()
+    results = {
+        "legacy": _measure(_legacy_decode, raw),
+        "fast": _measure(decode_patents_page, raw),
+        "fast_strict": _measure(lambda r: decode_patents_page(r, strict=True), raw),
+    }
+    for name, (seconds, peak) in results.items():
+        print(f"\n{name}: {seconds * 1000:.1f}ms, peak {peak / 1024 ** 2:.1f}MiB for a {len(raw) / 1024 ** 2:.1f}MiB page")
+        record_property(name, {"seconds": seconds, "peak_bytes": peak})
+
+    # Timings are only reported (too noisy to assert on shared machines), the memory saving is structural
+    assert results["fast"][1] < results["legacy"][1] * 0.75
+
+def test_decode_compact_matches():
+    raw = _synthetic_page(10)
+    compact = decode_patents_page(raw, compact=True)
+    assert all(isinstance(p, PatentRecord) for p in compact.patents)
+    assert [p.to_patent() for p in compact.patents] == decode_patents_page(raw).patents
+
+def test_compact_record_benchmark(record_property):
+    # Distinct short strings, so the per-item container overhead is what gets measured rather than the text itself
+    raw = json.dumps({
+        "patents": [
+            {
+                "patent_number": f"US{i:08d}",
+                "title": f"title {i}",
+                "grant_date": "2024-01-02",
+                "abstract": f"abstract {i}",
+                "claims": [f"claim {i}.{c}" for c in range(20)],
+                "assignees": [f"assignee {i}", f"assignee {i}b"],
+                "inventors": [f"inventor {i}", f"inventor {i}b", f"inventor {i}c"],
+                "description": f"description {i}",
+            }
+            for i in range(1000)
+        ],
+        "pagination": {"page": 1, "page_size": 1000, "total_pages": 1, "total_items": 1000},
+    }).encode("utf-8")
+
+    results = {}
+    for name, compact in [("patent", False), ("record", True)]:
+        seconds = min(_timed(lambda r: decode_patents_page(r, compact=compact), raw) for _ in range(3))
+        gc.collect()
+        tracemalloc.start()
+        page = decode_patents_page(raw, compact=compact)
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = (seconds, retained / len(page.patents))
+        print(f"\n{name}: build {seconds * 1000:.1f}ms per 1000, {retained / len(page.patents):.0f} bytes retained per item")
+        record_property(name, {"seconds": seconds, "bytes_per_item": retained / len(page.patents)})
+
+    assert results["record"][1] < results["patent"][1] * 0.85
@@ -0,0 +1,31 @@
+﻿import pytest
+
+from patent_fetcher.clients.dedup import BloomDeduplicator, ExactDeduplicator, make_deduplicator
+from patent_fetcher.constants import DedupMode
+
+
+@pytest.mark.parametrize("deduplicator", [ExactDeduplicator(), BloomDeduplicator(capacity=100, error_rate=1e-4)])
+def test_deduplicator_add(deduplicator):
+    assert not deduplicator.add("US1")
+    assert deduplicator.add("US1")
+    assert not deduplicator.add("US2")
+
+def test_bloom_deduplicator_false_positive_rate():
+    # sized for the probes too, as each one is added
+    deduplicator = BloomDeduplicator(capacity=20_000, error_rate=1e-3)
+    for i in range(10_000):
+        deduplicator.add(f"seen_{i}")
+    false_positives = sum(deduplicator.add(f"unseen_{i}") for i in range(10_000))
+    # generous margin over the 10 expected at most
+    assert false_positives < 50
+
+@pytest.mark.parametrize("mode, expected_items, expected_type", [
+    (DedupMode.OFF, 10, type(None)),
+    (DedupMode.EXACT, 10_000, ExactDeduplicator),
+    (DedupMode.BLOOM, 10, BloomDeduplicator),
+    (DedupMode.AUTO, 1_000, ExactDeduplicator),
+    (DedupMode.AUTO, 1_001, BloomDeduplicator),
+])
+def test_make_deduplicator(mode, expected_items, expected_type):
+    deduplicator = make_deduplicator(mode, expected_items, exact_max_items=1_000, error_rate=1e-4)
+    assert type(deduplicator) is expected_type
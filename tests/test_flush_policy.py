@@ -0,0 +1,92 @@
+﻿from datetime import date
+
+from patent_fetcher.clients.flush_policy import (
+    AnyFlushPolicy,
+    MaxAgePolicy,
+    MaxBytesPolicy,
+    MaxItemsPolicy,
+    approximate_size,
+    make_flush_policy
+)
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.models.api import Patent, PatentRecord, PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+
+def _patent(description: str = "description") -> Patent:
+    return Patent(
+        patent_number="US1",
+        title="title",
+        grant_date=date(2024, 1, 1),
+        abstract="abstract",
+        claims=["claim 1", "claim 2"],
+        assignees=["assignee"],
+        inventors=["inventor"],
+        description=description
+    )
+
+def test_approximate_size():
+    small, large = _patent(), _patent("x" * 10_000)
+    assert approximate_size(large) - approximate_size(small) == 10_000 - len("description")
+    assert approximate_size(PatentRecord.from_patent(small)) == approximate_size(small)
+
+def test_max_items_policy():
+    policy = MaxItemsPolicy(3)
+    policy.add([_patent()] * 2)
+    assert not policy.should_flush()
+    policy.add([_patent()])
+    assert policy.should_flush()
+    policy.reset()
+    assert not policy.should_flush()
+
+def test_max_bytes_policy():
+    policy = MaxBytesPolicy(max_bytes=20_000)
+    policy.add([_patent()] * 10)
+    assert not policy.should_flush()
+    policy.add([_patent("x" * 20_000)])
+    assert policy.should_flush()
+
+def test_max_age_policy():
+    now = [100.0]
+    policy = MaxAgePolicy(max_age_seconds=5, clock=lambda: now[0])
+    policy.add([])
+    now[0] += 10
+    # nothing buffered yet, so nothing is old
+    assert not policy.should_flush()
+
+    policy.add([_patent()])
+    now[0] += 4
+    policy.add([_patent()])
+    assert not policy.should_flush()
+    now[0] += 1
+    assert policy.should_flush()
+    policy.reset()
+    assert not policy.should_flush()
+
+def test_make_flush_policy():
+    assert type(make_flush_policy(10)) is MaxItemsPolicy
+    policy = make_flush_policy(10, max_bytes=1_000, max_age_seconds=60)
+    assert isinstance(policy, AnyFlushPolicy)
+    policy.add([_patent()] * 2)
+    # the byte budget is reached well before the item count
+    assert policy.should_flush()
+
+def test_fetch_patents_flushes_on_byte_budget(fake_patents_api, monkeypatch):
+    monkeypatch.setattr(cli_settings, "buffer_max_bytes", 5_000)
+    flushed = []
+    request = PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=5)
+        )
+    )
+    with PatentClient() as client:
+        client._flush_patent_buffer = lambda _, patents: flushed.append(len(patents)) or OutputClientResponse(num_items_outputted=len(patents))
+        response = client.fetch_patents(request)
+
+    # each page of 5 is about 4kb, so every other page is a flush - well short of BUFFER_SIZE
+    assert flushed == [10, 10, 5]
+    assert response.total_items_outputted == 25
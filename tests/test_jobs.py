@@ -0,0 +1,158 @@
+﻿import http.client
+import json
+import socket
+import stat
+import threading
+import time
+from datetime import date
+
+import pytest
+
+from patent_fetcher.clients.jobs import JobRunner
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.constants import CacheMode, JobStatus
+from patent_fetcher.exceptions import JobQueueFullError
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.jobs import FetchJob
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.server import JobServer, UnixJobServer
+from patent_fetcher.settings import cli_settings
+
+JOB = {
+    "api_request": {"grant_from_date": "2024-01-01", "grant_to_date": "2024-01-02", "pagination": {"page_size": 10}},
+    "output_client": "ndjson",
+}
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path))
+    return tmp_path
+
+
+def _request(**kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=10)
+        ),
+        **kwargs
+    )
+
+
+def _wait(runner: JobRunner, job_id: str, timeout: float = 10) -> FetchJob:
+    deadline = time.monotonic() + timeout
+    while not (job := runner.get(job_id)).finished:
+        assert time.monotonic() < deadline, f"job {job_id} still {job.status}"
+        time.sleep(0.01)
+    return job
+
+
+def test_health_check_reused_within_ttl(fake_patents_api, output_dir):
+    with PatentClient(health_check_ttl=60) as client:
+        first = client.fetch_patents(_request(output_client=None, cache_mode=CacheMode.BYPASS))
+        second = client.fetch_patents(_request(output_client=None, cache_mode=CacheMode.BYPASS))
+
+    # 3 pages, and a health check for the first run only
+    assert first.metrics.counters["requests"] == 4
+    assert second.metrics.counters["requests"] == 3
+
+def test_job_runner_runs_jobs(fake_patents_api, output_dir):
+    with JobRunner(workers=2, queue_size=5) as runner:
+        ids = [runner.submit(_request(output_client=NdjsonOutputClient)).id for _ in range(3)]
+        jobs = [_wait(runner, job_id) for job_id in ids]
+        fake_patents_api.fail_pages, fake_patents_api.fail_status = {1}, 400
+        failing = _wait(runner, runner.submit(_request(cache_mode=CacheMode.BYPASS)).id)
+
+    assert [job.status for job in jobs] == [JobStatus.SUCCEEDED] * 3
+    assert all(job.response.total_items_outputted == 25 for job in jobs)
+    assert all(job.started_at >= job.submitted_at and job.finished_at >= job.started_at for job in jobs)
+    assert failing.status == JobStatus.FAILED
+    assert failing.error
+
+def test_job_runner_queue_is_bounded():
+    runner = JobRunner(workers=1, queue_size=1)
+    queued = runner.submit(_request())
+    with pytest.raises(JobQueueFullError):
+        runner.submit(_request())
+    # never started, so the queued job is cancelled on stop
+    runner.stop()
+    assert runner.get(queued.id).status == JobStatus.CANCELLED
+
+def test_job_runner_drops_oldest_finished_jobs(fake_patents_api, output_dir):
+    with JobRunner(workers=1, max_jobs=2) as runner:
+        ids = [runner.submit(_request(output_client=None)).id for _ in range(3)]
+        _wait(runner, ids[-1])
+        assert [job.id for job in runner.jobs()] == ids[1:]
+        assert runner.get(ids[0]) is None
+
+def test_job_server_http(fake_patents_api, output_dir):
+    with JobRunner(workers=1) as runner:
+        server = JobServer(runner)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=10)
+        try:
+            conn.request("POST", "/jobs", body=json.dumps(JOB))
+            response = conn.getresponse()
+            assert response.status == 202
+            job_id = json.loads(response.read())["id"]
+
+            _wait(runner, job_id)
+            conn.request("GET", f"/jobs/{job_id}")
+            job = json.loads(conn.getresponse().read())
+            assert job["status"] == "succeeded"
+            assert job["request"]["output_client"] == "NdjsonOutputClient"
+            assert job["response"]["total_items_outputted"] == 25
+
+            conn.request("GET", "/jobs")
+            assert [j["id"] for j in json.loads(conn.getresponse().read())["jobs"]] == [job_id]
+
+            conn.request("POST", "/jobs", body=json.dumps({**JOB, "output_client": "nowhere"}))
+            response = conn.getresponse()
+            assert response.status == 400
+            assert "nowhere" in response.read().decode()
+
+            conn.request("GET", "/jobs/unknown")
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 404
+        finally:
+            conn.close()
+            server.shutdown()
+            server.server_close()
+
+def test_job_server_unix_socket(tmp_path):
+    path = str(tmp_path / "jobs.sock")
+    server = UnixJobServer(JobRunner(workers=1), path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(b"GET /health HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            raw = b"".join(iter(lambda: sock.recv(65536), b""))
+        head, body = raw.split(b"\r\n\r\n", 1)
+        assert head.startswith(b"HTTP/1.1 200")
+        assert json.loads(body)["status"] == "healthy"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_job_server_unix_socket_permissions(tmp_path):
+    path = tmp_path / "jobs.sock"
+    path.write_text("not a socket")
+    with pytest.raises(FileExistsError):
+        UnixJobServer(JobRunner(workers=1), str(path))
+    assert path.read_text() == "not a socket"
+
+    path.unlink()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(str(path)) # left behind as if by a daemon that didn't shut down cleanly
+    server = UnixJobServer(JobRunner(workers=1), str(path))
+    try:
+        assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    finally:
+        server.server_close()
+    assert not path.exists()
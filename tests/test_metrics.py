@@ -0,0 +1,89 @@
+﻿import json
+from datetime import date
+
+import pytest
+
+from patent_fetcher.clients.metrics import MetricsRecorder, write_metrics
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.metrics import RunMetrics
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+
+def test_histogram_quantiles():
+    recorder = MetricsRecorder(bounds=(0.1, 1.0))
+    for seconds in [0.05] * 98 + [0.5, 2.0]:
+        recorder.observe("request_seconds", seconds)
+    histogram = recorder.snapshot().histogram("request_seconds")
+
+    assert histogram.counts == [98, 1, 1]
+    assert histogram.count == 100
+    assert histogram.max == 2.0
+    assert 0 < histogram.p50 <= 0.1
+    assert 0.1 < histogram.p99 <= 1.0
+
+def test_merge_adds_up_side_by_side_runs():
+    first, second = MetricsRecorder(bounds=(1.0,)), MetricsRecorder(bounds=(1.0,))
+    first.observe("flush_seconds", 0.5, sink="a")
+    second.observe("flush_seconds", 2.0, sink="a")
+    second.observe("flush_seconds", 0.5, sink="b")
+    first.count("bytes_received", 10)
+    second.count("bytes_received", 5)
+
+    merged = RunMetrics.merge([first.snapshot(), second.snapshot()])
+    assert merged.histogram("flush_seconds", sink="a").counts == [1, 1]
+    assert merged.histogram("flush_seconds", sink="b").count == 1
+    assert merged.counters == {"bytes_received": 15}
+
+def test_to_prometheus():
+    recorder = MetricsRecorder(bounds=(0.1, 1.0))
+    recorder.observe("flush_seconds", 0.05, sink="NdjsonOutputClient")
+    recorder.observe("flush_seconds", 0.5, sink="NdjsonOutputClient")
+    recorder.count("requests", 2)
+    text = recorder.snapshot().to_prometheus()
+
+    assert "patent_fetcher_requests_total 2" in text
+    assert "# TYPE patent_fetcher_flush_seconds histogram" in text
+    assert 'patent_fetcher_flush_seconds_bucket{sink="NdjsonOutputClient",le="0.1"} 1' in text
+    assert 'patent_fetcher_flush_seconds_bucket{sink="NdjsonOutputClient",le="+Inf"} 2' in text
+    assert 'patent_fetcher_flush_seconds_count{sink="NdjsonOutputClient"} 2' in text
+
+@pytest.mark.parametrize("metrics_format", ["json", "prometheus"])
+def test_write_metrics(tmp_path, metrics_format):
+    recorder = MetricsRecorder()
+    recorder.count("requests")
+    recorder.observe("request_seconds", 0.2)
+    path = tmp_path / "metrics"
+    write_metrics(recorder.snapshot(), str(path), metrics_format)
+
+    if metrics_format == "json":
+        assert RunMetrics.model_validate_json(path.read_text()).counters == {"requests": 1}
+        # quantiles are written out for whoever reads the report
+        assert json.loads(path.read_text())["histograms"][0]["p99"] > 0
+    else:
+        assert "patent_fetcher_requests_total 1" in path.read_text()
+
+def test_fetch_patents_reports_metrics(fake_patents_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path))
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    request = PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=5)
+        ),
+        output_client=NdjsonOutputClient
+    )
+    with PatentClient() as client:
+        metrics = client.fetch_patents(request).metrics
+
+    # 1 health check and 5 pages
+    assert metrics.counters["requests"] == 6
+    assert metrics.counters["bytes_received"] > 0
+    assert metrics.histogram("request_seconds").count == 6
+    assert metrics.histogram("decode_seconds").count == 5
+    assert metrics.histogram("flush_seconds", sink="NdjsonOutputClient").count == 3
+    assert metrics.histogram("close_seconds", sink="NdjsonOutputClient").count == 1
+    assert metrics.items_per_second > 0
@@ -1,4 +1,19 @@
-﻿import pytest
+﻿import importlib.metadata
+import sqlite3
+from datetime import date
+from importlib.metadata import EntryPoint
+from pathlib import Path
+
+import pytest
+
+from patent_fetcher.clients.output.local import LocalOutputClient
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient, read_patents
+from patent_fetcher.clients.output.partitioned import PartitionedOutputClient, read_manifest, read_partitions
+from patent_fetcher.clients.output.registry import ENTRY_POINT_GROUP, OutputRegistry
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
+from patent_fetcher.constants import OUTPUT_CLIENT, Output
+from patent_fetcher.models.api import Patent, PatentRecord
+from patent_fetcher.settings import cli_settings
 
 
 # Full test coverage might also include checking logger calls, patching gzip/datetime, forcing gzip to fail, etc
@@ -7,9 +22,26 @@
 def test_local_output_client_creates_file():
     pass
 
-@pytest.mark.skip(reason="LocalOutputClient is only for the demo")
-def test_local_output_client_gzip_error():
-    pass
+def test_local_output_client_gzip_error(tmp_path, monkeypatch):
+    def disk_full(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("patent_fetcher.clients.output.local.gzip.open", disk_full)
+    # Raised so the flush fails and the batch isn't checkpointed as written
+    with pytest.raises(ValueError, match="disk full"):
+        LocalOutputClient().output_patents([_patent("US1")])
+    assert list(tmp_path.iterdir()) == []
+
+def test_local_output_client_recover(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crashed = LocalOutputClient()
+    response = crashed.output_patents([_patent("US1")])
+    # Written but never recorded, then the process dies
+    crashed.output_patents([_patent("US2")])
+
+    LocalOutputClient().recover(response.output_info["position"])
+    assert [p.name for p in tmp_path.iterdir()] == [Path(response.output_info["output_file"]).name]
 
 @pytest.mark.skip(reason="SQLite client is only for the demo")
 def test_sqlite_output_client_db_write():
@@ -17,4 +49,328 @@ def test_sqlite_output_client_db_write():
 
 @pytest.mark.skip(reason="SQLite client is only for the demo")
 def test_sqlite_output_client_connection_error():
-    pass
\ No newline at end of file
+    pass
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    db = str(tmp_path / "patents.db")
+    monkeypatch.setattr(cli_settings, "sqlite_db", db)
+    return db
+
+
+def _patent(number: str, title: str = "title", **kwargs) -> Patent:
+    return Patent(**{
+        "patent_number": number,
+        "title": title,
+        "grant_date": date(2024, 1, 1),
+        "description": "description",
+        "abstract": "abstract",
+        "claims": ["claims"],
+        "assignees": ["assignees"],
+        "inventors": ["inventors"],
+        **kwargs
+    })
+
+
+def test_sqlite_output_client_upserts(sqlite_db):
+    response = SQLiteOutputClient().output_patents([_patent("US1"), _patent("US2")])
+    assert response.num_items_outputted == 2
+
+    # Re-writing an existing patent updates it in place rather than adding a row
+    updated = _patent("US2", title="new title", claims=["claim 1", "claim 2"])
+    response = SQLiteOutputClient().output_patents([updated, _patent("US3")])
+    assert response.num_items_outputted == 2
+
+    conn = sqlite3.connect(sqlite_db)
+    assert conn.execute("SELECT patent_number FROM patent ORDER BY patent_number").fetchall() == [("US1",), ("US2",), ("US3",)]
+    assert conn.execute("SELECT COUNT(*) FROM patent_claim").fetchone()[0] == 4
+    assert conn.execute("SELECT COUNT(*) FROM patent_fts").fetchone()[0] == 3
+    conn.close()
+    assert SQLiteOutputClient.search(sqlite_db, patent_number="US2") == [updated]
+
+
+def test_sqlite_output_client_search(sqlite_db):
+    patents = [
+        _patent("US1", title="Lithium battery", claims=["A cathode"], assignees=["Acme"]),
+        _patent("US2", title="Solar panel", claims=["A lithium coating"], inventors=["Jane Doe"], grant_date=date(2024, 2, 1)),
+        _patent("US3", title="Bicycle", assignees=["Acme", "Other"], grant_date=date(2024, 3, 1)),
+    ]
+    SQLiteOutputClient().output_patents(patents)
+
+    assert {p.patent_number for p in SQLiteOutputClient.search(sqlite_db, text="lithium")} == {"US1", "US2"}
+    assert SQLiteOutputClient.search(sqlite_db, text="lithium", assignee="acme") == [patents[0]]
+    assert SQLiteOutputClient.search(sqlite_db, inventor="JANE DOE") == [patents[1]]
+    assert SQLiteOutputClient.search(sqlite_db, assignee="Acme") == [patents[2], patents[0]]
+    assert SQLiteOutputClient.search(sqlite_db, grant_from_date=date(2024, 2, 1), grant_to_date=date(2024, 3, 1)) == [patents[1]]
+    assert SQLiteOutputClient.search(sqlite_db, limit=1) == [patents[2]]
+    assert SQLiteOutputClient.search(sqlite_db, text="nothing") == []
+
+
+def test_sqlite_output_client_reuses_connection(sqlite_db):
+    with SQLiteOutputClient() as client:
+        client.write_batch([_patent("US1")])
+        conn = client._conn
+        client.write_batch([_patent("US2")])
+        assert client._conn is conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert client._conn is None
+    assert [p.patent_number for p in SQLiteOutputClient.search(sqlite_db)] == ["US1", "US2"]
+
+
+def test_sqlite_output_client_write_batch_requires_open(sqlite_db):
+    with pytest.raises(ValueError):
+        SQLiteOutputClient().write_batch([_patent("US1")])
+
+
+def test_sqlite_output_client_keeps_legacy_table(sqlite_db):
+    conn = sqlite3.connect(sqlite_db)
+    conn.execute("CREATE TABLE patent (data TEXT)")
+    conn.execute("INSERT INTO patent VALUES ('{}')")
+    conn.commit()
+    conn.close()
+
+    SQLiteOutputClient().output_patents([_patent("US1")])
+    conn = sqlite3.connect(sqlite_db)
+    assert conn.execute("SELECT COUNT(*) FROM patent_legacy").fetchone()[0] == 1
+    assert conn.execute("SELECT patent_number FROM patent").fetchall() == [("US1",)]
+    conn.close()
+
+
+def test_sqlite_output_client_search_is_read_only(sqlite_db):
+    conn = sqlite3.connect(sqlite_db)
+    conn.execute("CREATE TABLE patent (data TEXT)")
+    conn.commit()
+    conn.close()
+
+    # A search doesn't migrate the database, it just finds nothing it can read
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteOutputClient.search(sqlite_db)
+    conn = sqlite3.connect(sqlite_db)
+    assert [row[0] for row in conn.execute("SELECT name FROM sqlite_master")] == ["patent"]
+    conn.close()
+
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteOutputClient.search(str(Path(sqlite_db).with_name("missing.db")))
+    assert not Path(sqlite_db).with_name("missing.db").exists()
+
+
+def test_sqlite_output_client_rolls_back_failed_batch(sqlite_db):
+    SQLiteOutputClient().output_patents([_patent("US1")])
+    with pytest.raises(ValueError):
+        SQLiteOutputClient().output_patents([_patent("US2"), _patent("US3").model_copy(update={"patent_number": None})])
+    assert [p.patent_number for p in SQLiteOutputClient.search(sqlite_db)] == ["US1"]
+
+
+def test_sqlite_output_client_repeated_patent_in_batch(sqlite_db):
+    # eg the same page fetched twice with --dedup off, the last occurrence wins
+    updated = _patent("US1", title="new title", claims=["claim 1", "claim 2"])
+    response = SQLiteOutputClient().output_patents([_patent("US1"), _patent("US2"), updated])
+    assert response.num_items_outputted == 2
+
+    conn = sqlite3.connect(sqlite_db)
+    assert conn.execute("SELECT COUNT(*) FROM patent_claim").fetchone()[0] == 3
+    assert conn.execute("SELECT COUNT(*) FROM patent_fts").fetchone()[0] == 2
+    conn.close()
+    assert SQLiteOutputClient.search(sqlite_db, patent_number="US1") == [updated]
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path / "out"))
+    return tmp_path / "out"
+
+
+def test_ndjson_output_client_rolls_by_records(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_max_file_records", 2)
+    patents = [_patent(f"US{i}") for i in range(5)]
+    response = NdjsonOutputClient().output_patents(patents[:3] + [PatentRecord.from_patent(p) for p in patents[3:]])
+
+    files = response.output_info["output_files"]
+    assert response.num_items_outputted == 5
+    assert len(files) == 3
+    assert sorted(str(p) for p in output_dir.iterdir()) == sorted(files)
+    assert list(read_patents(*files)) == patents
+
+
+def test_ndjson_output_client_rolls_by_size(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_max_file_bytes", 1)
+    monkeypatch.setattr(cli_settings, "output_compression_level", 1)
+    response = NdjsonOutputClient().output_patents([_patent(f"US{i}") for i in range(3)])
+    # buffered writes only reach the file on flush, so size based rolling is approximate
+    assert 1 <= len(response.output_info["output_files"]) <= 3
+    assert len(list(read_patents(*response.output_info["output_files"]))) == 3
+
+
+def test_ndjson_output_client_unique_files(output_dir):
+    first = NdjsonOutputClient().output_patents([_patent("US1")]).output_info["output_files"]
+    second = NdjsonOutputClient().output_patents([_patent("US2")]).output_info["output_files"]
+    assert first != second
+    assert len(list(output_dir.iterdir())) == 2
+
+
+def test_ndjson_output_client_discards_failed_file(output_dir):
+    with pytest.raises(ValueError):
+        NdjsonOutputClient().output_patents([_patent("US1"), object()])
+    assert list(output_dir.iterdir()) == []
+
+
+def test_ndjson_output_client_keeps_file_open_across_batches(output_dir):
+    with NdjsonOutputClient() as client:
+        assert client.write_batch([_patent("US1")]).output_info["output_files"] == []
+        client.write_batch([_patent("US2")])
+        # Only the temporary file exists until the run is closed, but it already holds every batch
+        assert [p.name.endswith(".tmp") for p in output_dir.iterdir()] == [True]
+        assert [p.patent_number for p in read_patents(next(output_dir.iterdir()))] == ["US1", "US2"]
+        with pytest.raises(ValueError):
+            client.write_batch([_patent("US3"), object()])
+    files = client.close().output_info["output_files"]
+    assert len(files) == 1
+    assert [p.patent_number for p in read_patents(*files)] == ["US1", "US2"]
+
+
+def test_ndjson_output_client_discards_files_rolled_by_failed_batch(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_max_file_records", 2)
+    with NdjsonOutputClient() as client:
+        client.write_batch([_patent("US1")])
+        with pytest.raises(ValueError):
+            client.write_batch([_patent("US2"), _patent("US3"), _patent("US4"), object()])
+        client.write_batch([_patent("US5")])
+    files = client.close().output_info["output_files"]
+
+    assert sorted(str(p) for p in output_dir.iterdir()) == sorted(files)
+    assert [p.patent_number for p in read_patents(*files)] == ["US1", "US5"]
+
+
+def test_ndjson_output_client_recover(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_max_file_records", 3)
+    crashed = NdjsonOutputClient().open()
+    crashed.write_batch([_patent("US1"), _patent("US2")])
+    position = crashed.write_batch([_patent("US3"), _patent("US4")]).output_info["position"]
+    # Written but never recorded, then the process dies without closing the client
+    crashed.write_batch([_patent("US5"), _patent("US6"), _patent("US7")])
+
+    with NdjsonOutputClient() as client:
+        client.recover(position)
+    files = sorted(output_dir.iterdir())
+
+    # the file left open is completed, the one the unrecorded batch rolled over to is removed
+    assert len(files) == 2
+    assert not [p for p in files if p.name.endswith(".tmp")]
+    assert [p.patent_number for p in read_patents(*files)] == ["US1", "US2", "US3", "US4"]
+
+
+def test_partitioned_output_client_by_month(output_dir):
+    patents = [
+        _patent("US1", grant_date=date(2024, 1, 5)),
+        _patent("US2", grant_date=date(2024, 2, 1)),
+        _patent("US3", grant_date=date(2024, 1, 31)),
+    ]
+    client = PartitionedOutputClient()
+    response = client.output_patents(patents[:2])
+    client.output_patents(patents[2:])
+
+    assert response.num_items_outputted == 2
+    assert set(response.output_info["partitions"]) == {"year=2024/month=01", "year=2024/month=02"}
+    manifest = read_manifest(output_dir)
+    assert manifest["records"] == 3
+    assert manifest["partitions"]["year=2024/month=01"]["records"] == 2
+    assert len(manifest["partitions"]["year=2024/month=01"]["files"]) == 2
+    assert all((output_dir / "year=2024/month=01" / Path(f).name).exists() for f in manifest["partitions"]["year=2024/month=01"]["files"])
+
+    assert sorted(p.patent_number for p in read_partitions(output_dir)) == ["US1", "US2", "US3"]
+    assert [p.patent_number for p in read_partitions(output_dir, grant_from_date=date(2024, 1, 10), grant_to_date=date(2024, 2, 1))] == ["US3"]
+    assert [p.patent_number for p in read_partitions(output_dir, grant_from_date=date(2024, 2, 1))] == ["US2"]
+
+
+def test_partitioned_output_client_by_day(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_partition_by", "day")
+    PartitionedOutputClient().output_patents([_patent("US1", grant_date=date(2024, 1, 5))])
+    assert list(read_manifest(output_dir)["partitions"]) == ["year=2024/month=01/day=05"]
+    assert [p.patent_number for p in read_partitions(output_dir, grant_from_date=date(2024, 1, 5), grant_to_date=date(2024, 1, 6))] == ["US1"]
+
+
+def test_partitioned_output_client_bounds_open_files(output_dir, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_partition_by", "day")
+    monkeypatch.setattr(PartitionedOutputClient, "MAX_OPEN_PARTITIONS", 2)
+    patents = [_patent(f"US{day}", grant_date=date(2024, 1, day)) for day in range(1, 6)]
+    with PartitionedOutputClient() as client:
+        client.write_batch(patents)
+        assert sum(writer._raw is not None for writer in client._writers.values()) == 2
+        # Evicted partitions' files are completed and in the manifest before the run ends
+        assert read_manifest(output_dir)["records"] == 3
+        client.write_batch([_patent("US6", grant_date=date(2024, 1, 1))])
+        assert sum(writer._raw is not None for writer in client._writers.values()) == 2
+
+    manifest = read_manifest(output_dir)
+    assert manifest["records"] == 6
+    assert len(manifest["partitions"]["year=2024/month=01/day=01"]["files"]) == 2
+    assert sorted(p.patent_number for p in read_partitions(output_dir)) == [f"US{i}" for i in range(1, 7)]
+
+
+class _UnserializablePatent:
+    def __init__(self, grant_date: date):
+        self.grant_date = grant_date
+
+    def model_dump_json(self) -> str:
+        raise TypeError("not serializable")
+
+
+def test_partitioned_output_client_discards_failed_batch_in_every_partition(output_dir):
+    with PartitionedOutputClient() as client:
+        client.write_batch([_patent("US1", grant_date=date(2024, 1, 5)), _patent("US2", grant_date=date(2024, 2, 5))])
+        with pytest.raises(ValueError):
+            client.write_batch([
+                _patent("US3", grant_date=date(2024, 1, 6)),
+                _patent("US4", grant_date=date(2024, 3, 6)),
+                _UnserializablePatent(date(2024, 2, 6)),
+            ])
+        # Nothing of the failed batch made it to the manifest, only the files it cut back to where they were
+        assert read_manifest(output_dir)["records"] == 2
+        client.write_batch([_patent("US5", grant_date=date(2024, 2, 7))])
+
+    manifest = read_manifest(output_dir)
+    assert set(manifest["partitions"]) == {"year=2024/month=01", "year=2024/month=02"}
+    assert manifest["records"] == 3
+    assert not list(output_dir.rglob("*.tmp"))
+    assert sorted(p.patent_number for p in read_partitions(output_dir)) == ["US1", "US2", "US5"]
+
+
+def test_partitioned_output_client_recover(output_dir, monkeypatch):
+    monkeypatch.setattr(PartitionedOutputClient, "MAX_OPEN_PARTITIONS", 1)
+    crashed = PartitionedOutputClient().open()
+    position = crashed.write_batch([_patent("US1", grant_date=date(2024, 1, 5))]).output_info["position"]
+    # Evicts January, so its file is in the manifest with a patent the checkpoint never recorded
+    crashed.write_batch([_patent("US2", grant_date=date(2024, 2, 5)), _patent("US3", grant_date=date(2024, 1, 6))])
+    assert read_manifest(output_dir)["records"] == 2
+
+    with PartitionedOutputClient() as client:
+        client.recover(position)
+
+    manifest = read_manifest(output_dir)
+    assert set(manifest["partitions"]) == {"year=2024/month=01"}
+    assert manifest["records"] == 1
+    assert not list(output_dir.rglob("*.tmp"))
+    assert [p.patent_number for p in read_partitions(output_dir)] == ["US1"]
+
+
+def test_output_registry_builtins():
+    assert OUTPUT_CLIENT[Output.SQLITE] is SQLiteOutputClient
+    assert OUTPUT_CLIENT["NDJSON"] is NdjsonOutputClient
+    assert set(OUTPUT_CLIENT.names()) >= {o.value for o in Output}
+    assert OUTPUT_CLIENT.by_class_name("PartitionedOutputClient") is PartitionedOutputClient
+    with pytest.raises(KeyError):
+        OUTPUT_CLIENT["nowhere"]
+
+
+def test_output_registry_entry_points(monkeypatch):
+    plugins = [
+        EntryPoint(name="mirror", value="patent_fetcher.clients.output.ndjson:NdjsonOutputClient", group=ENTRY_POINT_GROUP),
+        # a plugin can't take over a built-in name
+        EntryPoint(name="sqlite", value="patent_fetcher.clients.output.ndjson:NdjsonOutputClient", group=ENTRY_POINT_GROUP),
+    ]
+    monkeypatch.setattr(importlib.metadata, "entry_points", lambda group: [p for p in plugins if p.group == group])
+    registry = OutputRegistry()
+
+    assert "mirror" in registry
+    assert registry["mirror"] is NdjsonOutputClient
+    assert registry["sqlite"] is SQLiteOutputClient
@@ -3,10 +3,15 @@ from typing import Any
 from unittest.mock import MagicMock
 
 import pytest
+import requests
 from urllib3.exceptions import HTTPError
 
+from patent_fetcher.clients.output.base_client import OutputClient
 from patent_fetcher.clients.output.local import LocalOutputClient
+from patent_fetcher.clients.output.sqlite import SQLiteOutputClient
 from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.constants import DedupMode
+from patent_fetcher.exceptions import NonRetryableApiError, RetryableApiError
 from patent_fetcher.models.api import (
     HealthApiResponse,
     Patent,
@@ -17,6 +22,7 @@ from patent_fetcher.models.api import (
 )
 from patent_fetcher.models.output_client import OutputClientResponse
 from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
 
 """
 Tests for the PatentClient:
@@ -34,6 +40,11 @@ def _health_check_ok(**_) -> HealthApiResponse:
 def _raise_http_error(self: Any | None = None, **_) -> None:
     raise HTTPError("test error")
 
+def _http_error(status_code: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
 def _mock_patents_api(total_pages: int, total_items: int, num_mocks: int | None = 1, ) -> PatentsApiResponse:
     # Generates a response mimicking what the api endpoint would pass
     patents = []
@@ -91,7 +102,7 @@ def test_flush_buffer_no_client():
     assert response.num_items_outputted == 1
 
 def test_flush_buffer_no_patents():
-    response = PatentClient()._flush_patent_buffer(LocalOutputClient, [])
+    response = PatentClient()._flush_patent_buffer(LocalOutputClient(), [])
     assert response.num_items_outputted == 0
 
 def test_fetch_patents_all_pages(patents_api_request):
@@ -108,7 +119,8 @@ def test_fetch_patents_all_pages(patents_api_request):
 
     client._fetch_patent_page = _fake_fetch_patent_page
     response = client.fetch_patents(
-        PatentsClientRequest(api_request=patents_api_request, output_client=None)
+        # the mocks repeat patent numbers across pages
+        PatentsClientRequest(api_request=patents_api_request, output_client=None, dedup=DedupMode.OFF)
     )
 
     assert response.total_items_found == 5
@@ -167,3 +179,193 @@ def test_fetch_patents_flush_on_error(patents_api_request):
 @pytest.mark.skip(reason="Full test coverage would check all inputs / edge cases, consciously skipped for brevity")
 def test_flush_buffer_valid():
     pass
+
+def _fake_paged_api(total_pages: int, items_per_page: int = 2):
+    # Every page returns items_per_page patents numbered by page, so the fetch order can be checked afterwards
+    def _fake_fetch_patent_page(api_request):
+        response = _mock_patents_api(
+            num_mocks=items_per_page,
+            total_items=total_pages * items_per_page,
+            total_pages=total_pages
+        )
+        for patent in response.patents:
+            patent.patent_number = f"{api_request.pagination.page}_{patent.patent_number}"
+        return response
+    return _fake_fetch_patent_page
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_fetch_patents_concurrent_all_pages(patents_api_request, concurrency):
+    client = PatentClient()
+    client.check_health = _health_check_ok
+    client._fetch_patent_page = _fake_paged_api(total_pages=10)
+    flushed = []
+    client._flush_patent_buffer = lambda _, patents: flushed.extend(patents) or OutputClientResponse(num_items_outputted=len(patents))
+
+    response = client.fetch_patents(
+        PatentsClientRequest(api_request=patents_api_request, output_client=None, concurrency=concurrency)
+    )
+
+    assert response.total_items_found == 20
+    assert response.total_items_fetched == 20
+    assert response.total_pages_fetched == 10
+    assert response.total_items_outputted == 20
+    # pages are buffered in page order regardless of which finished first
+    assert [p.patent_number.split("_")[0] for p in flushed] == [str(page) for page in range(1, 11) for _ in range(2)]
+
+@pytest.mark.parametrize("start_page, num_pages, expected_pages", [
+    (1, None, [2, 3, 4, 5]),
+    (2, None, [3, 4, 5]),
+    (2, 2, [3]),
+    (4, 10, [5]),
+    (5, None, []),
+])
+def test_remaining_pages(patents_api_request, start_page, num_pages, expected_pages):
+    request = PatentsClientRequest(api_request=patents_api_request, start_page=start_page, num_pages=num_pages)
+    assert list(PatentClient._remaining_pages(request, total_pages=5)) == expected_pages
+
+def test_fetch_patents_concurrent_flush_on_error(patents_api_request):
+    mock_output = MagicMock()
+    fake_api = _fake_paged_api(total_pages=10)
+
+    def _fake_fetch_patent_page(api_request):
+        if api_request.pagination.page == 6:
+            raise HTTPError("error")
+        return fake_api(api_request)
+
+    client = PatentClient()
+    client.check_health = _health_check_ok
+    client._fetch_patent_page = _fake_fetch_patent_page
+    client._flush_patent_buffer = mock_output
+
+    with pytest.raises(ValueError):
+        client.fetch_patents(PatentsClientRequest(api_request=patents_api_request, concurrency=3))
+
+    # pages 1-5 are flushed, nothing after the failed page makes it into the buffer
+    mock_output.assert_called_once()
+    assert len(mock_output.call_args.args[1]) == 10
+
+def test_session_reused_and_closed():
+    with PatentClient(pool_size=3, keep_alive=False) as client:
+        session = client.session
+        assert client.session is session
+        assert session.headers["Authorization"].startswith("Bearer")
+        assert session.headers["Connection"] == "close"
+        assert session.get_adapter("https://example.com")._pool_maxsize == 3
+    assert client._session is None
+
+def test_request_uses_session():
+    client = PatentClient()
+    client._session = MagicMock()
+    client._session.request.return_value.content = b'{"status": "healthy", "service": "session-test"}'
+
+    assert client.check_health().service == "session-test"
+    assert client.check_health().service == "session-test"
+    assert client._session.request.call_count == 2
+
+class _RecordingOutputClient(OutputClient):
+    # Records the lifecycle calls of every instance, to check a run drives a single one
+    instances = []
+
+    def __init__(self):
+        self.calls = []
+        _RecordingOutputClient.instances.append(self)
+
+    def open(self):
+        self.calls.append("open")
+        return self
+
+    def write_batch(self, patents):
+        self.calls.append(len(patents))
+        return OutputClientResponse(num_items_outputted=len(patents))
+
+    def close(self):
+        self.calls.append("close")
+        return OutputClientResponse(output_info={"closed": True})
+
+    def output_patents(self, patents):
+        raise AssertionError("runs should write batches rather than single calls")
+
+def test_fetch_patents_single_output_session(patents_api_request, monkeypatch):
+    monkeypatch.setattr(cli_settings, "buffer_size", 4)
+    _RecordingOutputClient.instances = []
+    client = PatentClient()
+    client.check_health = _health_check_ok
+    client._fetch_patent_page = _fake_paged_api(total_pages=5)
+
+    response = client.fetch_patents(
+        PatentsClientRequest(api_request=patents_api_request, output_client=_RecordingOutputClient)
+    )
+
+    assert [instance.calls for instance in _RecordingOutputClient.instances] == [["open", 4, 4, 2, "close"]]
+    assert response.total_items_outputted == 10
+    assert response.output_info[-1] == OutputClientResponse(output_info={"closed": True}, sink="_RecordingOutputClient")
+
+@pytest.mark.parametrize("error, error_cls", [
+    (requests.ConnectionError("refused"), RetryableApiError),
+    (requests.Timeout("timed out"), RetryableApiError),
+    (_http_error(503), RetryableApiError),
+    (_http_error(429), RetryableApiError),
+    (_http_error(404), NonRetryableApiError),
+    (ValueError("anything else"), NonRetryableApiError),
+])
+def test_api_error_classification(error, error_cls):
+    api_error = PatentClient._api_error(error)
+    assert type(api_error) is error_cls
+    assert isinstance(api_error, requests.HTTPError)
+
+def test_fetch_page_retries_retryable_errors(patents_api_request, monkeypatch):
+    monkeypatch.setattr(cli_settings, "page_retry_backoff_seconds", 0)
+    attempts = []
+
+    def _flaky_fetch_patent_page(api_request):
+        attempts.append(api_request.pagination.page)
+        if len(attempts) < 3:
+            raise RetryableApiError("flaky")
+        return _mock_patents_api(num_mocks=1, total_items=1, total_pages=1)
+
+    client = PatentClient()
+    client._fetch_patent_page = _flaky_fetch_patent_page
+    assert client._fetch_patent_page_retrying(patents_api_request).pagination.total_items == 1
+    assert len(attempts) == 3
+
+def test_fetch_page_does_not_retry_non_retryable_errors(patents_api_request):
+    attempts = []
+
+    def _bad_fetch_patent_page(api_request):
+        attempts.append(api_request.pagination.page)
+        raise NonRetryableApiError("bad request")
+
+    client = PatentClient()
+    client._fetch_patent_page = _bad_fetch_patent_page
+    with pytest.raises(NonRetryableApiError):
+        client._fetch_page_or_failed(patents_api_request)
+    assert len(attempts) == 1
+
+@pytest.mark.parametrize("dedup", [DedupMode.EXACT, DedupMode.BLOOM])
+def test_fetch_patents_drops_duplicates(patents_api_request, dedup):
+    client = PatentClient()
+    client.check_health = _health_check_ok
+    # every page repeats patent_number_0 and patent_number_1
+    client._fetch_patent_page = lambda _: _mock_patents_api(num_mocks=2, total_items=6, total_pages=3)
+    flushed = []
+    client._flush_patent_buffer = lambda _, patents: flushed.extend(patents) or OutputClientResponse(num_items_outputted=len(patents))
+
+    response = client.fetch_patents(PatentsClientRequest(api_request=patents_api_request, dedup=dedup))
+
+    assert [patent.patent_number for patent in flushed] == ["patent_number_0", "patent_number_1"]
+    assert response.total_items_fetched == 6
+    assert response.duplicates_dropped == 4
+
+def test_fetch_patents_skip_existing(patents_api_request, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "sqlite_db", str(tmp_path / "patents.db"))
+    SQLiteOutputClient().output_patents(_mock_patents_api(num_mocks=1, total_items=1, total_pages=1).patents)
+    client = PatentClient()
+    client.check_health = _health_check_ok
+    client._fetch_patent_page = lambda _: _mock_patents_api(num_mocks=3, total_items=3, total_pages=1)
+
+    response = client.fetch_patents(PatentsClientRequest(
+        api_request=patents_api_request, output_client=SQLiteOutputClient, skip_existing=True
+    ))
+
+    assert response.duplicates_dropped == 1
+    assert response.total_items_outputted == 2
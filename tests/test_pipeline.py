@@ -0,0 +1,294 @@
+﻿import random
+import threading
+import time
+from datetime import date
+
+import pytest
+
+from patent_fetcher.clients.checkpoint import Checkpoint, CheckpointStore
+from patent_fetcher.clients.output.base_client import OutputClient
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.clients.pipeline import FanOutPipeline, FlushPipeline
+from patent_fetcher.constants import CacheMode
+from patent_fetcher.exceptions import PatentFetchError
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+
+def _count(patents) -> OutputClientResponse:
+    return OutputClientResponse(num_items_outputted=len(patents))
+
+def _client_request(**kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=5)
+        ),
+        **{"output_client": None, **kwargs}
+    )
+
+
+@pytest.mark.parametrize("workers", [0, 3])
+def test_markers_acknowledged_in_order(workers):
+    def _slow_count(patents):
+        time.sleep(random.random() / 100)
+        return _count(patents)
+
+    acked = []
+    pipeline = FlushPipeline(flush=_slow_count, on_flushed=acked.append, workers=workers, queue_size=2)
+    for i in range(20):
+        pipeline.submit([None] * i, marker=i)
+    results = pipeline.close()
+
+    assert acked == list(range(20))
+    assert [r.num_items_outputted for r in results] == list(range(20))
+    assert not pipeline.failed
+
+def test_backpressure_blocks_submit():
+    release = threading.Event()
+    pipeline = FlushPipeline(flush=lambda patents: release.wait() and _count(patents), workers=1, queue_size=1)
+    pipeline.submit([1])  # picked up by the writer, which then blocks
+    pipeline.submit([2])  # fills the queue
+
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (pipeline.submit([3]), submitted.set()), daemon=True).start()
+    assert not submitted.wait(0.2)
+
+    release.set()
+    assert submitted.wait(1)
+    assert len(pipeline.close()) == 3
+
+def test_writer_error_propagates():
+    def _fail_second(patents):
+        if patents == [2]:
+            raise ValueError("sink down")
+        return _count(patents)
+
+    acked = []
+    pipeline = FlushPipeline(flush=_fail_second, on_flushed=acked.append, workers=1, queue_size=1)
+    pipeline.submit([1], marker=1)
+    pipeline.submit([2], marker=2)
+    time.sleep(0.1)
+    with pytest.raises(ValueError):
+        pipeline.submit([3], marker=3)
+    pipeline.close()
+
+    assert pipeline.failed
+    assert acked == [1]
+
+def test_ordered_writers_write_in_submission_order():
+    def _first_slowest(patents):
+        time.sleep(0.05 if patents == [0] else random.random() / 100)
+        if patents == [5]:
+            raise ValueError("sink down")
+        written.append(patents[0])
+        return _count(patents)
+
+    written = []
+    pipeline = FlushPipeline(flush=_first_slowest, workers=4, queue_size=4, ordered=True)
+    with pytest.raises(ValueError):
+        for i in range(20):
+            pipeline.submit([i], marker=i)
+            time.sleep(0.001)
+    pipeline.close()
+
+    # Nothing was written out of turn, nor after the failed batch, although other writers already held later ones
+    assert written == [0, 1, 2, 3, 4]
+
+def test_fetch_patents_background_flush(fake_patents_api, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    with PatentClient() as client:
+        response = client.fetch_patents(_client_request(concurrency=2, flush_workers=2))
+
+    assert response.total_items_fetched == 50
+    assert response.total_items_outputted == 50
+    assert [o.num_items_outputted for o in response.output_info] == [10, 10, 10, 10, 10, 0]
+
+@pytest.mark.parametrize("state_db, ordered", [("state.db", True), ("", False)])
+def test_flush_workers_ordered_while_checkpointing(tmp_path, monkeypatch, state_db, ordered):
+    # Out of turn, a batch could be written after an earlier one failed, which --resume would then write again
+    monkeypatch.setattr(cli_settings, "state_db", state_db and str(tmp_path / state_db))
+    with PatentClient() as client:
+        pipeline = client._flush_pipeline(_client_request(flush_workers=3), {}, on_flushed=lambda _: None)
+        pipeline.close()
+    assert len(pipeline._threads) == 3
+    assert pipeline.ordered is ordered
+
+def test_fetch_patents_writer_error_in_response(fake_patents_api, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+
+    def _flush(_, patents):
+        if patents[0].patent_number == "US00000020":
+            raise ValueError("sink down")
+        return _count(patents)
+
+    with PatentClient() as client:
+        client._flush_patent_buffer = _flush
+        with pytest.raises(PatentFetchError) as e:
+            client.fetch_patents(_client_request(flush_workers=1))
+
+    assert "sink down" in e.value.response.errors
+    assert e.value.response.total_items_outputted == 20
+
+def test_fan_out_slow_sink_does_not_block_others():
+    release = threading.Event()
+    fast = []
+    pipeline = FanOutPipeline(
+        flushes={"slow": lambda patents: release.wait() and _count(patents), "fast": lambda patents: fast.append(patents) or _count(patents)},
+        workers=1,
+        queue_size=2
+    )
+    pipeline.submit([1])
+    pipeline.submit([2])
+    time.sleep(0.1)
+    assert fast == [[1], [2]]
+
+    release.set()
+    assert [r.num_items_outputted for r in pipeline.close()] == [1, 1, 1, 1]
+
+def test_fan_out_drops_failed_sink():
+    def _fail_second(patents):
+        if patents == [2]:
+            raise ValueError("sink down")
+        return _count(patents)
+
+    acked = []
+    pipeline = FanOutPipeline(flushes={"broken": _fail_second, "ok": _count}, on_flushed=acked.append, queue_size=1)
+    for i in range(1, 5):
+        pipeline.submit([i], marker=i)
+        time.sleep(0.05)
+    results = pipeline.close()
+
+    assert not pipeline.failed
+    assert [str(e) for e in pipeline.sink_errors["broken"]] == ["sink down"]
+    assert list(pipeline.sink_errors) == ["broken"]
+    # the healthy sink got every batch, but markers stop at the last batch written to both
+    assert len(results) == 5
+    assert acked == [1]
+
+def test_fan_out_leaves_out_written_batches():
+    written, sink_acked, acked = [], [], []
+    pipeline = FanOutPipeline(
+        flushes={"a": lambda patents: written.append(("a", patents)) or _count(patents), "b": lambda patents: written.append(("b", patents)) or _count(patents)},
+        on_flushed=acked.append,
+        on_sink_flushed=lambda sink, marker: sink_acked.append((sink, marker)),
+        written=lambda sink, marker: sink == "a" and marker <= 2,
+        queue_size=1
+    )
+    for i in range(1, 4):
+        pipeline.submit([i], marker=i)
+    results = pipeline.close()
+
+    # a already holds the first two batches, so only b writes them, yet every marker is acknowledged in order
+    assert sorted(written) == [("a", [3]), ("b", [1]), ("b", [2]), ("b", [3])]
+    assert len(results) == 4
+    assert acked == [1, 2, 3]
+    assert [marker for sink, marker in sink_acked if sink == "a"] == [1, 2, 3]
+
+def test_fan_out_fails_once_every_sink_failed():
+    def _fail(_):
+        raise ValueError("sink down")
+
+    pipeline = FanOutPipeline(flushes={"a": _fail, "b": _fail}, queue_size=1)
+    pipeline.submit([1])
+    time.sleep(0.1)
+    with pytest.raises(ValueError):
+        pipeline.submit([2])
+    pipeline.close()
+    assert pipeline.failed
+
+def test_fetch_patents_fan_out(fake_patents_api, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+
+    class _Sink(OutputClient):
+        def __init__(self):
+            self.written = []
+
+        def output_patents(self, patents):
+            self.written.extend(p.patent_number for p in patents)
+            return _count(patents)
+
+    class _BrokenSink(_Sink):
+        def output_patents(self, patents):
+            if len(self.written) >= 20:
+                raise ValueError("sink down")
+            return super().output_patents(patents)
+
+    with PatentClient() as client:
+        response = client.fetch_patents(_client_request(output_client=[_Sink, _BrokenSink], concurrency=2))
+        fingerprint = CheckpointStore.fingerprint(_client_request(output_client=[_Sink, _BrokenSink]))
+        # Stuck at the last batch the broken sink wrote, so resuming refills it
+        assert client.checkpoints.get(fingerprint) == Checkpoint(4, 10)
+
+    assert response.total_items_fetched == 50
+    assert response.sink_errors == {"_BrokenSink": ["sink down"]}
+    assert response.errors == ["sink down"]
+    assert sum(o.num_items_outputted for o in response.output_info if o.sink == "_Sink") == 50
+    assert response.total_items_outputted == 20
+
+def test_fetch_patents_fan_out_resume(fake_patents_api, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    written = {"_Sink": [], "_FlakySink": []}
+    broken = True
+
+    class _Sink(OutputClient):
+        def output_patents(self, patents):
+            written[type(self).__name__].extend(p.patent_number for p in patents)
+            return _count(patents)
+
+    class _FlakySink(_Sink):
+        def output_patents(self, patents):
+            if broken and len(written["_FlakySink"]) >= 20:
+                raise ValueError("sink down")
+            return super().output_patents(patents)
+
+    request = _client_request(output_client=[_Sink, _FlakySink], concurrency=2)
+    with PatentClient() as client:
+        client.fetch_patents(request)
+        fingerprint = CheckpointStore.fingerprint(request)
+        assert client.checkpoints.sink_pages(fingerprint) == {"_Sink": 10, "_FlakySink": 4}
+
+        broken = False
+        response = client.fetch_patents(request.model_copy(update={"resume": True, "cache_mode": CacheMode.BYPASS}))
+        assert client.checkpoints.get(fingerprint) == Checkpoint(10, 10)
+
+    assert response.total_pages_fetched == 6
+    assert not response.sink_errors
+    # the healthy sink isn't written the resumed pages again, the failed one is refilled
+    assert sorted(written["_Sink"]) == sorted(written["_FlakySink"]) == [f"US{i:08d}" for i in range(50)]
+
+def test_fetch_patents_fan_out_resume_splits_batches(fake_patents_api, monkeypatch):
+    fake_patents_api.total_items = 50
+    monkeypatch.setattr(cli_settings, "buffer_size", 10)
+    written = {"_Sink": [], "_OtherSink": []}
+    limits = {"_Sink": 30, "_OtherSink": 20}
+
+    class _Sink(OutputClient):
+        def output_patents(self, patents):
+            if len(written[type(self).__name__]) >= limits[type(self).__name__]:
+                raise ValueError("sink down")
+            written[type(self).__name__].extend(p.patent_number for p in patents)
+            return _count(patents)
+
+    class _OtherSink(_Sink):
+        pass
+
+    request = _client_request(output_client=[_Sink, _OtherSink])
+    with PatentClient() as client:
+        with pytest.raises(PatentFetchError):
+            client.fetch_patents(request)
+        assert client.checkpoints.sink_pages(CheckpointStore.fingerprint(request)) == {"_Sink": 6, "_OtherSink": 4}
+
+        # Batches of 3 pages on resume, so one is cut at page 6 where _Sink stopped
+        monkeypatch.setattr(cli_settings, "buffer_size", 15)
+        limits.update(_Sink=50, _OtherSink=50)
+        client.fetch_patents(request.model_copy(update={"resume": True, "cache_mode": CacheMode.BYPASS}))
+
+    assert sorted(written["_Sink"]) == sorted(written["_OtherSink"]) == [f"US{i:08d}" for i in range(50)]
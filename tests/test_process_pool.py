@@ -0,0 +1,82 @@
+﻿import gzip
+import json
+from datetime import date
+
+import pytest
+
+from patent_fetcher.clients.output.local import LocalOutputClient
+from patent_fetcher.clients.output.ndjson import NdjsonOutputClient, read_patents
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.clients.process_pool import process_pool, shutdown_process_pool
+from patent_fetcher.models.api import Patent, PatentRecord, PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(cli_settings, "process_workers", 2)
+    yield process_pool()
+    shutdown_process_pool()
+
+
+def _patent(number: str) -> Patent:
+    return Patent(
+        patent_number=number,
+        title=f"title {number}",
+        grant_date=date(2024, 1, 1),
+        abstract="abstract",
+        claims=["claim 1", "claim 2"],
+        assignees=["assignee"],
+        inventors=["inventor"],
+        description="description " * 50,
+    )
+
+
+def test_no_pool_by_default():
+    assert process_pool() is None
+
+def test_ndjson_output_client_compresses_in_pool(pool, tmp_path, monkeypatch):
+    monkeypatch.setattr(NdjsonOutputClient, "POOL_CHUNK_RECORDS", 3)
+    monkeypatch.setattr(cli_settings, "output_max_file_records", 4)
+    patents = [_patent(f"US{i}") for i in range(6)] + [PatentRecord.from_patent(_patent(f"US{i}")) for i in range(6, 10)]
+    with NdjsonOutputClient(tmp_path) as client:
+        client.write_batch(patents[:5])
+        client.write_batch(patents[5:])
+
+    # chunks are cut where files roll, so every file is still exactly OUTPUT_MAX_FILE_RECORDS
+    assert list(client.files.values()) == [4, 4, 2]
+    assert [p.patent_number for p in read_patents(*client.files)] == [f"US{i}" for i in range(10)]
+
+def test_local_output_client_compresses_in_pool(pool, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(LocalOutputClient, "POOL_CHUNK_RECORDS", 2)
+    patents = [_patent(f"US{i}") for i in range(5)]
+    pooled = LocalOutputClient().output_patents(patents).output_info["output_file"]
+    monkeypatch.setattr(cli_settings, "process_workers", 0)
+    inline = LocalOutputClient().output_patents(patents).output_info["output_file"]
+
+    with gzip.open(pooled, "rt") as f, gzip.open(inline, "rt") as g:
+        assert f.read() == g.read()
+    with gzip.open(pooled, "rt") as f:
+        assert [p["patent_number"] for p in json.load(f)] == [f"US{i}" for i in range(5)]
+
+def test_fetch_patents_decodes_in_pool(pool, fake_patents_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli_settings, "output_dir", str(tmp_path))
+    request = PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=4)
+        ),
+        output_client=NdjsonOutputClient,
+        concurrency=3
+    )
+    with PatentClient() as client:
+        response = client.fetch_patents(request)
+
+    # pages decoded in the pool still land in page order
+    files = list(tmp_path.glob("*.ndjson.gz"))
+    assert response.total_items_outputted == 25
+    assert len(files) == 1
+    assert [p.patent_number for p in read_patents(*files)] == [f"US{i:08d}" for i in range(25)]
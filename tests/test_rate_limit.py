@@ -0,0 +1,124 @@
+﻿import threading
+import time
+from datetime import date
+
+import pytest
+
+from patent_fetcher.clients.patent_client import PatentClient
+from patent_fetcher.clients.rate_limit import AdaptiveRateLimiter
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.patent_client import PatentsClientRequest
+from patent_fetcher.settings import cli_settings
+
+
+def _client_request(**kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=date(2024, 1, 1),
+            grant_to_date=date(2024, 1, 2),
+            pagination=PatentsApiRequestPage(page_size=5)
+        ),
+        output_client=None,
+        **kwargs
+    )
+
+
+
+def test_throttled_halves_window_and_rate():
+    limiter = AdaptiveRateLimiter(max_window=8, max_rate=100)
+    limiter.on_throttled(0)
+    assert limiter.window == 4
+    assert limiter.rate == 50
+    assert limiter.throttled == 1
+
+def test_healthy_grows_window_back():
+    limiter = AdaptiveRateLimiter(max_window=8, max_rate=100)
+    limiter.on_throttled(0)
+    # one step per window's worth of healthy responses
+    for _ in range(4):
+        limiter.on_success(0.01)
+    assert limiter.window == 5
+    assert limiter.rate == 60
+    for _ in range(100):
+        limiter.on_success(0.01)
+    assert limiter.window == 8
+    assert limiter.rate == 100
+
+def test_resize_restarts_window():
+    limiter = AdaptiveRateLimiter(max_window=8, max_rate=100)
+    limiter.on_throttled(0)
+    limiter.resize(1)
+    assert limiter.window == 1
+    # eg a concurrency 8 run after a concurrency 1 run on the same client
+    limiter.resize(8)
+    assert limiter.window == 8
+    assert limiter.max_window == 8
+    assert limiter.rate == 50
+
+def test_latency_spike_shrinks_window():
+    limiter = AdaptiveRateLimiter(max_window=8, latency_spike_factor=3)
+    for _ in range(AdaptiveRateLimiter.MIN_LATENCY_SAMPLES):
+        limiter.on_success(0.01)
+    limiter.on_success(1)
+    assert limiter.window == 6
+    assert limiter.rate is None
+
+def test_token_bucket_paces_requests():
+    limiter = AdaptiveRateLimiter(max_window=1, max_rate=50, burst=1)
+    started = time.monotonic()
+    for _ in range(6):
+        with limiter.slot():
+            pass
+    # the first request goes out straight away, the other five wait on a token each
+    assert time.monotonic() - started >= 5 / 50 * 0.9
+
+def test_retry_after_pauses_requests():
+    limiter = AdaptiveRateLimiter(max_window=1)
+    limiter.on_throttled(0.2)
+    started = time.monotonic()
+    with limiter.slot():
+        pass
+    assert time.monotonic() - started >= 0.15
+
+def test_slot_caps_in_flight():
+    limiter = AdaptiveRateLimiter(max_window=2)
+    in_flight, max_in_flight, lock = [0], [0], threading.Lock()
+
+    def _request():
+        with limiter.slot():
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max_in_flight[0] == 2
+
+@pytest.mark.parametrize("retry_after", ["0", None])
+def test_fetch_patents_retries_throttled_pages(fake_patents_api, monkeypatch, retry_after):
+    monkeypatch.setattr(cli_settings, "throttle_backoff_seconds", 0)
+    fake_patents_api.total_items = 50
+    fake_patents_api.throttle_requests = 3
+    fake_patents_api.retry_after = retry_after
+
+    with PatentClient() as client:
+        response = client.fetch_patents(_client_request(concurrency=4))
+
+    assert response.total_items_fetched == 50
+    assert response.throttled_requests == 3
+    # the window shrinks on the throttled first page, then grows back with the healthy pages after it
+    assert response.concurrency_window == 4
+
+def test_fetch_patents_gives_up_when_throttled(fake_patents_api, monkeypatch):
+    monkeypatch.setattr(cli_settings, "throttle_retries", 1)
+    monkeypatch.setattr(cli_settings, "page_retries", 0)
+    fake_patents_api.throttle_requests = 2
+
+    with PatentClient() as client, pytest.raises(ValueError):
+        client.fetch_patents(_client_request())
@@ -0,0 +1,100 @@
+﻿from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+from pydantic import ValidationError
+
+from patent_fetcher.clients.sharding import ShardedPatentClient, halve_date_range, split_date_range
+from patent_fetcher.models.api import PatentsApiRequest, PatentsApiRequestPage
+from patent_fetcher.models.output_client import OutputClientResponse
+from patent_fetcher.models.patent_client import PatentsClientRequest, PatentsClientResponse
+from patent_fetcher.settings import cli_settings
+
+"""
+Sharded fetches run against the local stand-in api, on a thread pool instead of processes so the fixture applies
+"""
+
+
+def _sharded_request(start: date, end: date, **kwargs) -> PatentsClientRequest:
+    return PatentsClientRequest(
+        api_request=PatentsApiRequest(
+            grant_from_date=start,
+            grant_to_date=end,
+            pagination=PatentsApiRequestPage(page_size=10)
+        ),
+        output_client=None,
+        **kwargs
+    )
+
+def _thread_pool(workers):
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+@pytest.mark.parametrize("span_days, expected", [
+    (10, [(date(2024, 1, 1), date(2024, 1, 11)), (date(2024, 1, 11), date(2024, 1, 21)), (date(2024, 1, 21), date(2024, 1, 25))]),
+    (30, [(date(2024, 1, 1), date(2024, 1, 25))]),
+    (1, [(date(2024, 1, d), date(2024, 1, d + 1)) for d in range(1, 25)]),
+])
+def test_split_date_range(span_days, expected):
+    assert split_date_range(date(2024, 1, 1), date(2024, 1, 25), span_days) == expected
+
+def test_split_date_range_invalid_span():
+    with pytest.raises(ValueError):
+        split_date_range(date(2024, 1, 1), date(2024, 1, 25), 0)
+
+def test_halve_date_range():
+    assert halve_date_range(date(2024, 1, 1), date(2024, 1, 6)) == [(date(2024, 1, 1), date(2024, 1, 3)), (date(2024, 1, 3), date(2024, 1, 6))]
+    assert halve_date_range(date(2024, 1, 1), date(2024, 1, 2)) is None
+
+def test_merge_client_responses():
+    response = PatentsClientResponse.merge([
+        PatentsClientResponse(total_items_found=3, total_items_fetched=3, total_pages_fetched=1, total_items_outputted=3,
+                              output_info=[OutputClientResponse(num_items_outputted=3)]),
+        PatentsClientResponse(total_items_found=5, total_items_fetched=4, total_pages_fetched=2, total_items_outputted=4,
+                              output_info=[OutputClientResponse(num_items_outputted=4)]),
+    ])
+    assert response.total_items_found == 8
+    assert response.total_items_fetched == 7
+    assert response.total_pages_fetched == 3
+    assert response.total_items_outputted == 7
+    assert len(response.output_info) == 2
+
+def test_sharding_rejects_page_selection():
+    with pytest.raises(ValidationError):
+        _sharded_request(date(2024, 1, 1), date(2024, 2, 1), shard_days=7, num_pages=2)
+
+def test_fetch_patents_fixed_shards(fake_patents_api):
+    fake_patents_api.items_per_day = 3
+    client = ShardedPatentClient(workers=2, executor_factory=_thread_pool)
+    response = client.fetch_patents(_sharded_request(date(2024, 1, 1), date(2024, 1, 15), shard_days=7))
+
+    assert response.total_items_found == 42
+    assert response.total_items_fetched == 42
+    # each 7 day shard has 21 items over 3 pages of 10
+    assert response.total_pages_fetched == 6
+    assert {(r["grant_from_date"], r["grant_to_date"]) for r in fake_patents_api.requests} == {
+        ("2024-01-01", "2024-01-08"), ("2024-01-08", "2024-01-15")
+    }
+
+def test_fetch_patents_adaptive_shards(fake_patents_api):
+    fake_patents_api.items_per_day = 10
+    client = ShardedPatentClient(workers=4, executor_factory=_thread_pool)
+    response = client.fetch_patents(_sharded_request(date(2024, 1, 1), date(2024, 1, 9), max_shard_pages=2))
+
+    # 8 days at a page per day, halved until every shard is at most 2 days (2 pages)
+    assert response.total_items_fetched == 80
+    assert response.total_pages_fetched == 8
+    shards = {(r["grant_from_date"], r["grant_to_date"]) for r in fake_patents_api.requests}
+    assert ("2024-01-01", "2024-01-03") in shards
+    assert ("2024-01-07", "2024-01-09") in shards
+
+def test_fetch_patents_adaptive_shards_probe_reused(fake_patents_api, monkeypatch):
+    # Without a page cache to fall back on, the probed first page is handed on rather than fetched again
+    monkeypatch.setattr(cli_settings, "cache_db", None)
+    fake_patents_api.items_per_day = 10
+    client = ShardedPatentClient(workers=1, executor_factory=_thread_pool)
+    response = client.fetch_patents(_sharded_request(date(2024, 1, 1), date(2024, 1, 3), max_shard_pages=2))
+
+    assert response.total_items_fetched == 20
+    pages = [(r["grant_from_date"], r["grant_to_date"], r["pagination"]["page"]) for r in fake_patents_api.requests]
+    assert sorted(pages) == [("2024-01-01", "2024-01-03", 1), ("2024-01-01", "2024-01-03", 2)]
@@ -0,0 +1,60 @@
+﻿import os
+import subprocess
+import sys
+from pathlib import Path
+
+"""
+Startup regression tests - importing the cli (what every invocation, eg a check-health probe, pays before doing
+anything) should stay cheap, so they run it in a fresh interpreter with -X importtime and check what got imported
+rather than how long it took, which is too noisy on a busy machine (eagerly ~300ms, lazily ~20ms)
+"""
+
+ROOT = Path(__file__).parent.parent
+# Only imported once a command needs them
+LAZY_MODULES = (
+    "requests",
+    "pydantic",
+    "pydantic_settings",
+    "patent_fetcher.settings",
+    "patent_fetcher.clients.patent_client",
+    "patent_fetcher.clients.sharding",
+    "patent_fetcher.clients.output.local",
+    "patent_fetcher.clients.output.sqlite",
+    "patent_fetcher.clients.output.ndjson",
+    "patent_fetcher.clients.output.partitioned",
+)
+
+
+def _run(code: str, *args: str) -> subprocess.CompletedProcess:
+    # No API_URL, so anything reading the settings fails
+    env = {k: v for k, v in os.environ.items() if k not in ("API_URL", "API_TOKEN")}
+    return subprocess.run([sys.executable, *args, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+
+
+def _import_times(stderr: str) -> dict[str, int]:
+    """
+    :return: cumulative import time in microseconds per module, from -X importtime output
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_is_lazy():
+    result = _run("import patent_fetcher.cli", "-X", "importtime")
+    assert result.returncode == 0, result.stderr
+    times = _import_times(result.stderr)
+
+    assert "patent_fetcher.cli" in times
+    assert [module for module in LAZY_MODULES if module in times] == []
+
+
+def test_cli_help_without_settings():
+    result = _run("from patent_fetcher.cli import cli; cli(['fetch-patents', '--help'])")
+    assert result.returncode == 0, result.stderr
+    assert "[local|sqlite|ndjson|partitioned]" in result.stdout